@@ -5,6 +5,9 @@ from datetime import datetime
 # import the opencv library
 import cv2
 
+# import pytorch
+import torch
+
 # import the faces library
 from faces.builder import DefaultBuilder
 from faces.types import Image
@@ -23,15 +26,17 @@ while True:
     ret, raw_image = vid.read()
     image = Image.from_array(raw_image)
 
-    # identify faces in the image
-    extracts = [
-        (bounding_box, face_patch, builder.identifier(face_patch))
-        for bounding_box, face_patch in builder.detector.extract(image)
-    ]
+    # identify all faces in the image at once
+    extracts = list(builder.detector.extract(image))
+    identities = (
+        builder.identifier.many(torch.stack([patch for _, patch in extracts]))
+        if extracts
+        else []
+    )
 
     # annotate the image show it
     builder.annotate.with_identity(
-        image, ((bbox, identity) for bbox, _, identity in extracts)
+        image, ((bbox, identity) for (bbox, _), (identity, _) in zip(extracts, identities))
     ).save("static/faceCapture.jpg")
 
     # show status
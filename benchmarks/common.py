@@ -0,0 +1,42 @@
+"""Helpers shared by the benchmark scripts."""
+
+import time
+from typing import Callable, Tuple
+
+import torch
+
+
+def synthetic_gallery(
+    num_identities: int,
+    faces_per_identity: int,
+    num_queries: int,
+    noise: float = 1.2,
+    dim: int = 512,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """Return unit-length reference encodings, their targets, and queries.
+    Each identity's faces and queries scatter around a random center.
+    """
+    generator = torch.Generator().manual_seed(0)
+    centers = torch.randn((num_identities, dim), generator=generator)
+    targets = torch.arange(num_identities).repeat_interleave(faces_per_identity)
+    references = centers[targets] + noise * torch.randn(
+        (len(targets), dim), generator=generator
+    )
+    queries = centers[
+        torch.randint(num_identities, (num_queries,), generator=generator)
+    ] + noise * torch.randn((num_queries, dim), generator=generator)
+    return (
+        torch.nn.functional.normalize(references, dim=1),
+        targets,
+        torch.nn.functional.normalize(queries, dim=1),
+    )
+
+
+def timeit(func: Callable[[], object], repeat: int = 3) -> float:
+    """Return the fastest of *repeat* runs of *func*, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""Compare the throughput of the cosine index to the cdist-based exact index.
+
+Agreement is the fraction of queries whose nearest neighbour matches the
+one of the cdist-based index, error the largest deviation of the distance.
+
+"""
+
+import argparse
+from functools import partial
+
+import torch
+from common import synthetic_gallery, timeit
+
+from faces.index import BruteForceIndex, CosineIndex
+
+
+def _megabytes(tensor: torch.Tensor) -> float:
+    """Return the size of *tensor*'s elements in MiB."""
+    return tensor.element_size() * tensor.nelement() / 2**20
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--identities", type=int, default=5000)
+    parser.add_argument("--faces-per-identity", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=256)
+    args = parser.parse_args()
+
+    references, targets, queries = synthetic_gallery(
+        args.identities, args.faces_per_identity, args.queries
+    )
+    print(f"{len(references)} references, {len(queries)} queries")
+
+    exact = BruteForceIndex(references, targets)
+    exact_targets, exact_distances = exact.many(queries)
+    latency = timeit(partial(exact.many, queries))
+    print(f"{'index':>16} {'agreement':>10} {'error':>8} {'queries/s':>10} {'MB':>8}")
+    print(
+        f"{'cdist':>16} {1.0:10.3f} {0.0:8.4f} {len(queries) / latency:10.0f} "
+        f"{_megabytes(references):8.1f}"
+    )
+
+    for dtype in (torch.float32, torch.bfloat16, torch.float16):
+        index = CosineIndex(references, targets, dtype=dtype)
+        found, distances = index.many(queries)
+        agreement = (found == exact_targets).float().mean().item()
+        error = (distances - exact_distances).abs().max().item()
+        latency = timeit(partial(index.many, queries))
+        print(
+            f"{f'cosine/{str(dtype)[6:]}':>16} {agreement:10.3f} {error:8.4f} "
+            f"{len(queries) / latency:10.0f} {_megabytes(index.encodings):8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
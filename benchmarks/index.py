@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Compare the recall and latency of the approximate to the exact index.
+
+Recall is the fraction of queries whose approximate nearest neighbour
+is as close as the exact nearest neighbour.
+
+"""
+
+import argparse
+from functools import partial
+
+import torch
+from common import synthetic_gallery, timeit
+
+from faces.index import BruteForceIndex, IVFIndex
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--identities", type=int, default=5000)
+    parser.add_argument("--faces-per-identity", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--num-lists", type=int, default=256)
+    parser.add_argument("--num-probes", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    references, targets, queries = synthetic_gallery(
+        args.identities, args.faces_per_identity, args.queries
+    )
+    print(f"{len(references)} references, {len(queries)} queries")
+
+    exact = BruteForceIndex(references, targets)
+    _, exact_distances = exact.many(queries)
+    latency = timeit(partial(exact.many, queries)) / len(queries)
+    print(f"{'index':>16} {'recall':>8} {'ms/query':>10}")
+    print(f"{'exact':>16} {1.0:8.3f} {1000 * latency:10.3f}")
+
+    index = IVFIndex(references, targets, num_lists=args.num_lists)
+    for num_probes in args.num_probes:
+        index.num_probes = num_probes
+        _, distances = index.many(queries)
+        recall = torch.isclose(distances, exact_distances).float().mean().item()
+        latency = timeit(partial(index.many, queries)) / len(queries)
+        print(f"{f'ivf/{num_probes}':>16} {recall:8.3f} {1000 * latency:10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Compare the throughput of the prototype index to the exact index.
+
+Half of the queries are of unknown identities. Agreement is the fraction of
+queries that are identified alike, or rejected alike, by the distance threshold.
+Fallback is the fraction of queries compared to every reference.
+
+"""
+
+import argparse
+from functools import partial
+
+import torch
+from common import synthetic_gallery, timeit
+
+from faces.index import BruteForceIndex, PrototypeIndex
+
+
+def _decisions(
+    targets: torch.Tensor, distances: torch.Tensor, threshold: float
+) -> torch.Tensor:
+    """Return the targets, or -1 where the distance exceeds *threshold*."""
+    return torch.where(distances <= threshold, targets, -1)
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--identities", type=int, default=5000)
+    parser.add_argument("--faces-per-identity", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--threshold", type=float, default=1.2)
+    parser.add_argument("--num-prototypes", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--margins", type=float, nargs="+", default=[0.0, 0.1, 0.2])
+    args = parser.parse_args()
+
+    references, targets, known = synthetic_gallery(
+        args.identities, args.faces_per_identity, args.queries // 2
+    )
+    generator = torch.Generator().manual_seed(1)
+    unknown = torch.nn.functional.normalize(
+        torch.randn(
+            (args.queries - len(known), references.shape[1]), generator=generator
+        ),
+        dim=1,
+    )
+    queries = torch.cat([known, unknown])
+    print(f"{len(references)} references, {len(queries)} queries")
+
+    exact = BruteForceIndex(references, targets)
+    expected = _decisions(*exact.many(queries), args.threshold)
+    latency = timeit(partial(exact.many, queries))
+    print(f"{'index':>16} {'agreement':>10} {'fallback':>9} {'queries/s':>10}")
+    print(f"{'exact':>16} {1.0:10.3f} {1.0:9.3f} {len(queries) / latency:10.0f}")
+
+    for num_prototypes in args.num_prototypes:
+        index = PrototypeIndex(
+            references,
+            targets,
+            num_prototypes=num_prototypes,
+            threshold=args.threshold,
+        )
+        prototypes, _ = index.prototypes
+        for margin in args.margins:
+            index.margin = margin
+            found = _decisions(*index.many(queries), args.threshold)
+            agreement = (found == expected).float().mean().item()
+            distances = torch.cdist(queries, prototypes).min(1).values
+            fallback = ((distances - args.threshold).abs() <= margin).float().mean()
+            latency = timeit(partial(index.many, queries))
+            print(
+                f"{f'prototype{num_prototypes}/{margin}':>16} {agreement:10.3f} "
+                f"{fallback.item():9.3f} {len(queries) / latency:10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
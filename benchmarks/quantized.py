@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Compare the memory, recall, and latency of the quantized to the exact index.
+
+Memory counts the tensors held by the index, including the exact encodings
+the quantized indices keep to re-rank candidates. These are only read for the
+candidates, and stay on disc if memory-mapped from a snapshot. Agreement is the fraction of queries whose nearest neighbour
+has the same identity as the exact one, recall the fraction of queries whose
+nearest neighbour is as close as the exact one.
+
+"""
+
+import argparse
+from functools import partial
+from typing import Any
+
+import torch
+from common import synthetic_gallery, timeit
+
+from faces.index import BruteForceIndex, Int8Index, PQIndex
+
+
+def _megabytes(index: Any) -> float:
+    """Return the size of the tensors held by *index* in MiB."""
+    storages = {
+        tensor.untyped_storage().data_ptr(): tensor.untyped_storage().nbytes()
+        for tensor in vars(index).values()
+        if isinstance(tensor, torch.Tensor)
+    }
+    return sum(storages.values()) / 2**20
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--identities", type=int, default=5000)
+    parser.add_argument("--faces-per-identity", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--num-subspaces", type=int, nargs="+", default=[32, 64])
+    parser.add_argument("--num-candidates", type=int, nargs="+", default=[0, 16, 64])
+    args = parser.parse_args()
+
+    references, targets, queries = synthetic_gallery(
+        args.identities, args.faces_per_identity, args.queries
+    )
+    print(f"{len(references)} references, {len(queries)} queries")
+
+    exact = BruteForceIndex(references, targets)
+    exact_targets, exact_distances = exact.many(queries)
+    latency = timeit(partial(exact.many, queries)) / len(queries)
+    print(f"{'index':>16} {'MB':>8} {'agreement':>10} {'recall':>8} {'ms/query':>10}")
+    print(
+        f"{'exact':>16} {_megabytes(exact):8.1f} {1.0:10.3f} {1.0:8.3f} "
+        f"{1000 * latency:10.3f}"
+    )
+
+    factories = {"int8": Int8Index}
+    for num_subspaces in args.num_subspaces:
+        factories[f"pq{num_subspaces}"] = partial(PQIndex, num_subspaces=num_subspaces)
+    for name, factory in factories.items():
+        for num_candidates in args.num_candidates:
+            # NOTE: exact encodings are only kept if candidates are re-ranked
+            index = factory(references, targets, num_candidates=num_candidates)
+            found, distances = index.many(queries)
+            agreement = (found == exact_targets).float().mean().item()
+            recall = torch.isclose(distances, exact_distances).float().mean().item()
+            latency = timeit(partial(index.many, queries)) / len(queries)
+            print(
+                f"{f'{name}/{num_candidates}':>16} {_megabytes(index):8.1f} "
+                f"{agreement:10.3f} {recall:8.3f} {1000 * latency:10.3f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
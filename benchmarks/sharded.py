@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""Compare the throughput of the sharded index to the exact index.
+
+Each shard is searched by the exact index in a worker process,
+so that the throughput grows with the number of cores.
+
+"""
+
+import argparse
+import os
+from functools import partial
+
+from common import synthetic_gallery, timeit
+
+from faces.index import BruteForceIndex, ShardedIndex
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--identities", type=int, default=5000)
+    parser.add_argument("--faces-per-identity", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=256)
+    parser.add_argument("--num-shards", type=int, nargs="+", default=[2, 4])
+    args = parser.parse_args()
+
+    references, targets, queries = synthetic_gallery(
+        args.identities, args.faces_per_identity, args.queries
+    )
+    print(
+        f"{len(references)} references, {len(queries)} queries, {os.cpu_count()} cores"
+    )
+
+    exact = BruteForceIndex(references, targets)
+    exact_targets, _ = exact.topk(queries, 10)
+    latency = timeit(partial(exact.topk, queries, 10))
+    print(f"{'index':>16} {'agreement':>10} {'queries/s':>10}")
+    print(f"{'exact':>16} {1.0:10.3f} {len(queries) / latency:10.0f}")
+
+    for num_shards in args.num_shards:
+        index = ShardedIndex(references, targets, num_shards=num_shards)
+        found, _ = index.topk(queries, 10)
+        agreement = (found == exact_targets).float().mean().item()
+        latency = timeit(partial(index.topk, queries, 10))
+        index.close()
+        print(
+            f"{f'sharded/{num_shards}':>16} {agreement:10.3f} "
+            f"{len(queries) / latency:10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
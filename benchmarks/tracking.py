@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Compare the frame rate of detecting faces in every frame to tracking them.
+
+The video pans across an image, a few pixels per frame. Faces are detected
+and extracted every *detection interval* frames, and followed by optical flow
+in between. Identification is left out, but counted: identified is the number
+of faces per frame that would be encoded, once every *reidentify interval*
+frames at most. Offset is the mean distance of the tracked to the detected
+boxes, in pixels.
+
+"""
+
+import argparse
+import itertools
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import torch
+
+from faces import Image
+from faces.detector import MTCNNDetector
+from faces.tracker import Tracker, associate
+
+
+def main() -> None:
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--image",
+        type=Path,
+        default=Path(__file__).parent.parent / "test/data/images/monty_python.jpg",
+    )
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--speed", type=int, default=2)
+    parser.add_argument("--intervals", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--reidentify-intervals", type=int, nargs="+", default=[1, 30])
+    args = parser.parse_args()
+
+    detector = MTCNNDetector(device=torch.device("cpu"))
+    image = np.asarray(Image.open(args.image).image)
+    video = [
+        Image.from_array(np.roll(image, args.speed * index, axis=1))
+        for index in range(args.frames)
+    ]
+    expected = [detector.detect(frame).boxes for frame in video]
+    print(f"{args.frames} frames, {len(expected[0])} faces")
+
+    print(f"{'interval':>10} {'frames/s':>10} {'identified':>11} {'offset':>8}")
+    for interval, reidentify_interval in itertools.product(
+        args.intervals, args.reidentify_intervals
+    ):
+        tracker = Tracker(
+            detection_interval=interval, reidentify_interval=reidentify_interval
+        )
+        offsets = []
+        identified = []
+
+        def identify(patches: torch.Tensor) -> List[Tuple[str, float]]:
+            """Count the identified *patches*."""
+            identified.extend(patches)
+            return [("", 0.0)] * len(patches)
+
+        start = time.perf_counter()
+        for frame, boxes in zip(video, expected):
+            gray = np.asarray(frame.image.convert("L"))
+            if tracker.needs_detection:
+                detections = detector.extract_batch(frame)
+                tracks = tracker.update(gray, detections, identify)
+            else:
+                tracks = tracker.propagate(gray)
+            found = np.array([track.box for track in tracks]).reshape(-1, 4)
+            offsets.extend(
+                np.abs(found[row] - boxes[col]).mean()
+                for row, col in associate(found, boxes, threshold=0.3)
+            )
+        seconds = time.perf_counter() - start
+        print(
+            f"{f'{interval}/{reidentify_interval}':>10} {args.frames / seconds:10.1f} "
+            f"{len(identified) / args.frames:11.2f} {np.mean(offsets):8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,31 @@
 from __future__ import annotations
 
 import argparse
+import time
 from abc import ABC, abstractmethod
-from collections.abc import Iterable, Iterator
+from collections import Counter
+from collections.abc import Iterable, Iterator, Sized
+from contextlib import contextmanager
 from functools import cached_property
 from pathlib import Path
-from typing import Any, Tuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
+import numpy as np
 import torch
 from PIL import Image as PILImage
 
 from faces.types import (
     BoundingBox,
+    Detections,
     FaceEncoding,
     FacePatch,
     FaceProbability,
     Identity,
     Image,
+    Progress,
     VideoFrame,
 )
+from faces.utils import chunked
 
 
 class Identifier(ABC):
@@ -28,10 +35,77 @@ class Identifier(ABC):
     def __call__(self, face_patch: FacePatch) -> Identity:
         """Return the identity of the person in *face_patch*."""
 
+    @abstractmethod
+    def many(self, patches: torch.Tensor) -> List[Tuple[Identity, float]]:
+        """Return the identities and distances of N face *patches* given as an (N, ...) tensor."""
+
+    @abstractmethod
+    def add(self, face: torch.Tensor, identity: Identity) -> None:
+        """Add a reference *face* of *identity*, given as face patch or encoding."""
+
+    @abstractmethod
+    def remove(self, identity: Identity) -> None:
+        """Remove all references of *identity*."""
+
+
+class Index(ABC):
+    """Search the nearest reference encodings.
+    References are labelled with integer targets.
+    """
+
+    # reference encodings, (M, ...)
+    encodings: torch.Tensor
+
+    # reference targets, (M,)
+    targets: torch.Tensor
+
+    def __call__(self, encoding: FaceEncoding) -> Tuple[int, float]:
+        """Return the nearest neighbour's target and its distance to *encoding*."""
+        targets, distances = self.many(encoding.unsqueeze(0))
+        return int(targets[0].item()), distances[0].item()
+
+    @abstractmethod
+    def many(self, encodings: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the nearest neighbours' targets and distances to N *encodings*."""
+
+    @abstractmethod
+    def topk(
+        self, encodings: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the targets and distances of the *k* nearest neighbours to N *encodings*.
+        Both are (N, k)-tensors, sorted by distance. There are fewer columns if
+        there are fewer references, and approximate indices pad the rows of queries
+        with fewer candidates with target -1 and an infinite distance.
+        """
+
+    @abstractmethod
+    def add(self, encoding: FaceEncoding, target: int) -> None:
+        """Append a reference *encoding* with label *target*."""
+
+    @abstractmethod
+    def remove(self, target: int) -> None:
+        """Remove all references with label *target*."""
+
+    def references(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the encodings and targets of all references, row by row.
+        Raises a ValueError if the index doesn't keep the encodings.
+        """
+        if len(self.encodings) != len(self.targets):
+            raise ValueError("the index doesn't hold the encodings of all references")
+        return self.encodings, self.targets
+
+    @property
+    def is_empty(self) -> bool:
+        """Return True if there are no references."""
+        return len(self.targets) == 0
+
 
 class Detector(ABC):
     """Detect faces."""
 
+    # size of the extracted face patches
+    patch_size: int = 160
+
     @abstractmethod
     def detect(self, image: Image) -> Iterable[Tuple[BoundingBox, FaceProbability]]:
         """Return the bounding boxes and likelihoods of there being a face."""
@@ -40,6 +114,35 @@ class Detector(ABC):
     def extract(self, image: Image) -> Iterable[Tuple[BoundingBox, FacePatch]]:
         """Return the bounding boxes and faces detected in an image."""
 
+    def extract_batch(self, image: Image) -> Detections:
+        """Return the faces detected in an image, with their (N, ...) patches.
+        The patches can be passed to `Encoder.many` as they are.
+        """
+        probabilities = dict(self.detect(image))
+        extracts = list(self.extract(image))
+        if not extracts:
+            return Detections.empty().with_patches(
+                torch.empty((0, 3, self.patch_size, self.patch_size))
+            )
+        boxes, patches = zip(*extracts)
+        return Detections(
+            boxes=np.array([box.as_tuple for box in boxes]),
+            probabilities=np.array([probabilities[box] for box in boxes]),
+            patches=torch.stack(patches),
+        )
+
+    def detect_many(
+        self, images: Sequence[Image]
+    ) -> List[Iterable[Tuple[BoundingBox, FaceProbability]]]:
+        """Return the bounding boxes and likelihoods of there being a face, per image."""
+        return [list(self.detect(image)) for image in images]
+
+    def extract_many(
+        self, images: Sequence[Image]
+    ) -> List[List[Tuple[BoundingBox, FacePatch]]]:
+        """Return the bounding boxes and faces detected in each of the *images*."""
+        return [list(self.extract(image)) for image in images]
+
 
 class Encoder(ABC):
     """Encode a face patch."""
@@ -52,22 +155,103 @@ class Encoder(ABC):
     def many(self, patches: torch.Tensor) -> torch.Tensor:
         """Return N encodings of face *patches* given as an (N, ...) tensor."""
 
+    @property
+    @abstractmethod
+    def version(self) -> str:
+        """Return the identity of the encoding model.
+        Encodings of different versions are not comparable.
+        """
+
 
 class Registry(ABC):
     """Face patches and identities storage."""
 
     @abstractmethod
-    def add(self, face_patch: FacePatch, identity: Identity) -> None:
-        """Store a face and its identity. Auto-commits."""
+    def add(
+        self,
+        face_patch: FacePatch,
+        identity: Identity,
+        encoding: Optional[Tuple[str, FaceEncoding]] = None,
+    ) -> bool:
+        """Store a face and its identity. Auto-commits.
+        The face's *encoding* can be passed along as (encoder version, encoding)-tuple.
+        Returns False if the face was already stored with this identity.
+        """
 
     @abstractmethod
     def remove(self, identity: Identity) -> None:
         """Remove an identity and all its faces. Auto-commits."""
 
+    def fingerprint(self) -> Optional[str]:
+        """Return a digest of the faces and identities, or None if the registry can't tell.
+        The fingerprint changes whenever faces are added or removed.
+        """
+        return None
+
+    def is_stale(self) -> bool:
+        """Return True if the registry's storage was changed by someone else
+        since it was opened or last checked.
+        """
+        return False
+
+    @contextmanager
+    def transaction(self) -> Iterator[Registry]:
+        """Defer commits to the end of the context. Rolls back if the context raises."""
+        yield self
+
+    def add_many(
+        self,
+        faces: Iterable[Tuple[FacePatch, Identity, Optional[Tuple[str, FaceEncoding]]]],
+    ) -> None:
+        """Store many faces and their identities, and optionally their encodings.
+        Commits once. Stores none of the faces if one of them is rejected.
+        """
+        with self.transaction():
+            for face_patch, identity, encoding in faces:
+                self.add(face_patch, identity, encoding=encoding)
+
     @abstractmethod
     def __iter__(self) -> Iterator[Tuple[FacePatch, Identity]]:
         """Iterate over face patches and their identities."""
 
+    def entries(
+        self,
+    ) -> Iterator[Tuple[FacePatch, Identity, Optional[Tuple[str, FaceEncoding]]]]:
+        """Iterate over face patches, their identities, and their stored encodings.
+        Encodings are given as (encoder version, encoding)-tuples, or None if not stored.
+        """
+        return ((face_patch, identity, None) for face_patch, identity in self)
+
+    def identities(self) -> Iterator[Identity]:
+        """Iterate over the identity of each face.
+        Registries that store patches separately don't have to load them.
+        """
+        return (identity for _, identity in self)
+
+    def counts(self) -> Dict[Identity, int]:
+        """Return the number of faces per identity."""
+        return dict(Counter(self.identities()))
+
+    def encodings(
+        self,
+        encoder: Encoder,
+        batch_size: int = 256,
+        progress: Optional[Progress] = None,
+    ) -> Iterator[Tuple[FaceEncoding, Identity]]:
+        """Iterate over face encodings and their identities.
+        Faces are encoded in batches of *batch_size*, so that only a batch of patches is in memory.
+        Registries that store encodings only have to encode missing or stale faces.
+        Reports the encoded faces to *progress* after each batch.
+        """
+        num_total = len(self) if isinstance(self, Sized) else None
+        num_encoded, start = 0, time.perf_counter()
+        for batch in chunked(self, batch_size):
+            patches, identities = zip(*batch)
+            yield from zip(encoder.many(torch.stack(patches)), identities)
+            num_encoded += len(batch)
+            if progress is not None:
+                progress(num_encoded, num_total, time.perf_counter() - start)
+
 
 class Annotate(ABC):
     """Annotate an image with bounding boxes and additional information."""
@@ -114,9 +298,24 @@ class Builder(ABC):
 
     def reload(self) -> Builder:
         """Reload the builder's persistent parts from disc."""
-        del self.identifier
+        self.__dict__.pop("identifier", None)
         return self
 
+    def add(self, face_patch: FacePatch, identity: Identity) -> None:
+        """Add a face to the registry. Updates the identifier in place if it was built."""
+        encoding = self.encoder(face_patch).detach()
+        stored = self.registry.add(
+            face_patch, identity, encoding=(self.encoder.version, encoding)
+        )
+        if stored and "identifier" in self.__dict__:
+            self.identifier.add(encoding, identity)
+
+    def remove(self, identity: Identity) -> None:
+        """Remove an identity from the registry. Updates the identifier in place if it was built."""
+        self.registry.remove(identity)
+        if "identifier" in self.__dict__:
+            self.identifier.remove(identity)
+
     @cached_property
     @abstractmethod
     def encoder(self) -> Encoder:
@@ -1,16 +1,43 @@
-from dataclasses import dataclass
-from functools import cached_property
+import logging
+from dataclasses import dataclass, field, replace
+from functools import cached_property, partial
 from pathlib import Path
-from typing import Tuple
+from typing import Callable, Optional, Tuple, Type
 
 import torch
 
-from faces import Annotate, Builder, Detector, Encoder, Identifier, Identity, Registry
+from faces import (
+    Annotate,
+    Builder,
+    Detector,
+    Encoder,
+    Identifier,
+    Identity,
+    Index,
+    Registry,
+)
 from faces.detector import MTCNNDetector
 from faces.drawing import PILAnnotate
-from faces.encoder import ResnetEncoder
-from faces.identifier import ConstrainedNearestNeighbourClassifier
-from faces.registry import PickleRegistry
+from faces.encoder import CachedEncoder, ResnetEncoder
+from faces.identifier import (
+    ConstrainedNearestNeighbourClassifier,
+    KNearestNeighbourClassifier,
+)
+from faces.index import (
+    BruteForceIndex,
+    CosineIndex,
+    Int8Index,
+    IVFIndex,
+    PQIndex,
+    PrototypeIndex,
+    ShardedIndex,
+)
+from faces.registry import open_registry
+
+
+def log_progress(num_done: int, num_total: Optional[int], seconds: float) -> None:
+    """Log the progress of encoding the registry."""
+    logging.info(f"encoded {num_done} of {num_total or '?'} faces in {seconds:.1f}s")
 
 
 # pylint: disable=too-many-instance-attributes
@@ -22,6 +49,10 @@ class DefaultBuilder(Builder):
 
     registry_path: Path
 
+    # registry storage, either "pickle", "journal", or "sqlite".
+    # Inferred from the registry path's extension, or from its journal, if None.
+    registry_backend: Optional[str] = None
+
     probability_threshold: float = 0.9
 
     distance_threshold: float = 1.0
@@ -34,24 +65,192 @@ class DefaultBuilder(Builder):
 
     factor: float = 0.709
 
+    # nearest neighbour search, either "exact", "cosine", "ivf" (approximate),
+    # "int8" or "pq" (quantized), or "prototype" (per identity).
+    index: str = "exact"
+
+    # dtype of the "cosine" index's references, "float32", "float16", or "bfloat16".
+    precision: str = "float32"
+
+    # number of clusters of the "ivf" index.
+    num_lists: int = 64
+
+    # number of clusters the "ivf" index searches per query.
+    num_probes: int = 8
+
+    # number of bytes per reference of the "pq" index.
+    num_subspaces: int = 64
+
+    # number of references the "int8" and "pq" indices re-rank with their exact encodings.
+    num_candidates: int = 16
+
+    # number of prototypes per identity of the "prototype" index, their mean if one.
+    num_prototypes: int = 1
+
+    # the "prototype" index compares queries to every face if their distance
+    # to the nearest prototype is within this margin of the distance threshold.
+    prototype_margin: float = 0.1
+
+    # number of nearest faces that vote for the identity, the nearest face decides if one.
+    num_neighbours: int = 1
+
+    # votes are weighted by the inverse of their distance if True.
+    weighted_vote: bool = False
+
+    # number of worker processes that search a shard of the faces each, with the
+    # selected index. Searched in this process if one.
+    num_shards: int = 1
+
+    # number of encodings of recently seen face patches kept in memory. Not kept if zero.
+    encoding_cache_size: int = 1024
+
+    # database of the encodings of all face patches seen. Not stored if None.
+    encoding_cache_path: Optional[Path] = None
+
+    # number of equally sized images searched for faces at once.
+    detection_batch_size: int = 16
+
+    # number of faces encoded at once when fitting the identifier.
+    batch_size: int = 256
+
+    # directory of the fitted identifier, which is loaded instead of refitted
+    # as long as the registry doesn't change. Not stored if None.
+    snapshot_path: Optional[Path] = None
+
+    # opened registry, reopened when someone else changes its files
+    _registry: Optional[Registry] = field(default=None, init=False, repr=False)
+
     @cached_property
     def annotate(self) -> Annotate:
         return PILAnnotate()
 
     @cached_property
     def identifier(self) -> Identifier:
-        return ConstrainedNearestNeighbourClassifier.fit(
-            samples=self.registry,
+        identifier = self._fit_or_load()
+        if isinstance(identifier, KNearestNeighbourClassifier):
+            return replace(
+                identifier,
+                num_neighbours=self.num_neighbours,
+                weighted=self.weighted_vote,
+            )
+        return identifier
+
+    @property
+    def identifier_class(self) -> Type[ConstrainedNearestNeighbourClassifier]:
+        """Return the class of the identifier, which votes if there are several neighbours."""
+        if self.num_neighbours > 1:
+            return KNearestNeighbourClassifier
+        return ConstrainedNearestNeighbourClassifier
+
+    def _fit_or_load(self) -> Identifier:
+        """Return the identifier saved at *snapshot_path*, or fit one to the registry."""
+        registry = self.registry
+        fingerprint = registry.fingerprint()
+        if self.snapshot_path is None or fingerprint is None:
+            return self.identifier_class.fit(
+                samples=registry,
+                distance_threshold=self.distance_threshold,
+                restklasse=self.restklasse,
+                encoder=self.encoder,
+                index=self.index_factory,
+                batch_size=self.batch_size,
+                progress=log_progress,
+            )
+
+        # NOTE: the restklasse is not among the references
+        fingerprint = f"{fingerprint}:{self.restklasse}"
+        try:
+            return self._load_snapshot(fingerprint)
+        except (OSError, ValueError, KeyError) as error:
+            logging.info(f"refitting the identifier: {error}")
+        identifier = ConstrainedNearestNeighbourClassifier.fit(
+            samples=registry,
             distance_threshold=self.distance_threshold,
             restklasse=self.restklasse,
             encoder=self.encoder,
+            batch_size=self.batch_size,
+            progress=log_progress,
+        )
+        assert isinstance(identifier, ConstrainedNearestNeighbourClassifier)
+        try:
+            identifier.save(self.snapshot_path, fingerprint=fingerprint)
+            # NOTE: the index is built once, on memory-mapped encodings
+            return self._load_snapshot(fingerprint)
+        except (OSError, ValueError, KeyError) as error:
+            logging.warning(f"using an unsaved identifier: {error}")
+        return self.identifier_class(
+            encoder=identifier.encoder,
+            distance_threshold=identifier.distance_threshold,
+            restklasse=identifier.restklasse,
+            index2identity=identifier.index2identity,
+            classifier=self.index_factory(
+                identifier.classifier.encodings, identifier.classifier.targets
+            ),
+        )
+
+    def _load_snapshot(self, fingerprint: str) -> Identifier:
+        """Return the identifier saved at *snapshot_path* if it matches *fingerprint*."""
+        assert self.snapshot_path is not None
+        return self.identifier_class.load(
+            self.snapshot_path,
+            encoder=self.encoder,
+            fingerprint=fingerprint,
+            distance_threshold=self.distance_threshold,
+            index=self.index_factory,
+            device=self.device,
         )
 
+    @property
+    def index_factory(self) -> Callable[[torch.Tensor, torch.Tensor], Index]:
+        """Return a function that builds an Index from encodings and targets."""
+        if self.num_shards > 1:
+            return partial(
+                ShardedIndex, num_shards=self.num_shards, index=self.shard_factory
+            )
+        return self.shard_factory
+
+    @property
+    def shard_factory(self) -> Callable[[torch.Tensor, torch.Tensor], Index]:
+        """Return a function that builds the Index of a single process."""
+        if self.index == "exact":
+            return BruteForceIndex
+        if self.index == "cosine":
+            if self.precision not in ("float32", "float16", "bfloat16"):
+                raise ValueError(f"unknown precision: {self.precision}")
+            return partial(CosineIndex, dtype=getattr(torch, self.precision))
+        if self.index == "ivf":
+            return partial(
+                IVFIndex, num_lists=self.num_lists, num_probes=self.num_probes
+            )
+        if self.index == "int8":
+            return partial(Int8Index, num_candidates=self.num_candidates)
+        if self.index == "pq":
+            return partial(
+                PQIndex,
+                num_subspaces=self.num_subspaces,
+                num_candidates=self.num_candidates,
+            )
+        if self.index == "prototype":
+            return partial(
+                PrototypeIndex,
+                num_prototypes=self.num_prototypes,
+                threshold=self.distance_threshold,
+                margin=self.prototype_margin,
+            )
+        raise ValueError(f"unknown index: {self.index}")
+
     @cached_property
     def encoder(self) -> Encoder:
-        return ResnetEncoder(
+        encoder = ResnetEncoder(
             device=self.device,
         )
+        if self.encoding_cache_size > 0 or self.encoding_cache_path is not None:
+            return CachedEncoder(
+                encoder,
+                capacity=self.encoding_cache_size,
+                path=self.encoding_cache_path,
+            )
+        return encoder
 
     @cached_property
     def detector(self) -> Detector:
@@ -61,23 +260,55 @@ class DefaultBuilder(Builder):
             min_face_size=self.min_face_size,
             thresholds=self.thresholds,
             factor=self.factor,
+            batch_size=self.detection_batch_size,
         )
 
     @property
     def registry(self) -> Registry:
-        return PickleRegistry.open(self.registry_path, self.device)
+        if self._registry is None or self._registry.is_stale():
+            if self._registry is not None:
+                # refit to include changes made by someone else
+                self.__dict__.pop("identifier", None)
+            self._registry = open_registry(
+                self.registry_path, self.device, self.registry_backend
+            )
+        return self._registry
+
+    def reload(self) -> Builder:
+        self._registry = None
+        return super().reload()
 
     @classmethod
     def from_args(cls, args) -> Builder:
         device = args.device
         if not device:
             device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        snapshot_path = args.snapshot_path or args.registry_path.with_name(
+            args.registry_path.name + ".snapshot"
+        )
 
         return cls(
             device=torch.device(device),
             registry_path=args.registry_path,
+            registry_backend=args.registry_backend,
             probability_threshold=args.probability_threshold,
             distance_threshold=args.distance_threshold,
+            index=args.index,
+            precision=args.precision,
+            num_lists=args.num_lists,
+            num_probes=args.num_probes,
+            num_subspaces=args.num_subspaces,
+            num_candidates=args.num_candidates,
+            num_prototypes=args.num_prototypes,
+            prototype_margin=args.prototype_margin,
+            num_neighbours=args.num_neighbours,
+            weighted_vote=args.weighted_vote,
+            num_shards=args.num_shards,
+            detection_batch_size=args.detection_batch_size,
+            encoding_cache_size=args.encoding_cache_size,
+            encoding_cache_path=args.encoding_cache_path,
+            batch_size=args.batch_size,
+            snapshot_path=None if args.no_snapshot else snapshot_path,
         )
 
     @classmethod
@@ -1,10 +1,36 @@
-from typing import Iterable, Iterator, Tuple
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
 import numpy as np
 import torch
 from facenet_pytorch import MTCNN
+from PIL import Image as PILImage
 
-from faces import BoundingBox, Detector, FacePatch, FaceProbability, Image
+from faces import BoundingBox, Detections, Detector, FacePatch, Image
+from faces.utils import chunked
+
+
+def _crop(image: PILImage.Image, boxes: np.ndarray, size: int) -> torch.Tensor:
+    """Return the standardized (N, 3, *size*, *size*) patches of the (N, 4) *boxes*.
+    Like `facenet_pytorch.extract_face`, but converts all patches at once.
+    """
+    # NOTE: cropped and resized by PIL, as before, so that the patches don't change
+    width, height = image.size
+    corners = np.floor(
+        np.concatenate(
+            [np.maximum(boxes[:, :2], 0), np.minimum(boxes[:, 2:], (width, height))],
+            axis=1,
+        )
+    ).astype(int)
+    if len(corners) == 0:
+        return torch.empty((0, 3, size, size))
+    faces = np.stack(
+        [
+            np.asarray(image.crop(tuple(box)).resize((size, size), PILImage.BILINEAR))
+            for box in corners.tolist()
+        ]
+    )
+    return (torch.from_numpy(faces).permute(0, 3, 1, 2).float() - 127.5) / 128.0
 
 
 class MTCNNDetector(Detector):
@@ -16,6 +42,8 @@ class MTCNNDetector(Detector):
 
     device: torch.device
 
+    batch_size: int
+
     def __init__(
         self,
         # torch device.
@@ -30,9 +58,13 @@ class MTCNNDetector(Detector):
         factor: float = 0.709,
         # size of the extracted patch.
         patch_size: int = 160,
+        # maximum number of equally sized images detected at once.
+        batch_size: int = 16,
     ):
         self.device = device
         self.probability_threshold = probability_threshold
+        self.batch_size = batch_size
+        self.patch_size = patch_size
         # initialize the face detection network
         self.model = MTCNN(
             min_face_size=min_face_size,
@@ -43,16 +75,63 @@ class MTCNNDetector(Detector):
             image_size=patch_size,
         )
 
-    def detect(self, image: Image) -> Iterable[Tuple[BoundingBox, FaceProbability]]:
-        boxes, probs = self.model.detect(image.image)
+    def _filter(
+        self,
+        boxes: Optional[np.ndarray],
+        probs: np.ndarray,
+        landmarks: Optional[np.ndarray],
+    ) -> Detections:
+        """Return the *boxes* whose probability exceeds the threshold."""
         if boxes is None:  # no boxes to return
-            return
-        for box, prob in zip(boxes, probs):
-            if prob >= self.probability_threshold:
-                yield BoundingBox(*box), prob
+            return Detections.empty()
+        return Detections(boxes, probs, landmarks).filter(self.probability_threshold)
+
+    def detect(self, image: Image) -> Detections:
+        return self._filter(*self.model.detect(image.image, landmarks=True))
 
     def extract(self, image: Image) -> Iterator[Tuple[BoundingBox, FacePatch]]:
-        for box, _ in self.detect(image):
-            yield box, self.model.extract(
-                image.image, np.array(box.as_tuple).reshape(1, -1), None
-            ).squeeze(0).to(self.device)
+        detections = self.extract_batch(image)
+        for (box, _), patch in zip(detections, detections.patches):
+            yield box, patch
+
+    def extract_batch(self, image: Image) -> Detections:
+        detections = self.detect(image)
+        return detections.with_patches(self._patches(image, detections.boxes))
+
+    def _patches(self, image: Image, boxes: np.ndarray) -> torch.Tensor:
+        """Return the faces within the (N, 4) *boxes* of *image*."""
+        return _crop(image.image, boxes, self.patch_size).to(self.device)
+
+    def detect_many(self, images: Sequence[Image]) -> List[Detections]:
+        """Return the bounding boxes and likelihoods of there being a face, per image.
+        Images of equal size are detected together, up to *batch_size* at once.
+        """
+        # NOTE: bucketed rather than padded, padding changes the image pyramid
+        buckets: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        for index, image in enumerate(images):
+            buckets[image.image.size].append(index)
+        detections = [Detections.empty() for _ in images]
+        for bucket in buckets.values():
+            for batch in chunked(bucket, self.batch_size):
+                batch_detections = self.model.detect(
+                    [images[index].image for index in batch], landmarks=True
+                )
+                for index, image_detections in zip(batch, zip(*batch_detections)):
+                    detections[index] = self._filter(*image_detections)
+        return detections
+
+    def extract_many(
+        self, images: Sequence[Image]
+    ) -> List[List[Tuple[BoundingBox, FacePatch]]]:
+        """Return the bounding boxes and faces detected in each of the *images*.
+        Detects like `detect_many`.
+        """
+        return [
+            [
+                (box, patch)
+                for (box, _), patch in zip(
+                    detections, self._patches(image, detections.boxes)
+                )
+            ]
+            for image, detections in zip(images, self.detect_many(images))
+        ]
@@ -1,7 +1,14 @@
+import sqlite3
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
 import torch
 from facenet_pytorch import InceptionResnetV1
 
 from faces import Encoder, FaceEncoding, FacePatch
+from faces.utils import digest, from_blob, to_blob
 
 
 class ResnetEncoder(Encoder):
@@ -9,11 +16,16 @@ class ResnetEncoder(Encoder):
 
     model: InceptionResnetV1
 
+    pretrained: str
+
     def __init__(
         self,
         device: torch.device,
+        # pretrained weights, either "vggface2" or "casia-webface".
+        pretrained: str = "vggface2",
     ):
-        self.model = InceptionResnetV1("vggface2", device=device).eval()
+        self.pretrained = pretrained
+        self.model = InceptionResnetV1(pretrained, device=device).eval()
 
     def __call__(self, face_patch: FacePatch) -> FaceEncoding:
         # pylint: disable=not-callable
@@ -22,3 +34,115 @@ class ResnetEncoder(Encoder):
     def many(self, patches: torch.Tensor) -> torch.Tensor:
         # pylint: disable=not-callable
         return self.model(patches)
+
+    @property
+    def version(self) -> str:
+        return f"InceptionResnetV1:{self.pretrained}"
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class CachedEncoder(Encoder):
+    """Remember the encodings of recently encoded face patches.
+    Patches are identified by their digest and the encoder's version, so that
+    repeated patches skip the *encoder* entirely. Keeps the *capacity* most
+    recently used encodings in memory, and all encodings in a SQLite database
+    at *path* if given, so that they outlive the process.
+    """
+
+    encoder: Encoder
+
+    # number of encodings kept in memory.
+    capacity: int = 1024
+
+    # database of all encodings. Not stored if None.
+    path: Optional[Path] = None
+
+    # number of patches whose encoding was remembered, and of encoded patches
+    hits: int = field(default=0, init=False)
+
+    misses: int = field(default=0, init=False)
+
+    _memory: "OrderedDict[str, FaceEncoding]" = field(
+        default_factory=OrderedDict, init=False, repr=False
+    )
+
+    _connection: Optional[sqlite3.Connection] = field(
+        default=None, init=False, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        if self.path is not None:
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute("PRAGMA journal_mode = WAL")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS encodings (
+                    key TEXT PRIMARY KEY,
+                    encoding BLOB NOT NULL
+                )
+                """)
+
+    def __call__(self, face_patch: FacePatch) -> FaceEncoding:
+        return self.many(face_patch.unsqueeze(0)).squeeze(0)
+
+    def many(self, patches: torch.Tensor) -> torch.Tensor:
+        if len(patches) == 0:
+            return self.encoder.many(patches)
+        version = self.encoder.version
+        # NOTE: a single transfer rather than one per patch
+        keys = [f"{version}:{digest(patch)}" for patch in patches.detach().cpu()]
+        found: Dict[str, FaceEncoding] = {}
+        for key in keys:
+            if key not in found and (encoding := self._lookup(key)) is not None:
+                found[key] = encoding
+        # NOTE: identical patches within the batch are encoded once
+        missing = list(dict.fromkeys(key for key in keys if key not in found))
+        if missing:
+            position = {key: index for index, key in enumerate(keys)}
+            encodings = self.encoder.many(
+                patches[[position[key] for key in missing]]
+            ).detach()
+            for key, encoding in zip(missing, encodings):
+                found[key] = encoding
+                self._remember(key, encoding)
+            self._store(missing, encodings)
+        self.misses += len(missing)
+        self.hits += len(keys) - len(missing)
+        return torch.stack([found[key].to(patches.device) for key in keys])
+
+    def _lookup(self, key: str) -> Optional[FaceEncoding]:
+        """Return the remembered encoding of *key*, or None."""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if self._connection is None:
+            return None
+        row = self._connection.execute(
+            "SELECT encoding FROM encodings WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        encoding = from_blob(row[0], torch.device("cpu"))
+        self._remember(key, encoding)
+        return encoding
+
+    def _remember(self, key: str, encoding: FaceEncoding) -> None:
+        """Keep *encoding* in memory, and forget the least recently used if full."""
+        self._memory[key] = encoding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+
+    def _store(self, keys: List[str], encodings: torch.Tensor) -> None:
+        """Write *encodings* to the database, if any, in a single transaction."""
+        if self._connection is None:
+            return
+        with self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO encodings (key, encoding) VALUES (?, ?)",
+                [(key, to_blob(encoding)) for key, encoding in zip(keys, encodings)],
+            )
+
+    @property
+    def version(self) -> str:
+        return self.encoder.version
@@ -1,46 +1,35 @@
 from __future__ import annotations
 
-from collections.abc import Iterable, Mapping
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections.abc import Callable, Iterable, Iterator, Sized
 from dataclasses import dataclass
-from typing import Tuple
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
+import numpy as np
 import torch
 
-from faces import Encoder, FaceEncoding, FacePatch, Identifier, Identity
+from faces import (
+    Encoder,
+    FaceEncoding,
+    FacePatch,
+    Identifier,
+    Identity,
+    Index,
+    Progress,
+    Registry,
+)
+from faces.index import BruteForceIndex
+from faces.utils import append, chunked
 
-
-@dataclass(frozen=True)
-class _NearestNeighbour:
-    """Nearest neighbour classifier."""
-
-    encodings: torch.Tensor
-
-    targets: torch.Tensor
-
-    def __post_init__(self) -> None:
-        assert len(self.encodings) == len(self.targets)
-
-    def __call__(self, encoding: FaceEncoding) -> Tuple[int, float]:
-        """Return the nearest neighbour and its distance to *encoding*."""
-        # pairwise distances
-        dist = torch.cdist(encoding.unsqueeze(0), self.encodings).squeeze(0)
-        # index of lowest distance
-        min_distance, min_index = torch.min(dist, 0)
-        # return identity and distance
-        return int(self.targets[min_index].item()), min_distance.item()
-
-    @classmethod
-    def empty(cls) -> _NearestNeighbour:
-        """Return a nearest neighbour classifier without references."""
-        return cls(
-            encodings=torch.empty((0,)),
-            targets=torch.empty((0,)),
-        )
-
-    @property
-    def is_empty(self) -> bool:
-        """Return True if the classifier has no references."""
-        return len(self.encodings) == 0
+# files of a saved identifier
+SNAPSHOT_ENCODINGS = "encodings.npy"
+SNAPSHOT_TARGETS = "targets.npy"
+SNAPSHOT_METADATA = "identifier.json"
 
 
 @dataclass(frozen=True)
@@ -58,9 +47,9 @@ class ConstrainedNearestNeighbourClassifier(Identifier):
 
     restklasse: Identity
 
-    index2identity: Mapping[int, Identity]
+    index2identity: Dict[int, Identity]
 
-    classifier: _NearestNeighbour
+    classifier: Index
 
     @classmethod
     def fit(
@@ -70,33 +59,85 @@ class ConstrainedNearestNeighbourClassifier(Identifier):
         encoder: Encoder,
         distance_threshold: float = 1.0,
         restklasse: Identity = Identity("Anonymous"),
+        index: Callable[[torch.Tensor, torch.Tensor], Index] = BruteForceIndex,
+        batch_size: int = 256,
+        progress: Optional[Progress] = None,
     ) -> Identifier:
-        """Return an identifier that is fitted to *samples*."""
-        # filter
-        valid_samples = (
-            (patch, label) for patch, label in samples if label != restklasse
-        )
-        try:
-            # unpack
-            patches, labels = zip(*valid_samples)
-        except ValueError:
-            # valid_samples was empty
+        """Return an identifier that is fitted to *samples*.
+        Encodes *batch_size* samples at a time, so that only their patches are in memory,
+        and reports the encoded samples to *progress* after each batch.
+        Reuses stored encodings if *samples* is a `Registry`.
+        """
+        num_samples = len(samples) if isinstance(samples, Sized) else None
+        # NOTE: no gradients are needed, and their buffers would grow with the samples
+        with torch.no_grad():
+            encodings: Iterable[Tuple[FaceEncoding, Identity]]
+            if isinstance(samples, Registry):
+                encodings = samples.encodings(
+                    encoder, batch_size=batch_size, progress=progress
+                )
+            else:
+                encodings = _encode(
+                    ((patch, label) for patch, label in samples if label != restklasse),
+                    encoder,
+                    batch_size,
+                    progress,
+                    num_samples,
+                )
+
+            return cls.from_encodings(
+                encodings,
+                encoder=encoder,
+                distance_threshold=distance_threshold,
+                restklasse=restklasse,
+                index=index,
+                num_samples=num_samples,
+            )
+
+    @classmethod
+    def from_encodings(
+        cls,
+        samples: Iterable[Tuple[FaceEncoding, Identity]],
+        *,
+        encoder: Encoder,
+        distance_threshold: float = 1.0,
+        restklasse: Identity = Identity("Anonymous"),
+        index: Callable[[torch.Tensor, torch.Tensor], Index] = BruteForceIndex,
+        num_samples: Optional[int] = None,
+    ) -> Identifier:
+        """Return an identifier that is fitted to encoded *samples*.
+        The references are searched with an *index* built from encodings and targets.
+        The encodings are collected in a matrix that is allocated for *num_samples*
+        samples if given, and grows as needed.
+        """
+        buffer: Optional[torch.Tensor] = None
+        labels: List[Identity] = []
+        for encoding, label in samples:
+            if label == restklasse:
+                continue
+            if buffer is None:
+                buffer = encoding.new_empty((num_samples or 1, *encoding.shape))
+            buffer = append(buffer, len(labels), encoding.detach())
+            labels.append(label)
+
+        if buffer is None:
+            # samples was empty
             return cls(
                 encoder=encoder,
                 distance_threshold=distance_threshold,
                 restklasse=restklasse,
                 index2identity={},
-                classifier=_NearestNeighbour.empty(),
+                classifier=index(torch.empty((0,)), torch.empty((0,))),
             )
 
         # index/identity mappings
         index2identity = dict(enumerate(set(labels)))
         identity2index = {identity: index for index, identity in index2identity.items()}
         # classifier
-        classifier = _NearestNeighbour(
-            encodings=encoder.many(torch.stack(patches)),
+        classifier = index(
+            buffer[: len(labels)],
             # NOTE: targets can be on the cpu no matter the encodings
-            targets=torch.tensor(
+            torch.tensor(
                 [identity2index[label] for label in labels], device=torch.device("cpu")
             ),
         )
@@ -108,6 +149,107 @@ class ConstrainedNearestNeighbourClassifier(Identifier):
             classifier=classifier,
         )
 
+    def save(self, path: Path, fingerprint: str = "") -> None:
+        """Write the identifier to the directory *path*, replacing its content.
+        The encodings and targets are stored as .npy files, everything else as json.
+        The *fingerprint* identifies the samples the identifier was fitted to.
+        Raises a ValueError if the index doesn't keep the encodings of its references.
+        """
+        encodings, targets = self.classifier.references()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # NOTE: unique, so that processes which save at the same time don't collide
+        temporary = Path(tempfile.mkdtemp(prefix=path.name + ".", dir=path.parent))
+        try:
+            self._write(temporary, encodings, targets, fingerprint)
+            # NOTE: processes that mapped the old files keep reading them
+            shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.replace(temporary, path)
+            except OSError:
+                if not (path / SNAPSHOT_METADATA).exists():
+                    raise
+                # another process saved the identifier in the meantime
+        finally:
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    def _write(
+        self,
+        temporary: Path,
+        encodings: torch.Tensor,
+        targets: torch.Tensor,
+        fingerprint: str,
+    ) -> None:
+        """Write the identifier's files, with the references' *encodings* and
+        *targets*, to the directory *temporary*.
+        """
+        np.save(
+            temporary / SNAPSHOT_ENCODINGS,
+            encodings.detach().cpu().to(torch.float32).numpy(),
+        )
+        np.save(temporary / SNAPSHOT_TARGETS, targets.cpu().to(torch.int64).numpy())
+        with open(temporary / SNAPSHOT_METADATA, "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "encoder": self.encoder.version,
+                    "fingerprint": fingerprint,
+                    "distance_threshold": self.distance_threshold,
+                    "restklasse": self.restklasse,
+                    "identities": {
+                        str(index): identity
+                        for index, identity in self.index2identity.items()
+                    },
+                },
+                file,
+            )
+
+    @classmethod
+    def load(
+        cls,
+        path: Path,
+        *,
+        encoder: Encoder,
+        fingerprint: Optional[str] = None,
+        distance_threshold: Optional[float] = None,
+        index: Callable[[torch.Tensor, torch.Tensor], Index] = BruteForceIndex,
+        device: torch.device = torch.device("cpu"),
+    ) -> Identifier:
+        """Return the identifier saved to *path*.
+        Raises a ValueError if it was saved with another encoder, or with another
+        *fingerprint* if one is given. Uses the saved distance threshold unless
+        *distance_threshold* is given.
+        The encodings are memory-mapped on the cpu, so that processes which
+        load the same identifier share the memory, and nothing has to be parsed.
+        Other devices receive a copy.
+        """
+        with open(path / SNAPSHOT_METADATA, encoding="utf-8") as file:
+            metadata = json.load(file)
+        if metadata["encoder"] != encoder.version:
+            raise ValueError(f"saved with encoder {metadata['encoder']}")
+        if fingerprint is not None and metadata["fingerprint"] != fingerprint:
+            raise ValueError("saved with other samples")
+        targets = torch.from_numpy(np.load(path / SNAPSHOT_TARGETS))
+        if len(targets) == 0:
+            encodings, targets = torch.empty((0,)), torch.empty((0,))
+        else:
+            # NOTE: copy-on-write, the index might modify the encodings
+            encodings = torch.from_numpy(
+                np.load(path / SNAPSHOT_ENCODINGS, mmap_mode="c")
+            ).to(device)
+        return cls(
+            encoder=encoder,
+            distance_threshold=(
+                metadata["distance_threshold"]
+                if distance_threshold is None
+                else distance_threshold
+            ),
+            restklasse=metadata["restklasse"],
+            index2identity={
+                int(index): identity
+                for index, identity in metadata["identities"].items()
+            },
+            classifier=index(encodings, targets),
+        )
+
     def nearest_neighbour(self, face_patch: FacePatch) -> Tuple[Identity, float]:
         """Return the nearest neighbour and its distance."""
         if self.classifier.is_empty:
@@ -115,9 +257,132 @@ class ConstrainedNearestNeighbourClassifier(Identifier):
         identity_index, distance = self.classifier(self.encoder(face_patch))
         return self.index2identity[identity_index], distance
 
+    def add(self, face: torch.Tensor, identity: Identity) -> None:
+        """Add a reference *face*, given as face patch or encoding.
+        Only face patches need to be encoded.
+        """
+        if identity == self.restklasse:
+            return
+        if face.dim() != 1:  # face patch
+            face = self.encoder(face)
+        for index, known in self.index2identity.items():
+            if known == identity:
+                break
+        else:
+            index = max(self.index2identity, default=-1) + 1
+            self.index2identity[index] = identity
+        self.classifier.add(face, index)
+
+    def remove(self, identity: Identity) -> None:
+        for index, known in list(self.index2identity.items()):
+            if known == identity:
+                self.classifier.remove(index)
+                del self.index2identity[index]
+
     def __call__(self, face_patch: FacePatch) -> Identity:
         """Return the nearest neighbour's identity."""
         identity, dist = self.nearest_neighbour(face_patch)
         if dist > self.distance_threshold:
             return self.restklasse
         return identity
+
+    def many(self, patches: torch.Tensor) -> List[Tuple[Identity, float]]:
+        """Return the nearest neighbours' identities and distances.
+        Encodes all *patches* in a single batch.
+        """
+        if self.classifier.is_empty:
+            return [(self.restklasse, float("inf"))] * len(patches)
+        if len(patches) == 0:
+            return []
+        targets, distances = self.classifier.many(self.encoder.many(patches))
+        known = distances <= self.distance_threshold
+        return [
+            (self.index2identity[target] if is_known else self.restklasse, distance)
+            for target, distance, is_known in zip(
+                targets.tolist(), distances.tolist(), known.tolist()
+            )
+        ]
+
+    def topk(self, faces: torch.Tensor, k: int) -> List[List[Tuple[Identity, float]]]:
+        """Return the identities and distances of the *k* nearest references
+        to N *faces*, given as face patches or encodings, nearest first.
+        The references are not thresholded and may share their identities.
+        """
+        if self.classifier.is_empty or len(faces) == 0:
+            return [[] for _ in faces]
+        if faces.dim() != 2:  # face patches
+            faces = self.encoder.many(faces)
+        targets, distances = self.classifier.topk(faces, k)
+        return [
+            [
+                (self.index2identity[target], distance)
+                for target, distance in zip(row_targets, row_distances)
+                if target >= 0
+            ]
+            for row_targets, row_distances in zip(targets.tolist(), distances.tolist())
+        ]
+
+
+@dataclass(frozen=True)
+class KNearestNeighbourClassifier(ConstrainedNearestNeighbourClassifier):
+    """Open-world k-nearest neighbour classifier.
+    The *num_neighbours* nearest references within the distance threshold
+    vote for their identity, with weight one, or with the inverse of their
+    distance if *weighted*. Faces without votes are of the restklasse.
+    """
+
+    num_neighbours: int = 5
+
+    weighted: bool = False
+
+    def __call__(self, face_patch: FacePatch) -> Identity:
+        return self.many(face_patch.unsqueeze(0))[0][0]
+
+    def many(self, patches: torch.Tensor) -> List[Tuple[Identity, float]]:
+        """Return the elected identities, and the distances of their nearest references.
+        Votes for all *patches* in a single batch.
+        """
+        if self.classifier.is_empty:
+            return [(self.restklasse, float("inf"))] * len(patches)
+        if len(patches) == 0:
+            return []
+        targets, distances = self.classifier.topk(
+            self.encoder.many(patches), self.num_neighbours
+        )
+        eligible = (targets >= 0) & (distances <= self.distance_threshold)
+        weights = (
+            1 / distances.clamp(min=1e-6)
+            if self.weighted
+            else torch.ones_like(distances)
+        )
+        # NOTE: padded targets are -1, they vote with weight zero for target zero
+        votes = torch.zeros((len(targets), max(self.index2identity) + 1)).scatter_add_(
+            1, targets.clamp(min=0), torch.where(eligible, weights, 0)
+        )
+        elected, known = votes.argmax(1), eligible.any(1)
+        # nearest reference of the elected identity, or of any if there is none
+        nearest = torch.where(targets == elected.unsqueeze(1), distances, float("inf"))
+        distance = torch.where(known, nearest.amin(1), distances[:, 0])
+        return [
+            (self.index2identity[target] if is_known else self.restklasse, distance)
+            for target, distance, is_known in zip(
+                elected.tolist(), distance.tolist(), known.tolist()
+            )
+        ]
+
+
+def _encode(
+    samples: Iterable[Tuple[FacePatch, Identity]],
+    encoder: Encoder,
+    batch_size: int,
+    progress: Optional[Progress],
+    num_total: Optional[int],
+) -> Iterator[Tuple[FaceEncoding, Identity]]:
+    """Encode *samples* in batches of *batch_size*, and report them to *progress*."""
+    num_encoded, start = 0, time.perf_counter()
+    for batch in chunked(samples, batch_size):
+        patches, labels = zip(*batch)
+        yield from zip(encoder.many(torch.stack(patches)), labels)
+        num_encoded += len(batch)
+        if progress is not None:
+            progress(num_encoded, num_total, time.perf_counter() - start)
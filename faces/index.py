@@ -0,0 +1,959 @@
+from __future__ import annotations
+
+import weakref
+from dataclasses import dataclass, field
+from multiprocessing.connection import Connection
+from typing import Any, Callable, List, Optional, Tuple
+
+import torch
+
+from faces import FaceEncoding, Index
+from faces.utils import append
+
+# number of references that are dequantized or decoded at once
+_CHUNK_SIZE = 8192
+
+
+def _no_neighbours(num_queries: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Return the targets and distances of *num_queries* queries without neighbours."""
+    return (
+        torch.empty((num_queries, 0), dtype=torch.long),
+        torch.empty((num_queries, 0)),
+    )
+
+
+def _kmeans(
+    points: torch.Tensor, num_clusters: int, num_iterations: int
+) -> torch.Tensor:
+    """Return *num_clusters* centroids of *points* found by Lloyd's algorithm."""
+    generator = torch.Generator().manual_seed(0)
+    initial = torch.randperm(len(points), generator=generator)[:num_clusters]
+    centroids = points[initial.to(points.device)].clone()
+    for _ in range(num_iterations):
+        assignments = torch.cdist(points, centroids).argmin(1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, points)
+        counts = torch.bincount(assignments, minlength=len(centroids))
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty].unsqueeze(1)
+    return centroids
+
+
+@dataclass
+class BruteForceIndex(Index):
+    """Exact nearest neighbour search.
+    Compares a query to every reference.
+    References live in buffers that double their capacity when full,
+    *encodings* and *targets* are views of the occupied rows.
+    """
+
+    encodings: torch.Tensor
+
+    targets: torch.Tensor
+
+    _encodings: torch.Tensor = field(init=False, repr=False)
+
+    _targets: torch.Tensor = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        assert len(self.encodings) == len(self.targets)
+        self.encodings = self.encodings.detach()
+        self._encodings = self.encodings
+        self._targets = self.targets
+
+    def add(self, encoding: FaceEncoding, target: int) -> None:
+        size = len(self.targets)
+        self._encodings = append(self._encodings, size, encoding.detach())
+        self._targets = append(self._targets, size, torch.tensor(target))
+        self.encodings = self._encodings[: size + 1]
+        self.targets = self._targets[: size + 1]
+
+    def remove(self, target: int) -> None:
+        keep = self.targets != target
+        if keep.all():
+            return
+        # NOTE: indexing copies, the buffers never alias the constructor's tensors
+        self.encodings = self._encodings = self.encodings[
+            keep.to(self.encodings.device)
+        ]
+        self.targets = self._targets = self.targets[keep]
+
+    def __call__(self, encoding: FaceEncoding) -> Tuple[int, float]:
+        # pairwise distances
+        dist = torch.cdist(encoding.unsqueeze(0), self.encodings).squeeze(0)
+        # index of lowest distance
+        min_distance, min_index = torch.min(dist, 0)
+        # return identity and distance
+        return int(self.targets[min_index].item()), min_distance.item()
+
+    def many(self, encodings: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        # pairwise distances
+        dist = torch.cdist(encodings, self.encodings)
+        # index of lowest distance per query
+        min_distance, min_index = torch.min(dist, 1)
+        return self.targets[min_index.cpu()], min_distance.detach().cpu()
+
+    def topk(
+        self, encodings: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        k = min(k, len(self.targets))
+        if k == 0:
+            return _no_neighbours(len(encodings))
+        distance, index = torch.topk(
+            torch.cdist(encodings, self.encodings), k, dim=1, largest=False
+        )
+        return self.targets[index.cpu()], distance.detach().cpu()
+
+
+@dataclass
+class CosineIndex(BruteForceIndex):
+    """Exact nearest neighbour search on normalized encodings.
+    Ranks references by their inner product with the query, which takes a single
+    matrix multiplication for a batch of queries. For unit vectors, the Euclidean
+    distance d and the similarity s rank alike, since d = sqrt(2 - 2s).
+    The distances are Euclidean, so that thresholds carry over from other indices.
+    References are stored in *dtype*, e.g., torch.bfloat16 halves their memory.
+    """
+
+    # dtype of the references.
+    dtype: torch.dtype = torch.float32
+
+    def __post_init__(self) -> None:
+        if self.encodings.dim() == 2:
+            self.encodings = self._normalize(self.encodings)
+        super().__post_init__()
+
+    def _normalize(self, encodings: torch.Tensor) -> torch.Tensor:
+        """Return unit-length *encodings* in the references' dtype."""
+        return torch.nn.functional.normalize(
+            encodings.detach().to(torch.float32), dim=-1
+        ).to(self.dtype)
+
+    def add(self, encoding: FaceEncoding, target: int) -> None:
+        super().add(self._normalize(encoding), target)
+
+    def __call__(self, encoding: FaceEncoding) -> Tuple[int, float]:
+        return Index.__call__(self, encoding)
+
+    def _operands(self, encodings: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the normalized *encodings* in float32, and the references to multiply them with."""
+        references = self.encodings
+        if references.dtype == torch.float16 and references.device.type == "cpu":
+            # NOTE: there's no float16 matrix multiplication on the cpu
+            references = references.to(torch.float32)
+        queries = torch.nn.functional.normalize(
+            encodings.detach().to(torch.float32), dim=-1
+        )
+        return queries, references
+
+    def many(self, encodings: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        queries, references = self._operands(encodings)
+        similarity = queries.to(references.dtype) @ references.T
+        # index of highest similarity per query
+        max_index = torch.argmax(similarity, 1)
+        # NOTE: low precision similarities are too coarse for sqrt(2 - 2s) near zero
+        distance = torch.linalg.vector_norm(
+            queries - references[max_index].to(torch.float32), dim=1
+        )
+        return self.targets[max_index.cpu()], distance.cpu()
+
+    def topk(
+        self, encodings: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        k = min(k, len(self.targets))
+        if k == 0:
+            return _no_neighbours(len(encodings))
+        queries, references = self._operands(encodings)
+        index = torch.topk(
+            queries.to(references.dtype) @ references.T, k, dim=1
+        ).indices
+        distance = torch.linalg.vector_norm(
+            queries.unsqueeze(1) - references[index].to(torch.float32), dim=2
+        )
+        # NOTE: low precision similarities may rank near ties in the wrong order
+        distance, order = torch.sort(distance, dim=1)
+        return self.targets[index.gather(1, order).cpu()], distance.cpu()
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class IVFIndex(BruteForceIndex):
+    """Approximate nearest neighbour search with an inverted file.
+    Partitions the references into *num_lists* clusters and only compares a query
+    to the references in its *num_probes* nearest clusters.
+    More probes increase the recall, fewer probes increase the speed.
+    Searches exhaustively until there are at least *num_lists* references.
+    """
+
+    # number of clusters.
+    num_lists: int = 64
+
+    # number of clusters to search per query.
+    num_probes: int = 8
+
+    # number of k-means iterations to find the clusters.
+    num_iterations: int = 10
+
+    centroids: Optional[torch.Tensor] = field(init=False, default=None)
+
+    # cluster of each reference
+    assignments: torch.Tensor = field(init=False, repr=False)
+
+    _assignments: torch.Tensor = field(init=False, repr=False)
+
+    # references sorted by cluster, and the clusters' offsets therein
+    _lists: Optional[Tuple[torch.Tensor, torch.Tensor]] = field(
+        init=False, default=None, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        super().__post_init__()
+        self.assignments = self._assignments = torch.empty((0,), dtype=torch.long)
+        if len(self.targets) >= self.num_lists:
+            self._train()
+
+    def _train(self) -> None:
+        """Cluster the references and assign them to the clusters."""
+        self.centroids = _kmeans(self.encodings, self.num_lists, self.num_iterations)
+        self.assignments = self._assignments = (
+            torch.cdist(self.encodings, self.centroids).argmin(1).cpu()
+        )
+        self._lists = None
+
+    @property
+    def lists(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the references sorted by cluster, and the clusters' offsets therein."""
+        if self._lists is None:
+            counts = torch.bincount(self.assignments, minlength=self.num_lists)
+            offsets = torch.zeros((self.num_lists + 1,), dtype=torch.long)
+            offsets[1:] = torch.cumsum(counts, 0)
+            self._lists = torch.argsort(self.assignments), offsets
+        return self._lists
+
+    def add(self, encoding: FaceEncoding, target: int) -> None:
+        size = len(self.targets)
+        super().add(encoding, target)
+        if self.centroids is None:
+            if size + 1 >= self.num_lists:
+                self._train()
+            return
+        assignment = torch.cdist(encoding.unsqueeze(0), self.centroids).argmin()
+        self._assignments = append(self._assignments, size, assignment.cpu())
+        self.assignments = self._assignments[: size + 1]
+        self._lists = None
+
+    def remove(self, target: int) -> None:
+        keep = self.targets != target
+        if keep.all():
+            return
+        super().remove(target)
+        if self.centroids is not None:
+            self.assignments = self._assignments = self.assignments[keep]
+            self._lists = None
+
+    def __call__(self, encoding: FaceEncoding) -> Tuple[int, float]:
+        return Index.__call__(self, encoding)
+
+    def many(self, encodings: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.centroids is None or self.num_probes >= self.num_lists:
+            return super().many(encodings)
+
+        # clusters to search per query
+        probes = (
+            torch.cdist(encodings, self.centroids)
+            .topk(self.num_probes, dim=1, largest=False)
+            .indices.cpu()
+        )
+        order, offsets = self.lists
+        min_distance = torch.full((len(encodings),), float("inf"))
+        min_index = torch.zeros((len(encodings),), dtype=torch.long)
+        # search each probed cluster with all queries that probe it
+        for cluster in probes.unique().tolist():
+            members = order[offsets[cluster] : offsets[cluster + 1]]
+            if len(members) == 0:
+                continue
+            queries = (probes == cluster).any(1).nonzero().squeeze(1)
+            distance, index = torch.min(
+                torch.cdist(
+                    encodings[queries.to(encodings.device)],
+                    self.encodings[members.to(encodings.device)],
+                ),
+                1,
+            )
+            distance = distance.detach().cpu()
+            closer = distance < min_distance[queries]
+            min_distance[queries[closer]] = distance[closer]
+            min_index[queries[closer]] = members[index.cpu()[closer]]
+
+        return self.targets[min_index], min_distance
+
+    def topk(
+        self, encodings: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if self.centroids is None or self.num_probes >= self.num_lists:
+            return super().topk(encodings, k)
+
+        k = min(k, len(self.targets))
+        probes = (
+            torch.cdist(encodings, self.centroids)
+            .topk(self.num_probes, dim=1, largest=False)
+            .indices.cpu()
+        )
+        order, offsets = self.lists
+        best_distance = torch.full((len(encodings), k), float("inf"))
+        best_index = torch.full((len(encodings), k), -1, dtype=torch.long)
+        # merge each probed cluster's references into the best so far
+        for cluster in probes.unique().tolist():
+            members = order[offsets[cluster] : offsets[cluster + 1]]
+            if len(members) == 0:
+                continue
+            queries = (probes == cluster).any(1).nonzero().squeeze(1)
+            distance = torch.cdist(
+                encodings[queries.to(encodings.device)],
+                self.encodings[members.to(encodings.device)],
+            )
+            distance, index = torch.topk(
+                torch.cat([best_distance[queries], distance.detach().cpu()], dim=1),
+                k,
+                dim=1,
+                largest=False,
+            )
+            best_distance[queries] = distance
+            best_index[queries] = torch.cat(
+                [best_index[queries], members.expand(len(queries), -1)], dim=1
+            ).gather(1, index)
+
+        targets = self.targets[best_index.clamp(min=0)]
+        targets[best_index < 0] = -1
+        return targets, best_distance
+
+
+def _kmedoids(
+    points: torch.Tensor, num_clusters: int, num_iterations: int
+) -> torch.Tensor:
+    """Return the indices of *num_clusters* medoids of *points*."""
+    if len(points) <= num_clusters:
+        return torch.arange(len(points))
+    distances = torch.cdist(points, points)
+    generator = torch.Generator().manual_seed(0)
+    medoids = torch.randperm(len(points), generator=generator)[:num_clusters]
+    for _ in range(num_iterations):
+        assignments = distances[:, medoids.to(distances.device)].argmin(1).cpu()
+        updated = medoids.clone()
+        for cluster in range(num_clusters):
+            members = (assignments == cluster).nonzero().squeeze(1)
+            if len(members) > 0:
+                # the member with the lowest total distance to the other members
+                total = distances[members.to(distances.device)][:, members].sum(1)
+                updated[cluster] = members[total.argmin().cpu()]
+        if torch.equal(updated, medoids):
+            break
+        medoids = updated
+    return medoids
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class PrototypeIndex(BruteForceIndex):
+    """Nearest neighbour search on a few prototypes per target.
+    Summarizes each target's references by their mean direction if *num_prototypes* is one,
+    or by the medoids of as many clusters otherwise, so that a query is compared
+    to about as many prototypes as there are targets rather than to every reference.
+    Queries whose nearest prototype is within *margin* of *threshold* are
+    compared to every reference, since the decision could go either way.
+    Top-k queries are always compared to every reference.
+    """
+
+    # number of prototypes per target.
+    num_prototypes: int = 1
+
+    # distance threshold of the identifier.
+    threshold: float = 1.0
+
+    # queries whose prototype distance is closer than this to the threshold
+    # are compared to every reference.
+    margin: float = 0.1
+
+    # number of k-medoids iterations to find the prototypes.
+    num_iterations: int = 10
+
+    # prototypes and their targets
+    _prototypes: Optional[Tuple[torch.Tensor, torch.Tensor]] = field(
+        init=False, default=None, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        super().__post_init__()
+        # NOTE: fitted up front, so that the first query doesn't pay for it
+        if not self.is_empty:
+            self._prototypes = self._fit_prototypes()
+
+    @property
+    def prototypes(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the prototypes and their targets, refitted after changes."""
+        if self._prototypes is None:
+            self._prototypes = self._fit_prototypes()
+        return self._prototypes
+
+    def _fit_prototypes(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the prototypes of each target's references, and their targets."""
+        targets, inverse = torch.unique(self.targets, return_inverse=True)
+        if self.num_prototypes == 1:
+            inverse = inverse.to(self.encodings.device)
+            sums = self.encodings.new_zeros(
+                (len(targets), *self.encodings.shape[1:])
+            ).index_add_(0, inverse, self.encodings)
+            norms = self.encodings.new_zeros((len(targets),)).index_add_(
+                0, inverse, torch.linalg.vector_norm(self.encodings, dim=1)
+            )
+            # NOTE: averaging shortens the mean, which then seems closer to
+            # any query, so it is scaled to the average length of the references
+            counts = torch.bincount(inverse, minlength=len(targets))
+            scales = (
+                norms / counts / torch.linalg.vector_norm(sums, dim=1).clamp(min=1e-12)
+            )
+            return sums * scales.unsqueeze(1), targets
+        medoids = []
+        for position in range(len(targets)):
+            members = (inverse == position).nonzero().squeeze(1)
+            points = self.encodings[members.to(self.encodings.device)]
+            medoids.append(
+                members[_kmedoids(points, self.num_prototypes, self.num_iterations)]
+            )
+        index = torch.cat(medoids)
+        return self.encodings[index.to(self.encodings.device)], self.targets[index]
+
+    def add(self, encoding: FaceEncoding, target: int) -> None:
+        super().add(encoding, target)
+        self._prototypes = None
+
+    def remove(self, target: int) -> None:
+        super().remove(target)
+        self._prototypes = None
+
+    def __call__(self, encoding: FaceEncoding) -> Tuple[int, float]:
+        return Index.__call__(self, encoding)
+
+    def many(self, encodings: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        prototypes, prototype_targets = self.prototypes
+        distance, index = torch.min(torch.cdist(encodings, prototypes), 1)
+        distance = distance.detach().cpu()
+        targets = prototype_targets[index.cpu()]
+        ambiguous = ((distance - self.threshold).abs() <= self.margin).nonzero()
+        if len(ambiguous) > 0:
+            ambiguous = ambiguous.squeeze(1)
+            exact_targets, exact_distance = super().many(
+                encodings[ambiguous.to(encodings.device)]
+            )
+            targets[ambiguous] = exact_targets
+            distance[ambiguous] = exact_distance
+        return targets, distance
+
+
+def _rerank(
+    queries: torch.Tensor,
+    exact: Callable[[torch.Tensor], torch.Tensor],
+    distances: torch.Tensor,
+    num_candidates: int,
+    k: int = 1,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Return the indices and distances of each query's *k* nearest references.
+    Compares the *exact* encodings of the *num_candidates* references with
+    the lowest approximate *distances*, or takes the lowest approximate
+    distances if *num_candidates* is zero.
+    """
+    k = min(k, distances.shape[1])
+    if num_candidates == 0:
+        distance, index = torch.topk(distances, k, dim=1, largest=False)
+        return index, distance
+    candidates = distances.topk(
+        min(max(num_candidates, k), distances.shape[1]), dim=1, largest=False
+    ).indices
+    exact_distances = torch.linalg.vector_norm(
+        queries.unsqueeze(1) - exact(candidates).to(queries), dim=2
+    )
+    distance, best = torch.topk(exact_distances, k, dim=1, largest=False)
+    return candidates.gather(1, best), distance
+
+
+def _quantize_int8(encodings: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Return int8 codes and scales such that codes * scales approximates *encodings*."""
+    encodings = encodings.detach().to(torch.float32)
+    scales = encodings.abs().amax(1).clamp(min=1e-12) / 127
+    codes = torch.round(encodings / scales.unsqueeze(1)).clamp(-127, 127)
+    return codes.to(torch.int8), scales
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class _QuantizedIndex(Index):
+    """Base of the indices that search quantized references, and re-rank
+    the *num_candidates* nearest ones by their exact encodings.
+    The exact encodings are only kept if *num_candidates* is positive, and then
+    the given *encodings* are referred to but never copied or modified, so that
+    they can stay memory-mapped. Encodings of added references go to a side buffer.
+    """
+
+    encodings: torch.Tensor
+
+    targets: torch.Tensor
+
+    # number of references to re-rank with their exact encodings.
+    num_candidates: int = 16
+
+    # exact encodings of the added references
+    _added: torch.Tensor = field(init=False, repr=False)
+
+    _num_added: int = field(init=False, repr=False, default=0)
+
+    # row of each reference's exact encoding, among *encodings* followed by *_added*
+    _rows: torch.Tensor = field(init=False, repr=False)
+
+    _rows_buffer: torch.Tensor = field(init=False, repr=False)
+
+    _targets: torch.Tensor = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        assert len(self.encodings) == len(self.targets)
+        self._targets = self.targets
+        self._rows = self._rows_buffer = torch.arange(len(self.targets))
+        self._added = torch.empty((0,))
+
+    @property
+    def has_exact(self) -> bool:
+        """Return True if the exact encodings are kept."""
+        return self._added is not None
+
+    def _release(self) -> None:
+        """Drop the exact encodings unless they're needed for re-ranking."""
+        if self.num_candidates == 0:
+            self.encodings = torch.empty((0,))
+            self._added = None  # type: ignore[assignment]
+
+    def _exact(self, rows: torch.Tensor) -> torch.Tensor:
+        """Return the exact encodings of the references at *rows*, (..., dim)."""
+        rows = self._rows[rows]
+        given = len(self.encodings)
+        if self._num_added == 0:
+            return self.encodings[rows.to(self.encodings.device)]
+        if given == 0:
+            return self._added[(rows - given).to(self._added.device)]
+        exact = torch.empty(
+            (*rows.shape, self._added.shape[1]),
+            dtype=self._added.dtype,
+            device=self._added.device,
+        )
+        is_given = rows < given
+        exact[is_given] = self.encodings[rows[is_given]].to(exact)
+        exact[~is_given] = self._added[rows[~is_given] - given]
+        return exact
+
+    def _add_reference(self, encoding: FaceEncoding, target: int) -> None:
+        """Append a reference's exact *encoding*, if kept, and its *target*."""
+        size = len(self.targets)
+        row = len(self.encodings) + self._num_added
+        if self.has_exact:
+            self._added = append(self._added, self._num_added, encoding.detach())
+            self._num_added += 1
+        self._rows_buffer = append(self._rows_buffer, size, torch.tensor(row))
+        self._rows = self._rows_buffer[: size + 1]
+        self._targets = append(self._targets, size, torch.tensor(target))
+        self.targets = self._targets[: size + 1]
+
+    def _remove_references(self, keep: torch.Tensor) -> None:
+        """Drop the rows and targets of the references not in *keep*.
+        The exact encodings stay where they are.
+        """
+        self._rows = self._rows_buffer = self._rows[keep]
+        self.targets = self._targets = self.targets[keep]
+
+    def references(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        if not self.has_exact:
+            raise ValueError("the index doesn't keep the exact encodings")
+        return self._exact(torch.arange(len(self.targets))), self.targets
+
+    def __call__(self, encoding: FaceEncoding) -> Tuple[int, float]:
+        return Index.__call__(self, encoding)
+
+    def many(self, encodings: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        targets, distances = self.topk(encodings, 1)
+        return targets[:, 0], distances[:, 0]
+
+    def _search(
+        self, queries: torch.Tensor, distances: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the targets and distances of the *k* nearest references to *queries*,
+        given their approximate *distances*.
+        """
+        index, distance = _rerank(
+            queries,
+            self._exact,
+            distances,
+            self.num_candidates if self.has_exact else 0,
+            k,
+        )
+        return self.targets[index.cpu()], distance.cpu()
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class Int8Index(_QuantizedIndex):
+    """Nearest neighbour search on references quantized to int8.
+    Each reference is scaled to [-127, 127] and rounded, which takes a quarter of the memory.
+    The *num_candidates* nearest references are re-ranked by their exact encodings,
+    which are only read for these candidates, e.g., from a memory-mapped snapshot.
+    Distances are approximate if *num_candidates* is zero, and the exact encodings
+    are not kept if it is zero when the index is built.
+    """
+
+    # quantized references, and their scales
+    codes: torch.Tensor = field(init=False, repr=False)
+
+    scales: torch.Tensor = field(init=False, repr=False)
+
+    _codes: torch.Tensor = field(init=False, repr=False)
+
+    _scales: torch.Tensor = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        super().__post_init__()
+        if self.encodings.dim() == 2:
+            self.codes, self.scales = _quantize_int8(self.encodings)
+        else:
+            self.codes = torch.empty((0,), dtype=torch.int8)
+            self.scales = torch.empty((0,))
+        self._codes, self._scales = self.codes, self.scales
+        self._release()
+
+    def add(self, encoding: FaceEncoding, target: int) -> None:
+        size = len(self.targets)
+        self._add_reference(encoding, target)
+        code, scale = _quantize_int8(encoding.unsqueeze(0))
+        self._codes = append(self._codes, size, code[0])
+        self._scales = append(self._scales, size, scale[0])
+        self.codes = self._codes[: size + 1]
+        self.scales = self._scales[: size + 1]
+
+    def remove(self, target: int) -> None:
+        keep = self.targets != target
+        if keep.all():
+            return
+        self._remove_references(keep)
+        keep = keep.to(self.codes.device)
+        self.codes = self._codes = self.codes[keep]
+        self.scales = self._scales = self.scales[keep]
+
+    def topk(
+        self, encodings: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if len(self.targets) == 0:
+            return _no_neighbours(len(encodings))
+        queries = encodings.detach().to(torch.float32)
+        # NOTE: dequantize in chunks, there's no int8 matrix multiplication
+        distances = torch.cat(
+            [
+                torch.cdist(queries, codes.to(torch.float32) * scales.unsqueeze(1))
+                for codes, scales in zip(
+                    self.codes.split(_CHUNK_SIZE), self.scales.split(_CHUNK_SIZE)
+                )
+            ],
+            dim=1,
+        )
+        return self._search(queries, distances, k)
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class PQIndex(_QuantizedIndex):
+    """Nearest neighbour search on product quantized references.
+    Splits the references into *num_subspaces* parts, and replaces each part by
+    the nearest of *num_centroids* centroids, so that a reference takes
+    *num_subspaces* bytes. Queries are compared to the references' centroids
+    without being quantized themselves (asymmetric distance computation).
+    The *num_candidates* nearest references are re-ranked by their exact encodings,
+    which are only read for these candidates, e.g., from a memory-mapped snapshot.
+    Distances are approximate if *num_candidates* is zero, and the exact encodings
+    are not kept if it is zero once the index is trained.
+    Searches exhaustively until there are at least *num_centroids* references.
+    """
+
+    # number of parts of an encoding, must divide its dimension.
+    num_subspaces: int = 64
+
+    # number of centroids per part, at most 256.
+    num_centroids: int = 256
+
+    # number of k-means iterations to find the centroids.
+    num_iterations: int = 10
+
+    # centroids of each part, as (num_subspaces, num_centroids, dim / num_subspaces)-tensor
+    codebooks: Optional[torch.Tensor] = field(init=False, default=None, repr=False)
+
+    # centroid of each reference's parts
+    codes: torch.Tensor = field(init=False, repr=False)
+
+    _codes: torch.Tensor = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        assert self.num_centroids <= 256
+        super().__post_init__()
+        self.codes = self._codes = torch.empty((0,), dtype=torch.uint8)
+        if len(self.targets) >= self.num_centroids:
+            self._train()
+
+    def _split(self, encodings: torch.Tensor) -> torch.Tensor:
+        """Return the parts of *encodings* as (num_subspaces, N, dim / num_subspaces)-tensor."""
+        encodings = encodings.detach().to(torch.float32)
+        return encodings.reshape(len(encodings), self.num_subspaces, -1).transpose(0, 1)
+
+    def _quantize(self, encodings: torch.Tensor) -> torch.Tensor:
+        """Return the codes of *encodings* as (N, num_subspaces)-tensor."""
+        assert self.codebooks is not None
+        return torch.cat(
+            [
+                torch.cdist(self._split(chunk), self.codebooks)
+                .argmin(2)
+                .T.to(torch.uint8)
+                for chunk in encodings.split(_CHUNK_SIZE)
+            ]
+        )
+
+    def _train(self) -> None:
+        """Find the centroids of each part and quantize the references."""
+        encodings = self._exact(torch.arange(len(self.targets)))
+        self.codebooks = torch.stack(
+            [
+                _kmeans(part, self.num_centroids, self.num_iterations)
+                for part in self._split(encodings)
+            ]
+        )
+        self.codes = self._codes = self._quantize(encodings)
+        self._release()
+
+    def add(self, encoding: FaceEncoding, target: int) -> None:
+        size = len(self.targets)
+        self._add_reference(encoding, target)
+        if self.codebooks is None:
+            if size + 1 >= self.num_centroids:
+                self._train()
+            return
+        self._codes = append(
+            self._codes, size, self._quantize(encoding.unsqueeze(0))[0]
+        )
+        self.codes = self._codes[: size + 1]
+
+    def remove(self, target: int) -> None:
+        keep = self.targets != target
+        if keep.all():
+            return
+        self._remove_references(keep)
+        if self.codebooks is not None:
+            self.codes = self._codes = self.codes[keep.to(self.codes.device)]
+
+    def topk(
+        self, encodings: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if len(self.targets) == 0:
+            return _no_neighbours(len(encodings))
+        queries = encodings.detach().to(torch.float32)
+        if self.codebooks is None:
+            # NOTE: few references, whose exact encodings are kept until trained
+            distances = torch.cdist(
+                queries, self._exact(torch.arange(len(self.targets))).to(queries)
+            )
+            distance, index = torch.topk(
+                distances, min(k, distances.shape[1]), dim=1, largest=False
+            )
+            return self.targets[index.cpu()], distance.cpu()
+        # NOTE: the distance to a chunk of decoded references equals the sum of
+        # the query's parts' distances to their centroids, yet a matrix product
+        # is faster than looking up these distances in a table.
+        parts = torch.arange(self.num_subspaces, device=self.codes.device)
+        distances = torch.cat(
+            [
+                torch.cdist(queries, self.codebooks[parts, codes.long()].flatten(1))
+                for codes in self.codes.split(_CHUNK_SIZE)
+            ],
+            dim=1,
+        )
+        return self._search(queries, distances, k)
+
+
+def _serve(
+    connection: Connection,
+    index: Callable[[torch.Tensor, torch.Tensor], Index],
+    encodings: torch.Tensor,
+    targets: torch.Tensor,
+    num_threads: int,
+) -> None:
+    """Answer the requests of a ShardedIndex on *connection* with an *index* of a shard.
+    Replies with the result, or with the exception that the request raised.
+    """
+    torch.set_num_threads(num_threads)
+    shard = index(encodings, targets)
+    del encodings, targets
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        method, *args = request
+        try:
+            if method == "topk":
+                queries, k = args
+                found, distances = shard.topk(torch.from_numpy(queries), k)
+                connection.send((found.numpy(), distances.numpy()))
+            elif method == "add":
+                encoding, target = args
+                shard.add(torch.from_numpy(encoding), target)
+                connection.send(len(shard.targets))
+            elif method == "remove":
+                shard.remove(*args)
+                connection.send(len(shard.targets))
+            elif method == "references":
+                encodings, targets = shard.references()
+                connection.send((encodings.numpy(), targets.numpy()))
+            else:
+                raise ValueError(f"unknown request: {method}")
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            connection.send(error)
+    connection.close()
+
+
+def _stop(connections: List[Connection], processes: List[Any]) -> None:
+    """Ask the workers of a ShardedIndex to exit, and wait for them."""
+    for connection in connections:
+        try:
+            connection.send(None)
+            connection.close()
+        except OSError:
+            pass  # the worker is gone already
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class ShardedIndex(Index):
+    """Nearest neighbour search on shards of the references in worker processes.
+    Splits the references into *num_shards* shards, each searched by an *index* in
+    a process of its own, so that searches run on as many cores, and a worker only
+    holds its shard. Queries are sent to every worker, and the workers' nearest
+    neighbours are merged. Added references go to the smallest shard.
+    Workers search on the cpu, and exit with `close` or once the index is collected.
+    This process only keeps the targets, and the *encodings* it was built with
+    untouched, e.g., memory-mapped. Added references only live in the workers.
+    """
+
+    encodings: torch.Tensor
+
+    targets: torch.Tensor
+
+    # number of worker processes.
+    num_shards: int = 2
+
+    # builds the index of each shard from its encodings and targets.
+    index: Callable[[torch.Tensor, torch.Tensor], Index] = BruteForceIndex
+
+    # connection to each worker, and the number of references in its shard
+    _connections: List[Connection] = field(init=False, repr=False)
+
+    _sizes: List[int] = field(init=False, repr=False)
+
+    _targets: torch.Tensor = field(init=False, repr=False)
+
+    _finalizer: weakref.finalize = field(init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        assert len(self.encodings) == len(self.targets)
+        self._targets = self.targets
+        # NOTE: forked workers could inherit locks held by torch's threads
+        context = torch.multiprocessing.get_context("spawn")
+        num_threads = max(1, torch.get_num_threads() // self.num_shards)
+        num_references = len(self.targets)
+        self._connections, self._sizes, processes = [], [], []
+        for shard in range(self.num_shards):
+            start = shard * num_references // self.num_shards
+            stop = (shard + 1) * num_references // self.num_shards
+            encodings, targets = torch.empty((0,)), torch.empty((0,))
+            if stop > start:
+                # NOTE: a copy, sending a view would share the entire gallery
+                encodings = self.encodings[start:stop].detach().cpu().clone()
+                targets = self.targets[start:stop].clone()
+            connection, child = context.Pipe()
+            process = context.Process(
+                target=_serve,
+                args=(child, self.index, encodings, targets, num_threads),
+                daemon=True,
+            )
+            process.start()
+            child.close()
+            del encodings, targets
+            self._connections.append(connection)
+            self._sizes.append(stop - start)
+            processes.append(process)
+        self._finalizer = weakref.finalize(self, _stop, self._connections, processes)
+
+    def close(self) -> None:
+        """Stop the workers."""
+        self._finalizer()
+
+    def _request(self, shards: List[int], *request: Any) -> List[Any]:
+        """Send *request* to the workers of *shards*, and return their replies."""
+        for shard in shards:
+            self._connections[shard].send(request)
+        replies = [self._connections[shard].recv() for shard in shards]
+        for reply in replies:
+            if isinstance(reply, Exception):
+                raise reply
+        return replies
+
+    def add(self, encoding: FaceEncoding, target: int) -> None:
+        shard = min(range(self.num_shards), key=self._sizes.__getitem__)
+        (self._sizes[shard],) = self._request(
+            [shard], "add", encoding.detach().cpu().numpy(), target
+        )
+        size = len(self.targets)
+        self._targets = append(self._targets, size, torch.tensor(target))
+        self.targets = self._targets[: size + 1]
+
+    def remove(self, target: int) -> None:
+        keep = self.targets != target
+        if keep.all():
+            return
+        self._sizes = self._request(list(range(self.num_shards)), "remove", target)
+        self.targets = self._targets = self.targets[keep]
+
+    def references(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the encodings and targets of the workers' references, shard by shard."""
+        replies = self._request(list(range(self.num_shards)), "references")
+        # NOTE: empty shards hold (0,)-tensors
+        encodings = [torch.from_numpy(found) for found, _ in replies if len(found)]
+        return (
+            torch.cat(encodings) if encodings else torch.empty((0,)),
+            torch.cat([torch.from_numpy(targets) for _, targets in replies]),
+        )
+
+    def many(self, encodings: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        targets, distances = self.topk(encodings, 1)
+        return targets[:, 0], distances[:, 0]
+
+    def topk(
+        self, encodings: torch.Tensor, k: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        replies = self._request(
+            list(range(self.num_shards)),
+            "topk",
+            encodings.detach().cpu().to(torch.float32).numpy(),
+            k,
+        )
+        targets = torch.cat([torch.from_numpy(found) for found, _ in replies], dim=1)
+        distances = torch.cat(
+            [torch.from_numpy(distance) for _, distance in replies], dim=1
+        )
+        if distances.shape[1] == 0:
+            return _no_neighbours(len(encodings))
+        distance, index = torch.topk(
+            distances, min(k, distances.shape[1]), dim=1, largest=False
+        )
+        return targets.gather(1, index), distance
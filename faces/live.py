@@ -1,12 +1,13 @@
 import logging
 from datetime import datetime
 from tempfile import mkstemp
-from typing import Any
+from typing import Any, List, Tuple
 
 import cv2
 import numpy as np
 
-from faces import Builder, FacePatch, Identity, Image, VideoFrame
+from faces import BoundingBox, Builder, FacePatch, Identity, Image, VideoFrame
+from faces.tracker import Tracker
 
 WINDOW_NAME = "continuous face identification"
 
@@ -22,11 +23,28 @@ class Live:
 
     identified_in_session: Set[Identity]
 
+    tracker: Tracker
+
     def __init__(
-        self, builder: Builder, window_name: str = WINDOW_NAME, video_device: int = 0
+        self,
+        builder: Builder,
+        window_name: str = WINDOW_NAME,
+        video_device: int = 0,
+        # number of frames per detection, faces are tracked in between.
+        detection_interval: int = 1,
+        # number of frames a tracked face keeps its identity.
+        reidentify_interval: int = 30,
+        # tracked faces this close to the distance threshold are identified every detection.
+        uncertainty_margin: float = 0.1,
     ):
         self.builder = builder
         self.window_name = window_name
+        self.tracker = Tracker(
+            detection_interval=detection_interval,
+            reidentify_interval=reidentify_interval,
+            distance_threshold=builder.identifier.distance_threshold,
+            margin=uncertainty_margin,
+        )
         # initialize output window
         cv2.namedWindow(self.window_name)
         # initialize video capture
@@ -49,10 +67,7 @@ class Live:
             image = Image.from_array(video_frame.frame)
 
             # identify faces in the image
-            extracts = [
-                (bounding_box, face_patch, self.builder.identifier(face_patch))
-                for bounding_box, face_patch in self.builder.detector.extract(image)
-            ]
+            extracts = self.follow(image)
 
             # track identified people
             self.track_identified(
@@ -89,6 +104,22 @@ class Live:
                 except ValueError as error:
                     logging.error(str(error))
 
+    def follow(self, image: Image) -> List[Tuple[BoundingBox, FacePatch, Identity]]:
+        """Identify the faces in *image*, which is the next video frame.
+        Detects every *detection_interval* frames, or when a face is lost, and carries
+        the identities along the optical flow in between. Only new, uncertain, or
+        changed faces are identified, and all others every *reidentify_interval* frames.
+        """
+        frame = np.asarray(image.image.convert("L"))
+        if self.tracker.needs_detection:
+            detections = self.builder.detector.extract_batch(image)
+            tracks = self.tracker.update(
+                frame, detections, self.builder.identifier.many
+            )
+        else:
+            tracks = self.tracker.propagate(frame)
+        return [(track.bounding_box, track.patch, track.identity) for track in tracks]
+
     def track_identified(self, identified: Set[Identity]):
         """Handle identified faces."""
         for name in identified - self.identified_in_session:
@@ -115,8 +146,7 @@ class Live:
 
         try:
             (face_patch,) = unidentified
-            self.builder.registry.add(face_patch, Identity(user_input))
-            self.builder.reload()
+            self.builder.add(face_patch, Identity(user_input))
         except ValueError as error:
             raise ValueError(f"skipping face: {error}") from error
 
@@ -3,16 +3,20 @@
 import argparse
 import logging
 import sys
-from collections import Counter
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
 
 import matplotlib.pylab as plt
+import torch
 from PIL import Image as PILImage
 
-from faces import Builder, Identity, Image
+from faces import Builder, FacePatch, Identity, Image, Registry
 from faces.builder import DefaultBuilder
+from faces.encoder import CachedEncoder
+from faces.identifier import ConstrainedNearestNeighbourClassifier
 from faces.live import Live
+from faces.registry import journal_path, open_registry
+from faces.utils import chunked
 
 
 class Main:
@@ -34,6 +38,28 @@ class Main:
             default=Path("~/.faces.pkl").expanduser(),
             help="path to the faces database.",
         )
+        parser.add_argument(
+            "--registry-backend",
+            choices=("pickle", "journal", "sqlite"),
+            default=None,
+            help="storage of the faces database. journal appends changes instead of rewriting the file. "
+            "Defaults to sqlite for .db, .sqlite, and .sqlite3 files, to journal if the "
+            "database has a journal, and to pickle otherwise.",
+        )
+        parser.add_argument(
+            "--snapshot-path",
+            type=Path,
+            default=None,
+            help="path to the fitted identifier, which is loaded instead of refitted "
+            "while the faces database doesn't change. Defaults to the registry path "
+            "with a .snapshot suffix.",
+        )
+        parser.add_argument(
+            "--no-snapshot",
+            action="store_true",
+            default=False,
+            help="always fit the identifier to the faces database.",
+        )
         # pipeline args
         parser.add_argument(
             "--probability-threshold",
@@ -47,6 +73,98 @@ class Main:
             default=0.9,
             help="only identify faces whose similarity is below the given threshold.",
         )
+        parser.add_argument(
+            "--index",
+            choices=("exact", "cosine", "ivf", "int8", "pq", "prototype"),
+            default="exact",
+            help="nearest neighbour search. cosine is exact and faster, ivf is approximate "
+            "but faster on large registries, int8 and pq use less memory, prototype "
+            "compares to a few prototypes per identity.",
+        )
+        parser.add_argument(
+            "--num-subspaces",
+            type=int,
+            default=64,
+            help="number of bytes per face of the pq index.",
+        )
+        parser.add_argument(
+            "--num-candidates",
+            type=int,
+            default=16,
+            help="number of faces the int8 and pq indices compare exactly. 0 to not compare exactly.",
+        )
+        parser.add_argument(
+            "--num-prototypes",
+            type=int,
+            default=1,
+            help="number of prototypes per identity of the prototype index. 1 for their mean.",
+        )
+        parser.add_argument(
+            "--prototype-margin",
+            type=float,
+            default=0.1,
+            help="the prototype index compares faces to every reference if their distance "
+            "is within this margin of the distance threshold.",
+        )
+        parser.add_argument(
+            "--precision",
+            choices=("float32", "float16", "bfloat16"),
+            default="float32",
+            help="precision of the references of the cosine index.",
+        )
+        parser.add_argument(
+            "--num-lists",
+            type=int,
+            default=64,
+            help="number of clusters of the ivf index.",
+        )
+        parser.add_argument(
+            "--num-probes",
+            type=int,
+            default=8,
+            help="number of clusters the ivf index searches. More probes increase the recall.",
+        )
+        parser.add_argument(
+            "--num-shards",
+            type=int,
+            default=1,
+            help="number of worker processes that search a shard of the faces each.",
+        )
+        parser.add_argument(
+            "--num-neighbours",
+            type=int,
+            default=1,
+            help="number of nearest faces that vote for the identity.",
+        )
+        parser.add_argument(
+            "--weighted-vote",
+            action="store_true",
+            help="weigh the votes of the nearest faces by the inverse of their distance.",
+        )
+        parser.add_argument(
+            "--encoding-cache-size",
+            type=int,
+            default=1024,
+            help="number of encodings of recently seen faces kept in memory. 0 to disable.",
+        )
+        parser.add_argument(
+            "--encoding-cache-path",
+            type=Path,
+            default=None,
+            help="database that keeps the encodings of all faces seen across runs.",
+        )
+        parser.add_argument(
+            "--detection-batch-size",
+            type=int,
+            default=16,
+            help="number of images opened and searched for faces at once.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=256,
+            help="number of faces encoded at once when loading the faces database.",
+        )
         # actions
         subparsers = parser.add_subparsers(
             dest="action", required=True, help="choose what to do"
@@ -58,6 +176,25 @@ class Main:
         live_parser.add_argument(
             "--video-device", type=int, default=0, help="Video device number"
         )
+        live_parser.add_argument(
+            "--detection-interval",
+            type=int,
+            default=1,
+            help="number of frames per face detection, faces are tracked in between.",
+        )
+        live_parser.add_argument(
+            "--reidentify-interval",
+            type=int,
+            default=30,
+            help="number of frames a tracked face keeps its identity, unless it changes.",
+        )
+        live_parser.add_argument(
+            "--uncertainty-margin",
+            type=float,
+            default=0.1,
+            help="tracked faces whose distance is within this margin of the distance "
+            "threshold are identified at every detection.",
+        )
         # detect
         detect_parser = subparsers.add_parser("detect", help="detect faces in images")
         detect_parser.add_argument(
@@ -107,6 +244,27 @@ class Main:
         )
         # list
         database_subparsers.add_parser("list", help="list face database")
+        # migrate
+        migrate_parser = database_subparsers.add_parser(
+            "migrate", help="copy faces from another registry into the registry"
+        )
+        migrate_parser.add_argument(
+            "--source-backend",
+            choices=("pickle", "journal", "sqlite"),
+            default=None,
+            help="storage of the source registry. Inferred like --registry-backend by default.",
+        )
+        migrate_parser.add_argument(
+            "source", type=Path, help="path to the registry to copy from."
+        )
+        # export
+        export_parser = database_subparsers.add_parser(
+            "export",
+            help="write the encoded faces to a gallery that processes can share",
+        )
+        export_parser.add_argument(
+            "gallery", type=Path, help="directory to write the gallery to."
+        )
         # remove
         register_parser = database_subparsers.add_parser(
             "remove", help="remove identities from the registry"
@@ -129,22 +287,49 @@ class Main:
 
         # take action
         if args.action == "live":
-            self.live(builder, args.video_device)
-        elif args.action == "detect":
-            detect = (
-                self.detect_with_probability if args.show_probability else self.detect
+            self.live(
+                builder,
+                args.video_device,
+                args.detection_interval,
+                args.reidentify_interval,
+                args.uncertainty_margin,
             )
-            for path in args.images:
-                detect(builder, Image.open(path)).show()
+        elif args.action == "detect":
+            for paths in chunked(args.images, args.detection_batch_size):
+                for annotated in self.detect_many(
+                    builder,
+                    [Image.open(path) for path in paths],
+                    show_probability=args.show_probability,
+                ):
+                    annotated.show()
         elif args.action == "identify":
-            for path in args.images:
-                self.identify(builder, Image.open(path)).show()
+            for paths in chunked(args.images, args.detection_batch_size):
+                for annotated in self.identify_many(
+                    builder, [Image.open(path) for path in paths]
+                ):
+                    annotated.show()
         elif args.action == "db":
             if args.dbaction == "add":
-                for path in args.images:
-                    self.register(builder, path, args.identity)
+                self.register_many(
+                    builder,
+                    args.images,
+                    args.identity,
+                    batch_size=args.detection_batch_size,
+                )
             elif args.dbaction == "list":
                 self.list_db(builder)
+            elif args.dbaction == "migrate":
+                # NOTE: opening a missing registry would silently migrate nothing
+                if not (args.source.exists() or journal_path(args.source).exists()):
+                    parser.error(f"no registry at {args.source}")
+                self.migrate(
+                    builder,
+                    open_registry(
+                        args.source, torch.device("cpu"), args.source_backend
+                    ),
+                )
+            elif args.dbaction == "export":
+                self.export(builder, args.gallery)
             elif args.dbaction == "remove":
                 for identity in args.identities:
                     self.remove(builder, identity)
@@ -153,40 +338,100 @@ class Main:
         else:
             raise ValueError(args.action)
 
-    def live(self, builder: Builder, video_device: int) -> None:
+        encoder = builder.__dict__.get("encoder")
+        if isinstance(encoder, CachedEncoder):
+            logging.info(
+                f"encoding cache: {encoder.hits} hits, {encoder.misses} misses"
+            )
+
+    def live(
+        self,
+        builder: Builder,
+        video_device: int,
+        detection_interval: int = 1,
+        reidentify_interval: int = 30,
+        uncertainty_margin: float = 0.1,
+    ) -> None:
         """Perform live detection and identification via a webcam."""
-        Live(builder, video_device=video_device).run()
+        Live(
+            builder,
+            video_device=video_device,
+            detection_interval=detection_interval,
+            reidentify_interval=reidentify_interval,
+            uncertainty_margin=uncertainty_margin,
+        ).run()
 
     def detect(self, builder: Builder, image: Image) -> PILImage.Image:
         """Return an image where detected faces are highlighted."""
-        return builder.annotate(
-            image, (box for box, _ in builder.detector.detect(image))
-        )
+        return self.detect_many(builder, [image])[0]
 
     def detect_with_probability(self, builder: Builder, image: Image) -> PILImage.Image:
         """Return an image where detected faces and their likelihood are highlighted."""
-        return builder.annotate.with_probability(image, builder.detector.detect(image))
+        return self.detect_many(builder, [image], show_probability=True)[0]
+
+    def detect_many(
+        self, builder: Builder, images: Sequence[Image], show_probability: bool = False
+    ) -> List[PILImage.Image]:
+        """Return images where detected faces, and optionally their likelihood, are highlighted.
+        Detects the faces of all *images* at once.
+        """
+        annotated = []
+        for image, detections in zip(images, builder.detector.detect_many(images)):
+            if show_probability:
+                annotated.append(builder.annotate.with_probability(image, detections))
+            else:
+                annotated.append(
+                    builder.annotate(image, (box for box, _ in detections))
+                )
+        return annotated
 
     def identify(self, builder: Builder, image: Image) -> PILImage.Image:
         """Return an image where detected faces and their identity are highlighted."""
-        return builder.annotate.with_identity(
-            image,
-            (
-                (bounding_box, builder.identifier(face_patch))
-                for bounding_box, face_patch in builder.detector.extract(image)
-            ),
+        return self.identify_many(builder, [image])[0]
+
+    def identify_many(
+        self, builder: Builder, images: Sequence[Image]
+    ) -> List[PILImage.Image]:
+        """Return images where detected faces and their identity are highlighted.
+        Detects the faces of all *images* at once, and identifies them in a single batch.
+        """
+        extracts = builder.detector.extract_many(images)
+        patches = [patch for image_extracts in extracts for _, patch in image_extracts]
+        identities = iter(
+            builder.identifier.many(torch.stack(patches)) if patches else []
         )
+        return [
+            builder.annotate.with_identity(
+                image,
+                [
+                    (bounding_box, next(identities)[0])
+                    for bounding_box, _ in image_extracts
+                ],
+            )
+            for image, image_extracts in zip(images, extracts)
+        ]
 
     def list_db(self, builder: Builder) -> None:
         """Print a summary of the registry's content."""
-        for identity, count in Counter(
-            [identity for patch, identity in builder.registry]
-        ).items():
+        for identity, count in builder.registry.counts().items():
             print(f"{count: 4d}: {identity}")
 
+    def migrate(self, builder: Builder, source: Registry) -> None:
+        """Copy all faces and their stored encodings from *source* into the registry."""
+        builder.registry.add_many(source.entries())
+
+    def export(self, builder: Builder, gallery: Path) -> None:
+        """Write the identifier to the directory *gallery*.
+        See `ConstrainedNearestNeighbourClassifier.load` to open it.
+        """
+        identifier = builder.identifier
+        if not isinstance(identifier, ConstrainedNearestNeighbourClassifier):
+            raise ValueError(f"cannot export {type(identifier).__name__}")
+        identifier.save(gallery)
+
     def remove(self, builder: Builder, identity: Identity) -> None:
         """Remove an identity (and all of its faces) from the registry."""
-        builder.registry.remove(identity)
+        builder.remove(identity)
 
     def register(
         self,
@@ -195,28 +440,42 @@ class Main:
         identity: Optional[Identity] = None,
     ) -> None:
         """Extract faces from an image, add them to a face registry.
-        If *path* is a file, its filename is used as identity.
-        If *path* is a directory, its folder name is used as identity for all
+        See `register_many`.
+        """
+        self.register_many(builder, [path], identity)
+
+    def register_many(
+        self,
+        builder: Builder,
+        paths: Iterable[Path],
+        identity: Optional[Identity] = None,
+        batch_size: int = 16,
+    ) -> None:
+        """Extract faces from images, add them to a face registry.
+        If a path is a file, its filename is used as identity.
+        If a path is a directory, its folder name is used as identity for all
         images it contains.
 
         In either case, queries the user for the identity if multiple
         faces are detected within an image.
 
+        Detects the faces of *batch_size* images at once.
+        All faces are committed to the registry at once, including when the
+        user aborts, interrupts, or closes the input.
+
         """
+        registry = builder.registry
 
         def _path_to_identity(path: Path) -> Identity:
             if identity:
                 return identity
             return Identity(path.stem.lower().replace("-", "_").replace("_", " "))
 
-        def _add_face(path: Path, label: Path):
-            patches = [
-                face_patch
-                for _, face_patch in builder.detector.extract(Image.open(path))
-            ]
+        def _add_faces(patches: List[FacePatch], label: Path) -> bool:
+            """Add the faces detected in an image. Return False to abort."""
             if len(patches) == 1:
                 try:
-                    builder.registry.add(patches[0], _path_to_identity(label))
+                    registry.add(patches[0], _path_to_identity(label))
                 except ValueError as error:
                     print("Skipping face:", error)
             elif len(patches) > 1:
@@ -243,21 +502,45 @@ class Main:
                             user_input = ""
                             break
                         if user_input == "-2":
-                            return
+                            return True
                         if user_input == "-3":
-                            sys.exit(1)
+                            return False
                     if user_input:
                         try:
-                            builder.registry.add(face_patch, Identity(user_input))
+                            registry.add(face_patch, Identity(user_input))
                         except ValueError as error:
                             print("Skipping face:", error)
+            return True
+
+        def _images() -> Iterator[Tuple[Path, Path]]:
+            """Yield the image files and the path that labels them."""
+            for path in paths:
+                if path.is_file():
+                    yield path, path
+                if path.is_dir():
+                    yield from (
+                        (child, path) for child in path.iterdir() if child.is_file()
+                    )
 
-        if path.is_file():
-            _add_face(path, path)
-        if path.is_dir():
-            for child in path.iterdir():
-                if child.is_file():
-                    _add_face(child, path)
+        proceed = True
+        with registry.transaction():
+            try:
+                for batch in chunked(_images(), batch_size):
+                    extracts = builder.detector.extract_many(
+                        [Image.open(child) for child, _ in batch]
+                    )
+                    proceed = all(
+                        _add_faces([patch for _, patch in image_extracts], label)
+                        for (_, label), image_extracts in zip(batch, extracts)
+                    )
+                    if not proceed:
+                        break
+            except (KeyboardInterrupt, EOFError):
+                # NOTE: keep the faces added so far, as if aborted with -3
+                print("Aborting")
+                proceed = False
+        if not proceed:
+            sys.exit(1)
 
 
 def main(argv=None):
@@ -1,11 +1,37 @@
+import hashlib
+import os
 import pickle
-from dataclasses import dataclass
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Iterator, Set, Tuple
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 import torch
 
-from faces import FacePatch, Identity, Registry
+from faces import Encoder, FaceEncoding, FacePatch, Identity, Progress, Registry
+from faces.utils import (
+    chunked,
+    dequantize_patch,
+    digest,
+    from_blob,
+    quantize_patch,
+    to_blob,
+)
+
+# a registry mutation, as (action, *arguments)-tuple
+Record = Tuple[Any, ...]
 
 
 class InMemoryRegistry(Registry):
@@ -16,14 +42,30 @@ class InMemoryRegistry(Registry):
     def __init__(self):
         self.data = set()
 
-    def add(self, face_patch: FacePatch, identity: Identity) -> None:
+    def add(
+        self,
+        face_patch: FacePatch,
+        identity: Identity,
+        encoding: Optional[Tuple[str, FaceEncoding]] = None,
+    ) -> bool:
+        size = len(self.data)
         self.data.add((face_patch, identity))
+        return len(self.data) > size
 
     def remove(self, identity: Identity) -> None:
         self.data = {
             (face_patch, id_) for face_patch, id_ in self.data if id_ != identity
         }
 
+    @contextmanager
+    def transaction(self) -> Iterator[Registry]:
+        data = set(self.data)
+        try:
+            yield self
+        except BaseException:
+            self.data = data
+            raise
+
     def __iter__(self) -> Iterator[Tuple[FacePatch, Identity]]:
         return iter(self.data)
 
@@ -33,55 +75,580 @@ class InMemoryRegistry(Registry):
 
 @dataclass
 class PickleRegistry(Registry):
-    """Store faces and identities via pickle."""
+    """Store faces and identities via pickle.
+    Face patches are held as uint8 tensors, see `faces.utils.quantize_patch`.
+    They stay on the cpu and are moved to *device* only when iterated over.
+    """
 
     path: Path
 
+    # quantized face patches and their identities
     data: Set[Tuple[FacePatch, Identity]]
 
+    # device of the encodings, and of the patches when iterated over
+    device: torch.device = torch.device("cpu")
+
+    # face encodings by patch digest, as (encoder version, encoding)-tuples
+    encoded: Dict[str, Tuple[str, FaceEncoding]] = field(default_factory=dict)
+
+    # faces by patch digest, derived from *data* if not given
+    by_digest: Dict[str, Tuple[FacePatch, Identity]] = field(
+        default_factory=dict, repr=False
+    )
+
+    # records of the ongoing transaction, None outside of transactions
+    _pending: Optional[List[Record]] = field(default=None, init=False, repr=False)
+
+    # state of the files when they were last read or written
+    stamp: Tuple[Optional[Tuple[int, int, int]], ...] = field(
+        default=(), init=False, repr=False
+    )
+
+    def __post_init__(self) -> None:
+        if len(self.by_digest) != len(self.data):
+            self.by_digest = {
+                digest(dequantize_patch(face_patch)): (face_patch, identity)
+                for face_patch, identity in (
+                    (quantize_patch(patch), identity) for patch, identity in self.data
+                )
+            }
+            self.data = set(self.by_digest.values())
+        self.stamp = self._read_stamp()
+
+    @property
+    def files(self) -> Tuple[Path, ...]:
+        """Return the paths of the files that store the registry."""
+        return (self.path,)
+
+    def _read_stamp(self) -> Tuple[Optional[Tuple[int, int, int]], ...]:
+        """Return the modification time, size, and inode of the registry's files."""
+        stamp = []
+        for path in self.files:
+            try:
+                stat = path.stat()
+                stamp.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def fingerprint(self) -> Optional[str]:
+        return _fingerprint(
+            (key, identity) for key, (_, identity) in sorted(self.by_digest.items())
+        )
+
+    def is_stale(self) -> bool:
+        return self._read_stamp() != self.stamp
+
     @classmethod
     def open(cls, path: Path, device: torch.device) -> Registry:
         """Open the registry at *path*."""
         if not path.exists():
-            return cls(path=path, data=set())
+            return cls(path=path, data=set(), device=device)
         with open(path, "rb") as registry_file:
-            return cls(
-                path=path,
-                data={
-                    (patch.to(device), identity)
-                    for patch, identity in pickle.load(registry_file)["data"]
-                },
-            )
+            content = pickle.load(registry_file)
+        # NOTE: registries from before digests were stored lack this entry,
+        # registries from before patches were quantized hold float patches
+        by_digest = {
+            key: (quantize_patch(patch).cpu(), identity)
+            for key, (patch, identity) in content.get("by_digest", {}).items()
+        }
+        return cls(
+            path=path,
+            data=(
+                set(by_digest.values())
+                if by_digest
+                else {(patch.cpu(), identity) for patch, identity in content["data"]}
+            ),
+            device=device,
+            # NOTE: registries from before encodings were stored lack this entry
+            encoded={
+                key: (version, encoding.to(device))
+                for key, (version, encoding) in content.get("encoded", {}).items()
+            },
+            by_digest=by_digest,
+        )
 
     def _save(self) -> None:
-        with open(self.path, "wb") as registry_file:
+        """Write the registry to a temporary file, then atomically replace *path*."""
+        temporary = self.path.with_name(self.path.name + ".tmp")
+        with open(temporary, "wb") as registry_file:
             pickle.dump(
                 {
+                    # NOTE: pickle stores the faces shared by data and by_digest once
                     "data": self.data,
+                    "encoded": self.encoded,
+                    "by_digest": self.by_digest,
                 },
                 registry_file,
             )
+            registry_file.flush()
+            os.fsync(registry_file.fileno())
+        os.replace(temporary, self.path)
+        self.stamp = self._read_stamp()
 
-    def remove(self, identity: Identity) -> None:
-        self.data = {
-            (face_patch, id_) for face_patch, id_ in self.data if id_ != identity
-        }
+    def _apply(self, record: Record) -> None:
+        """Apply a mutation *record* to the registry's content."""
+        action, *args = record
+        if action == "add":
+            key, face_patch, identity = args
+            # NOTE: journals from before patches were quantized hold float patches
+            face_patch = quantize_patch(face_patch).cpu()
+            if key in self.by_digest:
+                self.data.discard(self.by_digest[key])
+            self.data.add((face_patch, identity))
+            self.by_digest[key] = (face_patch, identity)
+        elif action == "remove":
+            (identity,) = args
+            for key in [k for k, (_, id_) in self.by_digest.items() if id_ == identity]:
+                del self.by_digest[key]
+                self.encoded.pop(key, None)
+            self.data = {
+                (face_patch, id_) for face_patch, id_ in self.data if id_ != identity
+            }
+        elif action == "encode":
+            key, version, encoding = args
+            self.encoded[key] = (version, encoding.to(self.device))
+        else:
+            raise ValueError(f"unknown action: {action}")
+
+    def _commit(self, records: Sequence[Record]) -> None:
+        """Persist the mutation *records*."""
+        # pylint: disable=unused-argument
         self._save()
 
-    def add(self, face_patch: FacePatch, identity: Identity) -> None:
-        # NOTE: tensor hashes differ even if they are have identical values
-        if knows_patch_as := {
-            identity for patch, identity in self.data if torch.equal(face_patch, patch)
-        }:
-            if knows_patch_as != {identity}:
+    def _stage(self, records: Sequence[Record]) -> None:
+        """Apply the mutation *records*. Commit them unless a transaction is ongoing."""
+        for record in records:
+            self._apply(record)
+        if self._pending is None:
+            self._commit(records)
+        else:
+            self._pending.extend(records)
+
+    @contextmanager
+    def transaction(self) -> Iterator[Registry]:
+        if self._pending is not None:  # nested transaction
+            yield self
+            return
+        self._pending = []
+        content = set(self.data), dict(self.encoded), dict(self.by_digest)
+        try:
+            yield self
+        except BaseException:
+            self._pending = None
+            self.data, self.encoded, self.by_digest = content
+            raise
+        records, self._pending = self._pending, None
+        if records:
+            self._commit(records)
+
+    def remove(self, identity: Identity) -> None:
+        self._stage([("remove", identity)])
+
+    def add(
+        self,
+        face_patch: FacePatch,
+        identity: Identity,
+        encoding: Optional[Tuple[str, FaceEncoding]] = None,
+    ) -> bool:
+        # NOTE: tensor hashes differ even if they have identical values, digests don't
+        face_patch = quantize_patch(face_patch)
+        key = digest(dequantize_patch(face_patch))
+        if key in self.by_digest:
+            if (knows_patch_as := {self.by_digest[key][1]}) != {identity}:
                 raise ValueError(f"already known as {knows_patch_as}")
+            return False
+
+        records: List[Record] = [("add", key, face_patch, identity)]
+        if encoding is not None:
+            version, value = encoding
+            records.append(("encode", key, version, value.detach()))
+        self._stage(records)
+        return True
+
+    def encodings(
+        self,
+        encoder: Encoder,
+        batch_size: int = 256,
+        progress: Optional[Progress] = None,
+    ) -> Iterator[Tuple[FaceEncoding, Identity]]:
+        # encode faces whose encoding is missing or from another encoder
+        stale = [
+            key
+            for key in self.by_digest
+            if key not in self.encoded or self.encoded[key][0] != encoder.version
+        ]
+        num_encoded, start = 0, time.perf_counter()
+        with self.transaction():
+            for keys in chunked(stale, batch_size):
+                patches = torch.stack([self.by_digest[key][0] for key in keys])
+                encodings = encoder.many(dequantize_patch(patches.to(self.device)))
+                self._stage(
+                    [
+                        ("encode", key, encoder.version, encoding.detach())
+                        for key, encoding in zip(keys, encodings)
+                    ]
+                )
+                num_encoded += len(keys)
+                if progress is not None:
+                    progress(num_encoded, len(stale), time.perf_counter() - start)
+        return (
+            (self.encoded[key][1], identity)
+            for key, (_, identity) in self.by_digest.items()
+        )
+
+    def entries(
+        self,
+    ) -> Iterator[Tuple[FacePatch, Identity, Optional[Tuple[str, FaceEncoding]]]]:
+        return (
+            (
+                dequantize_patch(face_patch.to(self.device)),
+                identity,
+                self.encoded.get(key),
+            )
+            for key, (face_patch, identity) in self.by_digest.items()
+        )
+
+    def identities(self) -> Iterator[Identity]:
+        return (identity for _, identity in self.data)
+
+    def __iter__(self) -> Iterator[Tuple[FacePatch, Identity]]:
+        return (
+            (dequantize_patch(face_patch.to(self.device)), identity)
+            for face_patch, identity in self.data
+        )
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+@dataclass
+class JournalRegistry(PickleRegistry):
+    """Store faces and identities in a pickle snapshot and a journal.
+    Mutations are appended to the journal, whose records are merged into
+    the snapshot once there are more than *compact_after* of them.
+    """
+
+    # number of journal records after which they are merged into the snapshot.
+    compact_after: int = 1000
+
+    # number of records in the journal
+    num_records: int = 0
+
+    # offset of an incomplete last record in the journal, None if there is none
+    _torn: Optional[int] = field(default=None, init=False, repr=False)
+
+    @classmethod
+    def open(cls, path: Path, device: torch.device) -> Registry:
+        """Open the registry at *path* and replay its journal.
+        Doesn't write, an incomplete last record is dropped by the next mutation.
+        """
+        registry = super().open(path, device)
+        assert isinstance(registry, JournalRegistry)
+        if not registry.journal_path.exists():
+            return registry
+        with open(registry.journal_path, "rb") as journal:
+            size = os.fstat(journal.fileno()).st_size
+            while (offset := journal.tell()) < size:
+                try:
+                    record = pickle.load(journal)
+                except _TORN_RECORD_ERRORS:
+                    # NOTE: a crash while appending leaves an incomplete last record
+                    registry._torn = offset
+                    break
+                registry._apply(record)
+                registry.num_records += 1
+        registry.stamp = registry._read_stamp()
+        return registry
+
+    def _drop_torn_record(self) -> None:
+        """Truncate the journal's incomplete last record, unless another
+        process changed the journal since it was read.
+        """
+        torn, self._torn = self._torn, None
+        if torn is None or self._read_stamp()[1] != self.stamp[1]:
             return
+        with open(self.journal_path, "rb+") as journal:
+            journal.truncate(torn)
 
-        self.data.add((face_patch, identity))
+    @property
+    def journal_path(self) -> Path:
+        """Return the path of the journal."""
+        return journal_path(self.path)
+
+    @property
+    def files(self) -> Tuple[Path, ...]:
+        return (self.path, self.journal_path)
+
+    def _commit(self, records: Sequence[Record]) -> None:
+        self._drop_torn_record()
+        with open(self.journal_path, "ab") as journal:
+            for record in records:
+                pickle.dump(record, journal)
+            journal.flush()
+            os.fsync(journal.fileno())
+        self.num_records += len(records)
+        self.stamp = self._read_stamp()
+        if self.num_records > self.compact_after:
+            self.compact()
+
+    def compact(self) -> None:
+        """Merge the journal into the snapshot."""
         self._save()
+        # NOTE: replaying the journal onto the new snapshot is harmless, should we crash here
+        self.journal_path.unlink(missing_ok=True)
+        self.num_records = 0
+        self.stamp = self._read_stamp()
+
+
+def journal_path(path: Path) -> Path:
+    """Return the path of the journal of the registry at *path*."""
+    return path.with_name(path.name + ".journal")
+
+
+# errors of unpickling an incomplete record
+_TORN_RECORD_ERRORS = (EOFError, pickle.UnpicklingError, ValueError, RuntimeError)
+
+
+def _fingerprint(faces: Iterable[Tuple[str, Identity]]) -> str:
+    """Return a digest of (patch digest, identity)-tuples sorted by patch digest."""
+    hasher = hashlib.blake2b(digest_size=16)
+    for key, identity in faces:
+        hasher.update(f"{key}:{len(identity)}:{identity}".encode())
+    return hasher.hexdigest()
+
+
+@dataclass
+class SqliteRegistry(Registry):
+    """Store faces, identities, and encodings in a SQLite database.
+    Uses write-ahead logging so that readers don't block on a writer.
+    Face patches are stored as uint8, see `faces.utils.quantize_patch`.
+    """
+
+    path: Path
+
+    device: torch.device
+
+    connection: sqlite3.Connection
+
+    in_transaction: bool = field(default=False, init=False)
+
+    # version of the database when last checked, changed by other connections' commits
+    data_version: int = field(default=0, init=False)
+
+    def __post_init__(self) -> None:
+        self.is_stale()
+
+    @classmethod
+    def open(cls, path: Path, device: torch.device) -> Registry:
+        """Open the registry at *path*."""
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.executescript("""
+            CREATE TABLE IF NOT EXISTS faces (
+                digest TEXT PRIMARY KEY,
+                identity TEXT NOT NULL,
+                patch BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS faces_identity ON faces (identity);
+            CREATE TABLE IF NOT EXISTS encodings (
+                digest TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                encoding BLOB NOT NULL
+            );
+            """)
+        return cls(path=path, device=device, connection=connection)
+
+    @contextmanager
+    def _writing(self) -> Iterator[sqlite3.Connection]:
+        """Commit the writes within the context unless a transaction is ongoing."""
+        if self.in_transaction:
+            yield self.connection
+        else:
+            with self.connection:
+                yield self.connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[Registry]:
+        if self.in_transaction:  # nested transaction
+            yield self
+            return
+        self.in_transaction = True
+        try:
+            # NOTE: the connection commits on success and rolls back otherwise
+            with self.connection:
+                yield self
+        finally:
+            self.in_transaction = False
+
+    def fingerprint(self) -> Optional[str]:
+        return _fingerprint(
+            self.connection.execute(
+                "SELECT digest, identity FROM faces ORDER BY digest"
+            )
+        )
+
+    def is_stale(self) -> bool:
+        data_version = self.connection.execute("PRAGMA data_version").fetchone()[0]
+        stale, self.data_version = data_version != self.data_version, data_version
+        return stale
+
+    def remove(self, identity: Identity) -> None:
+        with self._writing():
+            self.connection.execute(
+                "DELETE FROM encodings WHERE digest IN "
+                "(SELECT digest FROM faces WHERE identity = ?)",
+                (identity,),
+            )
+            self.connection.execute("DELETE FROM faces WHERE identity = ?", (identity,))
+
+    def add(
+        self,
+        face_patch: FacePatch,
+        identity: Identity,
+        encoding: Optional[Tuple[str, FaceEncoding]] = None,
+    ) -> bool:
+        face_patch = quantize_patch(face_patch)
+        key = digest(dequantize_patch(face_patch))
+        if row := self.connection.execute(
+            "SELECT identity FROM faces WHERE digest = ?", (key,)
+        ).fetchone():
+            if (knows_patch_as := {row[0]}) != {identity}:
+                raise ValueError(f"already known as {knows_patch_as}")
+            return False
+
+        with self._writing():
+            self.connection.execute(
+                "INSERT INTO faces (digest, identity, patch) VALUES (?, ?, ?)",
+                (key, identity, to_blob(face_patch)),
+            )
+            if encoding is not None:
+                version, value = encoding
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO encodings (digest, version, encoding) "
+                    "VALUES (?, ?, ?)",
+                    (key, version, to_blob(value)),
+                )
+        return True
+
+    def encodings(
+        self,
+        encoder: Encoder,
+        batch_size: int = 256,
+        progress: Optional[Progress] = None,
+    ) -> Iterator[Tuple[FaceEncoding, Identity]]:
+        # encode faces whose encoding is missing or from another encoder
+        stale = [
+            key
+            for (key,) in self.connection.execute(
+                "SELECT faces.digest FROM faces "
+                "LEFT JOIN encodings ON faces.digest = encodings.digest "
+                "WHERE encodings.version IS NULL OR encodings.version != ?",
+                (encoder.version,),
+            )
+        ]
+        num_encoded, start = 0, time.perf_counter()
+        with self.transaction():
+            for keys in chunked(stale, batch_size):
+                # NOTE: only the patches of one batch are loaded at a time
+                rows = self.connection.execute(
+                    "SELECT digest, patch FROM faces WHERE digest IN "
+                    f"({', '.join('?' * len(keys))})",
+                    keys,
+                ).fetchall()
+                encodings = encoder.many(
+                    torch.stack(
+                        [
+                            dequantize_patch(from_blob(patch, self.device))
+                            for _, patch in rows
+                        ]
+                    )
+                )
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO encodings (digest, version, encoding) "
+                    "VALUES (?, ?, ?)",
+                    (
+                        (key, encoder.version, to_blob(encoding))
+                        for (key, _), encoding in zip(rows, encodings)
+                    ),
+                )
+                num_encoded += len(keys)
+                if progress is not None:
+                    progress(num_encoded, len(stale), time.perf_counter() - start)
+        return (
+            (from_blob(encoding, self.device), identity)
+            for encoding, identity in self.connection.execute(
+                "SELECT encodings.encoding, faces.identity FROM faces "
+                "JOIN encodings ON faces.digest = encodings.digest"
+            )
+        )
+
+    def entries(
+        self,
+    ) -> Iterator[Tuple[FacePatch, Identity, Optional[Tuple[str, FaceEncoding]]]]:
+        return (
+            (
+                dequantize_patch(from_blob(patch, self.device)),
+                identity,
+                (
+                    None
+                    if version is None
+                    else (version, from_blob(encoding, self.device))
+                ),
+            )
+            for patch, identity, version, encoding in self.connection.execute(
+                "SELECT faces.patch, faces.identity, encodings.version, encodings.encoding "
+                "FROM faces LEFT JOIN encodings ON faces.digest = encodings.digest"
+            )
+        )
+
+    def identities(self) -> Iterator[Identity]:
+        return (
+            identity
+            for (identity,) in self.connection.execute("SELECT identity FROM faces")
+        )
+
+    def counts(self) -> Dict[Identity, int]:
+        return dict(
+            self.connection.execute(
+                "SELECT identity, COUNT(*) FROM faces GROUP BY identity"
+            )
+        )
 
     def __iter__(self) -> Iterator[Tuple[FacePatch, Identity]]:
-        return iter(self.data)
+        return (
+            (dequantize_patch(from_blob(patch, self.device)), identity)
+            for patch, identity in self.connection.execute(
+                "SELECT patch, identity FROM faces"
+            )
+        )
 
     def __len__(self) -> int:
-        return len(self.data)
+        return self.connection.execute("SELECT COUNT(*) FROM faces").fetchone()[0]
+
+
+# file extensions of SQLite registries
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+
+
+def open_registry(
+    path: Path, device: torch.device, backend: Optional[str] = None
+) -> Registry:
+    """Open the registry at *path* with storage *backend*.
+    Infers the backend from the file extension if *backend* is not given,
+    or uses "journal" if the registry has a journal.
+    """
+    if backend is None:
+        if path.suffix in SQLITE_SUFFIXES:
+            backend = "sqlite"
+        elif journal_path(path).exists():
+            backend = "journal"
+        else:
+            backend = "pickle"
+    if backend == "pickle":
+        return PickleRegistry.open(path, device)
+    if backend == "journal":
+        return JournalRegistry.open(path, device)
+    if backend == "sqlite":
+        return SqliteRegistry.open(path, device)
+    raise ValueError(f"unknown registry backend: {backend}")
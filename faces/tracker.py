@@ -0,0 +1,269 @@
+import math
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+import torch
+from numpy.typing import NDArray
+
+from faces import BoundingBox, Detections, FacePatch, Identity
+
+
+def iou(boxes: NDArray, others: NDArray) -> NDArray:
+    """Return the (N, M) intersections over union of (N, 4) *boxes* and (M, 4) *others*."""
+    lower = np.maximum(boxes[:, None, :2], others[None, :, :2])
+    upper = np.minimum(boxes[:, None, 2:], others[None, :, 2:])
+    intersection = np.prod(np.clip(upper - lower, 0, None), axis=2)
+    areas = np.prod(boxes[:, 2:] - boxes[:, :2], axis=1)
+    other_areas = np.prod(others[:, 2:] - others[:, :2], axis=1)
+    union = areas[:, None] + other_areas[None, :] - intersection
+    return intersection / np.maximum(union, 1e-12)
+
+
+def associate(
+    boxes: NDArray, others: NDArray, threshold: float
+) -> List[Tuple[int, int]]:
+    """Return the pairs of indices of *boxes* and *others* that overlap by at least
+    *threshold*. Each box is paired once, greedily by decreasing overlap.
+    """
+    if len(boxes) == 0 or len(others) == 0:
+        return []
+    overlaps = iou(boxes, others)
+    pairs: List[Tuple[int, int]] = []
+    rows, cols = set(), set()
+    for row, col in zip(
+        *np.unravel_index(np.argsort(-overlaps, axis=None), overlaps.shape)
+    ):
+        if overlaps[row, col] < threshold:
+            break
+        if row not in rows and col not in cols:
+            pairs.append((int(row), int(col)))
+            rows.add(row)
+            cols.add(col)
+    return pairs
+
+
+def _spread(points: NDArray) -> float:
+    """Return the mean distance of *points* to their centroid."""
+    return float(np.linalg.norm(points - points.mean(axis=0), axis=1).mean())
+
+
+def thumbnails(patches: torch.Tensor, size: int = 16) -> torch.Tensor:
+    """Return the (N, *size* x *size*) grayscale thumbnails of N face *patches*,
+    centered and of unit length, so that their dot product measures their likeness.
+    """
+    thumbs = torch.nn.functional.adaptive_avg_pool2d(
+        patches.mean(dim=1, keepdim=True), size
+    ).flatten(1)
+    return torch.nn.functional.normalize(
+        thumbs - thumbs.mean(dim=1, keepdim=True), dim=1
+    )
+
+
+@dataclass
+class Track:
+    """A face followed across video frames."""
+
+    # bounding box in the current frame, as (lower_left, lower_top, upper_left, upper_top)
+    box: NDArray
+
+    # face patch of the most recent detection
+    patch: FacePatch
+
+    # identity of the face, carried forward until it is re-identified. None if unknown.
+    identity: Optional[Identity] = None
+
+    # distance of the face to the identity's nearest reference
+    distance: float = math.inf
+
+    # thumbnail of the face patch the identity was found with
+    thumbnail: Optional[torch.Tensor] = None
+
+    # points within the face that are followed by optical flow, (K, 2)
+    points: NDArray = field(default_factory=lambda: np.empty((0, 2), np.float32))
+
+    # number of frames since the face was last detected
+    age: int = 0
+
+    # number of frames since the face was last identified
+    since_identification: int = 0
+
+    @property
+    def bounding_box(self) -> BoundingBox:
+        """Return the box as BoundingBox."""
+        return BoundingBox(*self.box.tolist())
+
+
+# pylint: disable=too-many-instance-attributes
+@dataclass
+class Tracker:
+    """Follow detected faces across video frames with sparse optical flow,
+    so that the detector only runs every few frames.
+    """
+
+    # number of frames per detection, detects every frame if one.
+    detection_interval: int = 5
+
+    # minimum overlap of a detected face with a track to continue the track.
+    iou_threshold: float = 0.3
+
+    # maximum number of points followed per face.
+    max_points: int = 20
+
+    # minimum number of points per face, the face is lost if fewer are followed.
+    min_points: int = 4
+
+    # number of frames a face keeps its identity, re-identified every detection if one.
+    reidentify_interval: int = 30
+
+    # distance threshold of the identifier, beyond which faces are unknown.
+    distance_threshold: float = 1.0
+
+    # faces whose distance to their identity is within this margin of the distance
+    # threshold are uncertain, and re-identified every detection.
+    margin: float = 0.1
+
+    # maximum change of a face's appearance, from zero (none) to two, to keep its identity.
+    max_drift: float = 0.2
+
+    # faces in the current frame
+    tracks: List[Track] = field(default_factory=list, init=False)
+
+    # grayscale version of the previous frame
+    _frame: Optional[NDArray] = field(default=None, init=False, repr=False)
+
+    # number of frames since the last detection
+    _since_detection: int = field(default=0, init=False, repr=False)
+
+    # True if a face was lost since the last detection
+    _lost: bool = field(default=False, init=False, repr=False)
+
+    @property
+    def needs_detection(self) -> bool:
+        """Return True if the next frame should be searched for faces."""
+        return (
+            self._frame is None
+            or self._lost
+            or self._since_detection + 1 >= self.detection_interval
+        )
+
+    def update(
+        self,
+        frame: NDArray,
+        detections: Detections,
+        identify: Callable[[torch.Tensor], Sequence[Tuple[Identity, float]]],
+    ) -> List[Track]:
+        """Replace the tracks by the faces detected in *frame*.
+        Detected faces continue the track they overlap most with, and keep its identity.
+        *identify* returns the identities and distances of the (N, ...) patches of new
+        faces, uncertain faces, and faces whose identity is outdated or whose
+        appearance changed.
+        """
+        assert detections.patches is not None, "requires extracted faces"
+        previous = self.tracks
+        matches = dict(
+            (col, row)
+            for row, col in associate(
+                np.array([track.box for track in previous]).reshape(-1, 4),
+                detections.boxes,
+                self.iou_threshold,
+            )
+        )
+        self.tracks = []
+        for index, (box, patch) in enumerate(zip(detections.boxes, detections.patches)):
+            if index in matches:
+                track = previous[matches[index]]
+                track.box, track.patch, track.age = box, patch, 0
+                track.since_identification += 1
+            else:
+                track = Track(box=box, patch=patch)
+            track.points = self._points(frame, box)
+            self.tracks.append(track)
+
+        thumbs = thumbnails(detections.patches)
+        stale = [
+            index
+            for index, track in enumerate(self.tracks)
+            if self._is_stale(track, thumbs[index])
+        ]
+        if stale:
+            # NOTE: all faces are identified at once
+            identities = identify(detections.patches[stale])
+            for index, (identity, distance) in zip(stale, identities):
+                track = self.tracks[index]
+                track.identity, track.distance = identity, distance
+                track.thumbnail = thumbs[index]
+                track.since_identification = 0
+
+        self._frame = frame
+        self._since_detection = 0
+        self._lost = False
+        return self.tracks
+
+    def propagate(self, frame: NDArray) -> List[Track]:
+        """Move the tracks along the optical flow from the previous frame to *frame*.
+        Tracks with too few followed points are dropped.
+        """
+        assert self._frame is not None, "requires a detection first"
+        tracks = [track for track in self.tracks if len(track.points) > 0]
+        self._lost |= len(tracks) < len(self.tracks)
+        if tracks:
+            # NOTE: all faces are followed at once
+            points = np.concatenate([track.points for track in tracks])
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(
+                self._frame, frame, points.reshape(-1, 1, 2), None
+            )
+            offsets = np.cumsum([len(track.points) for track in tracks])[:-1]
+            for track, old, new, found in zip(
+                tracks,
+                np.split(points, offsets),
+                np.split(moved.reshape(-1, 2), offsets),
+                np.split(status.ravel().astype(bool), offsets),
+            ):
+                old, new = old[found], new[found]
+                track.points = new
+                if len(new) < self.min_points:
+                    continue
+                shift = np.median(new - old, axis=0)
+                scale = _spread(new) / max(_spread(old), 1e-6)
+                center = (track.box[:2] + track.box[2:]) / 2 + shift
+                size = (track.box[2:] - track.box[:2]) * scale
+                track.box = np.concatenate([center - size / 2, center + size / 2])
+                track.age += 1
+                track.since_identification += 1
+
+        self.tracks = [
+            track for track in tracks if len(track.points) >= self.min_points
+        ]
+        self._lost |= len(self.tracks) < len(tracks)
+        self._frame = frame
+        self._since_detection += 1
+        return self.tracks
+
+    def _is_stale(self, track: Track, thumbnail: torch.Tensor) -> bool:
+        """Return True if *track* is to be re-identified, given its current *thumbnail*."""
+        return (
+            track.identity is None
+            or track.thumbnail is None
+            or abs(track.distance - self.distance_threshold) < self.margin
+            or track.since_identification >= self.reidentify_interval
+            or 1 - float(track.thumbnail @ thumbnail) > self.max_drift
+        )
+
+    def _points(self, frame: NDArray, box: NDArray) -> NDArray:
+        """Return up to *max_points* corners within *box* of *frame*, (K, 2)."""
+        mask = np.zeros_like(frame)
+        left, top = np.floor(np.maximum(box[:2], 0)).astype(int)
+        right, bottom = np.ceil(box[2:]).astype(int)
+        mask[top:bottom, left:right] = 255
+        corners = cv2.goodFeaturesToTrack(
+            frame,
+            maxCorners=self.max_points,
+            qualityLevel=0.01,
+            minDistance=3,
+            mask=mask,
+        )
+        if corners is None:
+            return np.empty((0, 2), np.float32)
+        return corners.reshape(-1, 2)
@@ -1,10 +1,11 @@
 from __future__ import annotations
 
 from collections import namedtuple
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import Callable, Iterator, Optional, Tuple, Union, overload
 
+import numpy as np
 import torch
 from numpy.typing import NDArray
 from PIL import Image as PILImage
@@ -19,6 +20,10 @@ Identity = str
 
 VideoFrame = namedtuple("VideoFrame", ["rval", "frame"])
 
+# progress callback, called with the number of processed items,
+# their total number if known, and the elapsed seconds.
+Progress = Callable[[int, Optional[int], float], None]
+
 
 ## complex types
 @dataclass(frozen=True)
@@ -46,6 +51,73 @@ class BoundingBox:
         return (self.lower_left, self.lower_top, self.upper_left, self.upper_top)
 
 
+@dataclass(frozen=True, eq=False)
+class Detections:
+    """Faces detected in an image, as arrays rather than one `BoundingBox` per face.
+    Iterates over (BoundingBox, FaceProbability)-tuples, like `Detector.detect`.
+    """
+
+    # bounding boxes as (lower_left, lower_top, upper_left, upper_top)-rows, (N, 4)
+    boxes: NDArray
+    # likelihoods of there being a face, (N,)
+    probabilities: NDArray
+    # facial landmarks, (N, 5, 2). None if not detected.
+    landmarks: Optional[NDArray] = None
+    # face patches, (N, 3, S, S). None if not extracted.
+    patches: Optional[torch.Tensor] = None
+
+    @classmethod
+    def empty(cls) -> Detections:
+        """Return detections of no faces."""
+        return cls(np.empty((0, 4), np.float32), np.empty((0,), np.float32))
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def __iter__(self) -> Iterator[Tuple[BoundingBox, FaceProbability]]:
+        for box, probability in zip(self.boxes.tolist(), self.probabilities.tolist()):
+            yield BoundingBox(*box), probability
+
+    @overload
+    def __getitem__(self, index: int) -> Tuple[BoundingBox, FaceProbability]: ...
+
+    @overload
+    def __getitem__(self, index: Union[slice, NDArray]) -> Detections: ...
+
+    def __getitem__(self, index):
+        """Return the *index*-th face, or the faces selected by a slice or mask.
+        Slices are views of the arrays, masks and index arrays are copies.
+        """
+        if isinstance(index, (int, np.integer)):
+            return BoundingBox(*self.boxes[index].tolist()), float(
+                self.probabilities[index]
+            )
+        return Detections(
+            boxes=self.boxes[index],
+            probabilities=self.probabilities[index],
+            landmarks=None if self.landmarks is None else self.landmarks[index],
+            patches=(
+                None
+                if self.patches is None
+                else self.patches[
+                    torch.from_numpy(index) if isinstance(index, np.ndarray) else index
+                ]
+            ),
+        )
+
+    def filter(self, threshold: float) -> Detections:
+        """Return the faces whose probability is at least *threshold*."""
+        keep = self.probabilities >= threshold
+        if keep.all():  # NOTE: the common case, which doesn't copy
+            return self
+        return self[keep]
+
+    def with_patches(self, patches: torch.Tensor) -> Detections:
+        """Return the detections with face *patches*, one per bounding box."""
+        assert len(patches) == len(self), "requires one patch per bounding box"
+        return replace(self, patches=patches)
+
+
 @dataclass(frozen=True)
 class Image:
     """An image."""
@@ -1,9 +1,16 @@
+import hashlib
+import io
+import itertools
 import typing
 
+import numpy as np
+import torch
 from PIL import Image
 
 EXIF_ORIENTATION_KEY = 274
 
+T = typing.TypeVar("T")
+
 
 def preprocess(
     img: Image.Image,
@@ -41,3 +48,72 @@ def preprocess(
         img = img.rotate(rotate, expand=True)
 
     return img
+
+
+def digest(tensor: torch.Tensor) -> str:
+    """Return a hex digest of *tensor*'s dtype, shape, and values.
+
+    Unlike the tensor's hash, the digest is equal for tensors with equal content.
+
+    """
+    array = tensor.detach().cpu().contiguous().numpy()
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{array.dtype}{array.shape}".encode())
+    hasher.update(array.tobytes())
+    return hasher.hexdigest()
+
+
+def quantize_patch(face_patch: torch.Tensor) -> torch.Tensor:
+    """Return *face_patch* as uint8 tensor.
+
+    Face patches are standardized pixel values, i.e., (k - 127.5) / 128 for k in [0, 255],
+    and are restored exactly by `dequantize_patch`. Other values are rounded to the
+    nearest such value, i.e., are off by at most 1/256.
+
+    """
+    if face_patch.dtype == torch.uint8:
+        return face_patch
+    return (face_patch.detach() * 128 + 127.5).round_().clamp_(0, 255).to(torch.uint8)
+
+
+def dequantize_patch(face_patch: torch.Tensor) -> torch.Tensor:
+    """Return the standardized float patch of a patch quantized by `quantize_patch`."""
+    if face_patch.dtype != torch.uint8:
+        return face_patch
+    return (face_patch.to(torch.float32) - 127.5) / 128
+
+
+def to_blob(tensor: torch.Tensor) -> bytes:
+    """Serialize *tensor* to bytes, e.g., to store it in a database."""
+    buffer = io.BytesIO()
+    np.save(buffer, tensor.detach().cpu().numpy(), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def from_blob(blob: bytes, device: torch.device) -> torch.Tensor:
+    """Deserialize a tensor serialized by `to_blob` onto *device*."""
+    return torch.from_numpy(np.load(io.BytesIO(blob), allow_pickle=False)).to(device)
+
+
+def append(buffer: torch.Tensor, size: int, row: torch.Tensor) -> torch.Tensor:
+    """Write *row* at position *size* of *buffer*.
+    Return the buffer, which is replaced by one of twice the capacity if it is full.
+    """
+    if size == len(buffer):
+        grown = torch.empty(
+            (max(1, 2 * size), *row.shape), dtype=row.dtype, device=row.device
+        )
+        if size > 0:
+            grown[:size] = buffer[:size]
+        buffer = grown
+    buffer[size] = row
+    return buffer
+
+
+def chunked(iterable: typing.Iterable[T], size: int) -> typing.Iterator[typing.List[T]]:
+    """Iterate over lists of *size* consecutive items of *iterable*.
+    The last list is shorter if the items don't divide evenly.
+    """
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
@@ -3,6 +3,7 @@ from pathlib import Path
 
 import numpy as np
 import torch
+from PIL import Image as PILImage
 
 from faces import BoundingBox, Image
 from faces.detector import MTCNNDetector
@@ -198,6 +199,60 @@ class TestDetector(unittest.TestCase):
             )
         )
 
+    def test_detect_many(self) -> None:
+        images = [
+            Image.open(Path(__file__).parent / "data" / "images" / name)
+            for name in ("monty_python.jpg", "douglas_adams.jpg", "monty_python.jpg")
+        ]
+        # images of different sizes are detected in separate batches
+        self.assertNotEqual(images[0].image.size, images[1].image.size)
+        detections = self.detector.detect_many(images)
+        self.assertEqual(len(detections), 3)
+        for image, image_detections in zip(images, detections):
+            self.assertListEqual(
+                list(image_detections), list(self.detector.detect(image))
+            )
+        self.assertListEqual(self.detector.detect_many([]), [])
+
+    def test_extract_many(self) -> None:
+        images = [
+            Image.open(Path(__file__).parent / "data" / "images" / name)
+            for name in ("douglas_adams.jpg", "monty_python.jpg")
+        ]
+        extracts = self.detector.extract_many(images)
+        self.assertListEqual(
+            [len(image_extracts) for image_extracts in extracts], [1, 8]
+        )
+        for image, image_extracts in zip(images, extracts):
+            for (box, patch), (expected_box, expected_patch) in zip(
+                image_extracts, self.detector.extract(image)
+            ):
+                self.assertEqual(box, expected_box)
+                self.assertTrue(torch.equal(patch, expected_patch))
+
+    def test_extract_batch(self) -> None:
+        image = Image.open(
+            Path(__file__).parent / "data" / "images" / "monty_python.jpg"
+        )
+        detections = self.detector.extract_batch(image)
+        self.assertEqual(detections.boxes.shape, (8, 4))
+        self.assertEqual(detections.probabilities.shape, (8,))
+        self.assertEqual(detections.landmarks.shape, (8, 5, 2))
+        self.assertEqual(detections.patches.shape, (8, 3, 160, 160))
+        self.assertListEqual(list(detections), list(self.detector.detect(image)))
+        # same patches as extracting the faces one at a time
+        self.assertTrue(
+            torch.equal(
+                detections.patches,
+                self.detector.model.extract(image.image, detections.boxes, None),
+            )
+        )
+        # image w/o faces
+        detections = self.detector.extract_batch(Image(PILImage.new("RGB", (320, 240))))
+        self.assertEqual(detections.boxes.shape, (0, 4))
+        self.assertEqual(detections.patches.shape, (0, 3, 160, 160))
+        self.assertListEqual(list(detections), [])
+
 
 if __name__ == "__main__":
     unittest.main()
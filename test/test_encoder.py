@@ -1,3 +1,4 @@
+import tempfile
 import unittest
 from os.path import basename
 from pathlib import Path
@@ -6,7 +7,8 @@ import numpy as np
 import torch
 
 from faces import FaceEncoding, FacePatch
-from faces.encoder import ResnetEncoder
+from faces.encoder import CachedEncoder, ResnetEncoder
+from test.helpers import CountingEncoder
 
 
 class TestEncoder(unittest.TestCase):
@@ -44,5 +46,62 @@ class TestEncoder(unittest.TestCase):
             )
 
 
+class TestCachedEncoder(unittest.TestCase):
+    def setUp(self) -> None:
+        generator = torch.Generator().manual_seed(0)
+        self.patches = torch.randn((4, 3, 160, 160), generator=generator)
+
+    def test_many(self) -> None:
+        encoder = CountingEncoder()
+        cached = CachedEncoder(encoder, capacity=8)
+        expected = encoder.many(self.patches)
+        encoder.batch_sizes.clear()
+        # identical patches are encoded once
+        patches = self.patches[[0, 1, 0, 2]]
+        self.assertTrue(torch.equal(cached.many(patches), expected[[0, 1, 0, 2]]))
+        self.assertListEqual(encoder.batch_sizes, [3])
+        self.assertEqual((cached.hits, cached.misses), (1, 3))
+        # hits skip the encoder
+        self.assertTrue(torch.equal(cached.many(self.patches), expected))
+        self.assertTrue(torch.equal(cached(self.patches[1]), expected[1]))
+        self.assertListEqual(encoder.batch_sizes, [3, 1])
+        self.assertEqual((cached.hits, cached.misses), (5, 4))
+        self.assertEqual(cached.version, encoder.version)
+        self.assertEqual(cached.many(self.patches[:0]).shape, (0, 512))
+
+    def test_capacity(self) -> None:
+        encoder = CountingEncoder()
+        cached = CachedEncoder(encoder, capacity=2)
+        cached.many(self.patches[:2])
+        # the least recently used patch is forgotten
+        cached(self.patches[0])
+        cached(self.patches[2])
+        self.assertEqual(len(cached._memory), 2)
+        cached.many(self.patches[[0, 2]])
+        self.assertListEqual(encoder.batch_sizes, [2, 1])
+        cached(self.patches[1])
+        self.assertListEqual(encoder.batch_sizes, [2, 1, 1])
+
+    def test_version(self) -> None:
+        cached = CachedEncoder(CountingEncoder("v1"))
+        cached.many(self.patches)
+        # encodings of another version are not reused
+        cached.encoder = CountingEncoder("v2")
+        cached.many(self.patches)
+        self.assertListEqual(cached.encoder.batch_sizes, [4])
+
+    def test_path(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "encodings.db"
+            encoder = CountingEncoder()
+            expected = CachedEncoder(encoder, capacity=0, path=path).many(self.patches)
+            # stored encodings are reused by later processes
+            encoder = CountingEncoder()
+            cached = CachedEncoder(encoder, capacity=2, path=path)
+            self.assertTrue(torch.equal(cached.many(self.patches), expected))
+            self.assertListEqual(encoder.batch_sizes, [])
+            self.assertEqual((cached.hits, cached.misses), (4, 0))
+
+
 if __name__ == "__main__":
     unittest.main()
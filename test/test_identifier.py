@@ -1,13 +1,24 @@
+import os
+import shutil
+import tempfile
 import unittest
+from dataclasses import replace
+from functools import partial
 from os.path import basename
 from pathlib import Path
+from unittest import mock
 
 import numpy as np
 import torch
 
 from faces import FacePatch, Identity
 from faces.encoder import ResnetEncoder
-from faces.identifier import ConstrainedNearestNeighbourClassifier
+from faces.identifier import (
+    ConstrainedNearestNeighbourClassifier,
+    KNearestNeighbourClassifier,
+)
+from faces.index import Int8Index, PQIndex, ShardedIndex
+from faces.registry import InMemoryRegistry
 
 
 class TestIdentifier(unittest.TestCase):
@@ -37,6 +48,37 @@ class TestIdentifier(unittest.TestCase):
         self.assertEqual(identifier.classifier.targets.shape, (4,))
         self.assertEqual(len(identifier.index2identity), 4)
 
+        # encoded in batches, without gradients
+        reports = []
+        batched = ConstrainedNearestNeighbourClassifier.fit(
+            samples=samples,
+            distance_threshold=1.1,
+            restklasse="Anonymous",
+            encoder=self.encoder,
+            batch_size=3,
+            progress=lambda num_done, num_total, _: reports.append(
+                (num_done, num_total)
+            ),
+        )
+        self.assertListEqual(reports, [(3, 4), (4, 4)])
+        self.assertFalse(batched.classifier.encodings.requires_grad)
+        self.assertTrue(
+            torch.allclose(
+                batched.classifier.encodings, identifier.classifier.encodings, atol=1e-5
+            )
+        )
+        # the total is unknown for iterators
+        reports.clear()
+        ConstrainedNearestNeighbourClassifier.fit(
+            samples=iter(samples),
+            encoder=self.encoder,
+            batch_size=3,
+            progress=lambda num_done, num_total, _: reports.append(
+                (num_done, num_total)
+            ),
+        )
+        self.assertListEqual(reports, [(3, None), (4, None)])
+
         # empty data
         identifier = ConstrainedNearestNeighbourClassifier.fit(
             samples=[],
@@ -59,6 +101,164 @@ class TestIdentifier(unittest.TestCase):
         self.assertEqual(identifier.classifier.targets.shape, (0,))
         self.assertEqual(len(identifier.index2identity), 0)
 
+    def test_fit_registry(self) -> None:
+        registry = InMemoryRegistry()
+        for path in ("john-cleese.npy", "michael-palin.npy", "terry-jones.npy"):
+            registry.add(
+                FacePatch(np.load(Path(__file__).parent / "data" / "patches" / path)),
+                Identity(basename(path)),
+            )
+        registry.add(
+            FacePatch(
+                np.load(Path(__file__).parent / "data" / "patches" / "eric-idle.npy")
+            ),
+            "Anonymous",
+        )
+        identifier = ConstrainedNearestNeighbourClassifier.fit(
+            samples=registry,
+            distance_threshold=1.1,
+            restklasse="Anonymous",
+            encoder=self.encoder,
+        )
+        self.assertEqual(identifier.classifier.encodings.shape, (3, 512))
+        self.assertEqual(len(identifier.index2identity), 3)
+        for patch, target in registry:
+            if target != "Anonymous":
+                self.assertEqual(identifier(patch), target)
+
+    def test_save_changed(self) -> None:
+        generator = torch.Generator().manual_seed(0)
+        encodings = torch.nn.functional.normalize(
+            torch.randn((38, 512), generator=generator), dim=1
+        )
+        samples = [
+            (encoding, Identity(f"person {index % 4}"))
+            for index, encoding in enumerate(encodings[:30])
+        ]
+        # as many references are added as removed
+        queries = [index for index in range(38) if index >= 30 or index % 4 != 0]
+        expected = [
+            samples[index][1] if index < 30 else "newcomer" for index in queries
+        ]
+        for index in (
+            partial(Int8Index, num_candidates=4),
+            partial(PQIndex, num_subspaces=16, num_centroids=16, num_candidates=4),
+            partial(ShardedIndex, num_shards=2),
+        ):
+            identifier = ConstrainedNearestNeighbourClassifier.from_encodings(
+                samples, encoder=self.encoder, index=index
+            )
+            if isinstance(identifier.classifier, ShardedIndex):
+                self.addCleanup(identifier.classifier.close)
+            for encoding in encodings[30:]:
+                identifier.add(encoding, Identity("newcomer"))
+            identifier.remove(Identity("person 0"))
+            with tempfile.TemporaryDirectory() as directory:
+                identifier.save(Path(directory))
+                loaded = ConstrainedNearestNeighbourClassifier.load(
+                    Path(directory), encoder=self.encoder
+                )
+            found, distances = loaded.classifier.many(encodings[queries])
+            self.assertListEqual(
+                [loaded.index2identity[int(target)] for target in found], expected
+            )
+            self.assertTrue(torch.allclose(distances, torch.zeros(30), atol=1e-2))
+        # the exact encodings aren't kept without re-ranking
+        identifier = ConstrainedNearestNeighbourClassifier.from_encodings(
+            samples, encoder=self.encoder, index=partial(Int8Index, num_candidates=0)
+        )
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertRaises(ValueError, identifier.save, Path(directory))
+
+    def test_save_load(self) -> None:
+        samples = [
+            (
+                FacePatch(np.load(Path(__file__).parent / "data" / "patches" / path)),
+                Identity(basename(path)),
+            )
+            for path in (
+                "eric-idle.npy",
+                "graham-chapman.npy",
+                "john-cleese.npy",
+                "michael-palin.npy",
+            )
+        ]
+        identifier = ConstrainedNearestNeighbourClassifier.fit(
+            samples=samples, distance_threshold=1.1, encoder=self.encoder
+        )
+        identifier.remove(samples[1][1])
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "identifier"
+            identifier.save(path, fingerprint="samples")
+            # saving again replaces the identifier
+            identifier.save(path, fingerprint="samples")
+            self.assertListEqual(os.listdir(directory), ["identifier"])
+
+            # another process saved in the meantime
+            def save_concurrently(source: Path, target: Path) -> None:
+                shutil.copytree(source, target)
+                raise OSError(39, "Directory not empty")
+
+            with mock.patch(
+                "faces.identifier.os.replace", side_effect=save_concurrently
+            ):
+                identifier.save(path, fingerprint="samples")
+            self.assertListEqual(os.listdir(directory), ["identifier"])
+            # which is only assumed if the identifier is there
+            with mock.patch("faces.identifier.os.replace", side_effect=OSError(39)):
+                self.assertRaises(OSError, identifier.save, Path(directory) / "other")
+            self.assertListEqual(os.listdir(directory), ["identifier"])
+            loaded = ConstrainedNearestNeighbourClassifier.load(
+                path, encoder=self.encoder, fingerprint="samples"
+            )
+            self.assertEqual(loaded.distance_threshold, 1.1)
+            self.assertEqual(loaded.restklasse, "Anonymous")
+            self.assertDictEqual(loaded.index2identity, identifier.index2identity)
+            self.assertTrue(
+                torch.equal(
+                    loaded.classifier.encodings, identifier.classifier.encodings
+                )
+            )
+            self.assertTrue(
+                torch.equal(loaded.classifier.targets, identifier.classifier.targets)
+            )
+            for patch, identity in samples:
+                self.assertEqual(loaded(patch), identifier(patch))
+            # loaded identifiers can be modified
+            loaded.add(samples[1][0], samples[1][1])
+            self.assertEqual(loaded(samples[1][0]), samples[1][1])
+            # the distance threshold can be overridden
+            loaded = ConstrainedNearestNeighbourClassifier.load(
+                path, encoder=self.encoder, distance_threshold=0.5
+            )
+            self.assertEqual(loaded.distance_threshold, 0.5)
+            # mismatches are rejected
+            self.assertRaises(
+                ValueError,
+                ConstrainedNearestNeighbourClassifier.load,
+                path,
+                encoder=self.encoder,
+                fingerprint="other samples",
+            )
+            with mock.patch.object(type(self.encoder), "version", "other encoder"):
+                self.assertRaises(
+                    ValueError,
+                    ConstrainedNearestNeighbourClassifier.load,
+                    path,
+                    encoder=self.encoder,
+                )
+
+            # empty identifier
+            empty = ConstrainedNearestNeighbourClassifier.fit(
+                samples=[], encoder=self.encoder
+            )
+            empty.save(path)
+            loaded = ConstrainedNearestNeighbourClassifier.load(
+                path, encoder=self.encoder
+            )
+            self.assertTrue(loaded.classifier.is_empty)
+            self.assertEqual(loaded(samples[0][0]), "Anonymous")
+
     def test_call(self) -> None:
         idle, chapman, *samples_train = [
             (
@@ -98,6 +298,197 @@ class TestIdentifier(unittest.TestCase):
         self.assertEqual(identifier(idle[0]), "Anonymous")
         self.assertEqual(identifier(chapman[0]), "Anonymous")
 
+    def test_many(self) -> None:
+        idle, chapman, *samples_train = [
+            (
+                FacePatch(np.load(Path(__file__).parent / "data" / "patches" / path)),
+                Identity(basename(path)),
+            )
+            for path in (
+                "eric-idle.npy",
+                "graham-chapman.npy",
+                "john-cleese.npy",
+                "michael-palin.npy",
+                "terry-gilliam.npy",
+                "terry-jones.npy",
+            )
+        ]
+        patches = torch.stack([idle[0], chapman[0]] + [p for p, _ in samples_train])
+
+        # non-empty identifier
+        identifier = ConstrainedNearestNeighbourClassifier.fit(
+            samples=samples_train,
+            distance_threshold=1.1,
+            restklasse="Anonymous",
+            encoder=self.encoder,
+        )
+        results = identifier.many(patches)
+        self.assertListEqual(
+            [identity for identity, _ in results],
+            ["terry-jones.npy", "Anonymous"] + [t for _, t in samples_train],
+        )
+        for patch, (identity, distance) in zip(patches, results):
+            self.assertEqual(identifier(patch), identity)
+            self.assertAlmostEqual(
+                identifier.nearest_neighbour(patch)[1], distance, places=4
+            )
+        self.assertListEqual(identifier.many(patches[:0]), [])
+
+        # empty identifier
+        identifier = ConstrainedNearestNeighbourClassifier.fit(
+            samples=[],
+            distance_threshold=1.1,
+            restklasse="Anonymous",
+            encoder=self.encoder,
+        )
+        self.assertListEqual(
+            identifier.many(patches[:2]),
+            [("Anonymous", float("inf")), ("Anonymous", float("inf"))],
+        )
+
+    def test_topk(self) -> None:
+        idle, *samples_train = [
+            (
+                FacePatch(np.load(Path(__file__).parent / "data" / "patches" / path)),
+                Identity(basename(path)),
+            )
+            for path in (
+                "eric-idle.npy",
+                "john-cleese.npy",
+                "michael-palin.npy",
+                "terry-gilliam.npy",
+                "terry-jones.npy",
+            )
+        ]
+        patches = torch.stack([p for p, _ in samples_train])
+        identifier = ConstrainedNearestNeighbourClassifier.fit(
+            samples=samples_train,
+            distance_threshold=1.1,
+            restklasse="Anonymous",
+            encoder=self.encoder,
+        )
+        results = identifier.topk(patches, 2)
+        for (_, target), neighbours in zip(samples_train, results):
+            self.assertEqual(len(neighbours), 2)
+            self.assertEqual(neighbours[0][0], target)
+            self.assertAlmostEqual(neighbours[0][1], 0.0, places=3)
+            self.assertGreater(neighbours[1][1], neighbours[0][1])
+        # encodings, and more neighbours than references
+        results = identifier.topk(self.encoder.many(patches), 10)
+        self.assertListEqual([len(neighbours) for neighbours in results], [4] * 4)
+        # the nearest neighbour agrees with many, but is not thresholded
+        self.assertEqual(
+            identifier.topk(idle[0].unsqueeze(0), 1)[0][0],
+            identifier.many(idle[0].unsqueeze(0))[0],
+        )
+
+        # empty identifier
+        identifier = ConstrainedNearestNeighbourClassifier.fit(
+            samples=[],
+            distance_threshold=1.1,
+            restklasse="Anonymous",
+            encoder=self.encoder,
+        )
+        self.assertListEqual(identifier.topk(patches[:2], 3), [[], []])
+
+    def test_vote(self) -> None:
+        idle, chapman, cleese = [
+            FacePatch(np.load(Path(__file__).parent / "data" / "patches" / path))
+            for path in ("eric-idle.npy", "graham-chapman.npy", "john-cleese.npy")
+        ]
+        center = self.encoder(idle)
+        directions = torch.nn.functional.normalize(
+            torch.randn((3, 512), generator=torch.Generator().manual_seed(0)), dim=1
+        )
+        # one near reference of A, two farther ones of B, and a far one of C
+        samples = [
+            (center + 0.1 * directions[0], "A"),
+            (center + 0.3 * directions[1], "B"),
+            (center + 0.3 * directions[2], "B"),
+            (self.encoder(cleese), "C"),
+        ]
+        identifier = KNearestNeighbourClassifier.from_encodings(
+            samples,
+            encoder=self.encoder,
+            distance_threshold=0.5,
+            restklasse="Anonymous",
+        )
+        patches = torch.stack([idle, chapman])
+
+        # the majority of the neighbours within the threshold decides
+        majority = replace(identifier, num_neighbours=4)
+        (identity, distance), unknown = majority.many(patches)
+        self.assertEqual(identity, "B")
+        self.assertAlmostEqual(distance, 0.3, places=4)
+        self.assertEqual(unknown[0], "Anonymous")
+        self.assertEqual(majority(idle), "B")
+        # the nearest neighbour outweighs the majority
+        weighted = replace(identifier, num_neighbours=4, weighted=True)
+        self.assertEqual(weighted.many(patches)[0][0], "A")
+        self.assertAlmostEqual(weighted.many(patches)[0][1], 0.1, places=4)
+        # a single neighbour is the nearest neighbour
+        single = replace(identifier, num_neighbours=1)
+        self.assertEqual(single(idle), "A")
+        self.assertListEqual(single.many(patches[:0]), [])
+
+    def test_add_remove(self) -> None:
+        idle, chapman, cleese, *samples_train = [
+            (
+                FacePatch(np.load(Path(__file__).parent / "data" / "patches" / path)),
+                Identity(basename(path)),
+            )
+            for path in (
+                "eric-idle.npy",
+                "graham-chapman.npy",
+                "john-cleese.npy",
+                "michael-palin.npy",
+                "terry-gilliam.npy",
+                "terry-jones.npy",
+            )
+        ]
+        identifier = ConstrainedNearestNeighbourClassifier.fit(
+            samples=samples_train,
+            distance_threshold=1.1,
+            restklasse="Anonymous",
+            encoder=self.encoder,
+        )
+        self.assertEqual(identifier(chapman[0]), "Anonymous")
+
+        # add a patch of a new identity
+        identifier.add(*chapman)
+        self.assertEqual(identifier.classifier.encodings.shape, (4, 512))
+        self.assertEqual(len(identifier.index2identity), 4)
+        self.assertEqual(identifier(chapman[0]), chapman[1])
+        # add an encoding of a new identity
+        identifier.add(self.encoder(cleese[0]), cleese[1])
+        self.assertEqual(identifier.classifier.encodings.shape, (5, 512))
+        self.assertEqual(identifier(cleese[0]), cleese[1])
+        # add the restklasse
+        identifier.add(idle[0], "Anonymous")
+        self.assertEqual(identifier.classifier.encodings.shape, (5, 512))
+
+        # remove identities
+        identifier.remove(chapman[1])
+        identifier.remove("not present")
+        self.assertEqual(identifier.classifier.encodings.shape, (4, 512))
+        self.assertEqual(identifier.classifier.targets.shape, (4,))
+        self.assertEqual(len(identifier.index2identity), 4)
+        self.assertEqual(identifier(chapman[0]), "Anonymous")
+        for patch, target in samples_train + [cleese]:
+            self.assertEqual(identifier(patch), target)
+
+        # add to an empty identifier
+        identifier = ConstrainedNearestNeighbourClassifier.fit(
+            samples=[],
+            distance_threshold=1.1,
+            restklasse="Anonymous",
+            encoder=self.encoder,
+        )
+        identifier.add(*chapman)
+        self.assertEqual(identifier(chapman[0]), chapman[1])
+        identifier.remove(chapman[1])
+        self.assertEqual(identifier(chapman[0]), "Anonymous")
+
 
 if __name__ == "__main__":
     unittest.main()
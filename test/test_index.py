@@ -0,0 +1,532 @@
+import unittest
+from functools import partial
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import torch
+
+from faces.index import (
+    BruteForceIndex,
+    CosineIndex,
+    Int8Index,
+    IVFIndex,
+    PQIndex,
+    PrototypeIndex,
+    ShardedIndex,
+)
+
+
+def _references(num_references: int = 300) -> torch.Tensor:
+    generator = torch.Generator().manual_seed(0)
+    return torch.nn.functional.normalize(
+        torch.randn((num_references, 512), generator=generator), dim=1
+    )
+
+
+class TestBruteForceIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.encodings = torch.stack(
+            [
+                torch.Tensor(
+                    np.load(Path(__file__).parent / "data" / "encodings" / path)
+                )
+                for path in (
+                    "eric-idle.npy",
+                    "graham-chapman.npy",
+                    "john-cleese.npy",
+                    "michael-palin.npy",
+                )
+            ]
+        )
+        self.targets = torch.tensor([0, 1, 2, 3])
+
+    def test_call(self) -> None:
+        index = BruteForceIndex(self.encodings, self.targets)
+        for encoding, target in zip(self.encodings, self.targets):
+            self.assertEqual(index(encoding), (target, 0.0))
+
+    def test_many(self) -> None:
+        index = BruteForceIndex(self.encodings, self.targets)
+        targets, distances = index.many(self.encodings)
+        self.assertListEqual(targets.tolist(), [0, 1, 2, 3])
+        self.assertListEqual(distances.tolist(), [0.0, 0.0, 0.0, 0.0])
+
+    def test_topk(self) -> None:
+        index = BruteForceIndex(self.encodings, self.targets)
+        targets, distances = index.topk(self.encodings, 2)
+        self.assertEqual(targets.shape, (4, 2))
+        self.assertListEqual(targets[:, 0].tolist(), [0, 1, 2, 3])
+        self.assertListEqual(distances[:, 0].tolist(), [0.0, 0.0, 0.0, 0.0])
+        self.assertTrue((distances[:, 1] > 0).all())
+        # no more neighbours than references
+        targets, distances = index.topk(self.encodings, 10)
+        self.assertEqual(targets.shape, (4, 4))
+        self.assertTrue((distances[:, 1:] >= distances[:, :-1]).all())
+        empty = BruteForceIndex(torch.empty((0,)), torch.empty((0,)))
+        self.assertEqual(empty.topk(self.encodings, 3)[0].shape, (4, 0))
+
+    def test_add(self) -> None:
+        index = BruteForceIndex(torch.empty((0,)), torch.empty((0,)))
+        self.assertTrue(index.is_empty)
+        for encoding, target in zip(self.encodings, self.targets):
+            index.add(encoding, int(target))
+        self.assertFalse(index.is_empty)
+        self.assertEqual(index.encodings.shape, (4, 512))
+        self.assertEqual(index.targets.shape, (4,))
+        self.assertTrue(torch.equal(index.encodings, self.encodings))
+        self.assertTrue(torch.equal(index.targets, self.targets))
+        # the buffers grow by doubling
+        self.assertEqual(len(index._encodings), 4)
+        index.add(self.encodings[0], 4)
+        self.assertEqual(len(index._encodings), 8)
+        self.assertEqual(index(self.encodings[0])[1], 0.0)
+
+    def test_remove(self) -> None:
+        index = BruteForceIndex(self.encodings, self.targets)
+        index.remove(1)
+        index.remove(5)
+        self.assertEqual(index.encodings.shape, (3, 512))
+        self.assertListEqual(index.targets.tolist(), [0, 2, 3])
+        self.assertTrue(torch.equal(index.encodings, self.encodings[[0, 2, 3]]))
+        for target in (0, 2, 3):
+            index.remove(target)
+        self.assertTrue(index.is_empty)
+
+
+class TestCosineIndex(unittest.TestCase):
+    def test_many(self) -> None:
+        references = _references()
+        targets = torch.arange(len(references))
+        queries = torch.nn.functional.normalize(
+            references + 0.05 * _references(len(references)).flip(0), dim=1
+        )
+        exact_targets, exact_distances = BruteForceIndex(references, targets).many(
+            queries
+        )
+        # distances are euclidean
+        index = CosineIndex(references, targets)
+        found, distances = index.many(queries)
+        self.assertTrue(torch.equal(found, exact_targets))
+        self.assertTrue(torch.allclose(distances, exact_distances, atol=1e-3))
+        self.assertEqual(index(queries[7])[0], 7)
+        # queries and references are normalized
+        found, _ = index.many(2 * queries)
+        self.assertTrue(torch.equal(found, exact_targets))
+        # half precision
+        for dtype in (torch.float16, torch.bfloat16):
+            index = CosineIndex(references, targets, dtype=dtype)
+            self.assertEqual(index.encodings.dtype, dtype)
+            found, distances = index.many(queries)
+            self.assertTrue(torch.equal(found, exact_targets))
+            self.assertTrue(torch.allclose(distances, exact_distances, atol=2e-2))
+
+    def test_topk(self) -> None:
+        references = _references()
+        targets = torch.arange(len(references))
+        queries = _references(310)[300:]
+        exact_targets, exact_distances = BruteForceIndex(references, targets).topk(
+            queries, 5
+        )
+        found, distances = CosineIndex(references, targets).topk(queries, 5)
+        self.assertTrue(torch.equal(found, exact_targets))
+        self.assertTrue(torch.allclose(distances, exact_distances, atol=1e-5))
+        # low precision references rank near ties loosely, yet distances are sorted
+        _, distances = CosineIndex(references, targets, dtype=torch.bfloat16).topk(
+            queries, 5
+        )
+        self.assertTrue((distances[:, 1:] >= distances[:, :-1]).all())
+        self.assertTrue(torch.allclose(distances, exact_distances, atol=1e-2))
+
+    def test_add_remove(self) -> None:
+        references = _references(10)
+        index = CosineIndex(torch.empty((0,)), torch.empty((0,)), dtype=torch.bfloat16)
+        self.assertTrue(index.is_empty)
+        for target, encoding in enumerate(references):
+            index.add(3 * encoding, target)
+        self.assertEqual(index.encodings.dtype, torch.bfloat16)
+        self.assertListEqual(index.many(references)[0].tolist(), list(range(10)))
+        index.remove(3)
+        self.assertEqual(index.encodings.shape, (9, 512))
+        self.assertNotIn(3, index.many(references)[0].tolist())
+
+
+class TestInt8Index(unittest.TestCase):
+    def test_many(self) -> None:
+        references = _references()
+        targets = torch.arange(len(references))
+        queries = references + 0.01
+        exact_targets, exact_distances = BruteForceIndex(references, targets).many(
+            queries
+        )
+        index = Int8Index(references, targets)
+        self.assertEqual(index.codes.dtype, torch.int8)
+        self.assertEqual(index.codes.shape, (300, 512))
+        # re-ranked distances are exact
+        found, distances = index.many(queries)
+        self.assertTrue(torch.equal(found, exact_targets))
+        self.assertTrue(torch.allclose(distances, exact_distances, atol=1e-5))
+        # approximate distances
+        index.num_candidates = 0
+        found, distances = index.many(queries)
+        self.assertTrue(torch.equal(found, exact_targets))
+        self.assertTrue(torch.allclose(distances, exact_distances, atol=2e-2))
+
+    def test_topk(self) -> None:
+        references = _references()
+        targets = torch.arange(len(references))
+        queries = references + 0.01
+        exact_targets, exact_distances = BruteForceIndex(references, targets).topk(
+            queries, 3
+        )
+        index = Int8Index(references, targets)
+        # candidates are re-ranked exactly
+        found, distances = index.topk(queries, 3)
+        self.assertTrue(torch.equal(found[:, 0], exact_targets[:, 0]))
+        self.assertTrue(
+            torch.allclose(distances[:, 0], exact_distances[:, 0], atol=1e-5)
+        )
+        self.assertTrue((distances[:, 1:] >= distances[:, :-1]).all())
+        # more neighbours than candidates
+        self.assertEqual(index.topk(queries, 20)[0].shape, (300, 20))
+
+    def test_add_remove(self) -> None:
+        references = _references(10)
+        index = Int8Index(torch.empty((0,)), torch.empty((0,)))
+        for target, encoding in enumerate(references):
+            index.add(encoding, target)
+        self.assertEqual(index.codes.shape, (10, 512))
+        self.assertListEqual(index.many(references)[0].tolist(), list(range(10)))
+        index.remove(3)
+        self.assertEqual(index.codes.shape, (9, 512))
+        self.assertEqual(index.scales.shape, (9,))
+        self.assertNotIn(3, index.many(references)[0].tolist())
+
+    def test_exact(self) -> None:
+        references = _references()
+        targets = torch.arange(len(references))
+        added = _references(2) + 1
+        # the given encodings are referred to, added ones kept aside
+        index = Int8Index(references, targets)
+        index.add(added[0], 300)
+        index.remove(0)
+        self.assertIs(index.encodings, references)
+        self.assertEqual(index._added.shape, (1, 512))
+        found, distances = index.many(torch.stack([added[0], references[1]]))
+        self.assertListEqual(found.tolist(), [300, 1])
+        self.assertTrue(torch.allclose(distances, torch.zeros(2), atol=1e-5))
+        # exact encodings are not kept without re-ranking
+        index = Int8Index(references, targets, num_candidates=0)
+        self.assertFalse(index.has_exact)
+        self.assertEqual(index.encodings.numel(), 0)
+        index.add(added[1], 300)
+        self.assertEqual(index.many(added[1:])[0].tolist(), [300])
+        self.assertFalse(index.has_exact)
+
+
+class TestPQIndex(unittest.TestCase):
+    def test_many(self) -> None:
+        references = _references()
+        targets = torch.arange(len(references))
+        queries = references + 0.01
+        exact_targets, exact_distances = BruteForceIndex(references, targets).many(
+            queries
+        )
+        index = PQIndex(
+            references, targets, num_subspaces=16, num_centroids=32, num_candidates=8
+        )
+        self.assertEqual(index.codebooks.shape, (16, 32, 32))
+        self.assertEqual(index.codes.shape, (300, 16))
+        self.assertEqual(index.codes.dtype, torch.uint8)
+        # re-ranked distances are exact
+        found, distances = index.many(queries)
+        self.assertTrue(torch.equal(found, exact_targets))
+        self.assertTrue(torch.allclose(distances, exact_distances, atol=1e-5))
+        # approximate distances
+        index.num_candidates = 0
+        found, distances = index.many(queries)
+        self.assertGreater((found == exact_targets).float().mean(), 0.5)
+        self.assertTrue((distances < 1.5).all())
+
+    def test_topk(self) -> None:
+        references = _references()
+        targets = torch.arange(len(references))
+        queries = references + 0.01
+        exact_targets, exact_distances = BruteForceIndex(references, targets).topk(
+            queries, 3
+        )
+        index = PQIndex(
+            references, targets, num_subspaces=16, num_centroids=32, num_candidates=8
+        )
+        # candidates are re-ranked exactly
+        found, distances = index.topk(queries, 3)
+        self.assertTrue(torch.equal(found[:, 0], exact_targets[:, 0]))
+        self.assertTrue(
+            torch.allclose(distances[:, 0], exact_distances[:, 0], atol=1e-5)
+        )
+        self.assertTrue((distances[:, 1:] >= distances[:, :-1]).all())
+        # more neighbours than candidates
+        self.assertEqual(index.topk(queries, 20)[0].shape, (300, 20))
+
+    def test_add_remove(self) -> None:
+        references = _references()
+        index = PQIndex(
+            torch.empty((0,)),
+            torch.empty((0,)),
+            num_subspaces=16,
+            num_centroids=32,
+            num_candidates=8,
+        )
+        for target, encoding in enumerate(references):
+            index.add(encoding, target)
+        self.assertIsNotNone(index.codebooks)
+        self.assertEqual(index.codes.shape, (300, 16))
+        self.assertListEqual(index.many(references)[0].tolist(), list(range(300)))
+        for target in range(0, 300, 2):
+            index.remove(target)
+        self.assertEqual(index.codes.shape, (150, 16))
+        self.assertListEqual(
+            index.many(references[1::2])[0].tolist(), list(range(1, 300, 2))
+        )
+
+    def test_exact(self) -> None:
+        references = _references()
+        index = PQIndex(
+            torch.empty((0,)),
+            torch.empty((0,)),
+            num_subspaces=16,
+            num_centroids=32,
+            num_candidates=0,
+        )
+        # exact encodings are kept until trained
+        for target, encoding in enumerate(references[:31]):
+            index.add(encoding, target)
+        self.assertTrue(index.has_exact)
+        self.assertListEqual(index.many(references[:31])[0].tolist(), list(range(31)))
+        for target, encoding in enumerate(references[31:], 31):
+            index.add(encoding, target)
+        self.assertIsNotNone(index.codebooks)
+        self.assertFalse(index.has_exact)
+        self.assertEqual(index.encodings.numel(), 0)
+        self.assertEqual(index.codes.shape, (300, 16))
+
+
+class TestPrototypeIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        # ten identities of thirty faces each, scattered around their centers
+        self.centers = _references(10)
+        generator = torch.Generator().manual_seed(1)
+        self.targets = torch.arange(10).repeat_interleave(30)
+        self.references = self.centers[self.targets] + 0.02 * torch.randn(
+            (300, 512), generator=generator
+        )
+
+    def test_mean(self) -> None:
+        index = PrototypeIndex(self.references, self.targets, threshold=1.0)
+        prototypes, targets = index.prototypes
+        self.assertEqual(prototypes.shape, (10, 512))
+        self.assertListEqual(targets.tolist(), list(range(10)))
+        # the mean, scaled to the references' average length
+        mean = self.references[90:120].mean(0)
+        scale = self.references[90:120].norm(dim=1).mean() / mean.norm()
+        self.assertTrue(torch.allclose(prototypes[3], scale * mean, atol=1e-6))
+        # queries near a center are decided by the prototypes alone
+        found, distances = index.many(self.centers)
+        self.assertListEqual(found.tolist(), list(range(10)))
+        self.assertTrue(
+            torch.allclose(distances, (self.centers - prototypes).norm(dim=1))
+        )
+
+    def test_fallback(self) -> None:
+        # unrelated to the identities
+        queries = _references(30)[10:]
+        exact_targets, exact_distances = BruteForceIndex(
+            self.references, self.targets
+        ).many(queries)
+        # queries far from the threshold are not compared to every face
+        index = PrototypeIndex(self.references, self.targets, threshold=0.5)
+        self.assertFalse(torch.allclose(index.many(queries)[1], exact_distances))
+        # queries near the threshold are compared to every face
+        index = PrototypeIndex(self.references, self.targets, threshold=1.4, margin=0.2)
+        found, distances = index.many(queries)
+        self.assertTrue(torch.equal(found, exact_targets))
+        self.assertTrue(torch.allclose(distances, exact_distances))
+
+    def test_medoids(self) -> None:
+        index = PrototypeIndex(self.references, self.targets, num_prototypes=3)
+        prototypes, targets = index.prototypes
+        self.assertEqual(prototypes.shape, (30, 512))
+        self.assertListEqual(
+            targets.tolist(), torch.arange(10).repeat_interleave(3).tolist()
+        )
+        # medoids are references of their target
+        for prototype, target in zip(prototypes, targets):
+            self.assertEqual(
+                self.targets[(self.references == prototype).all(1)].tolist(),
+                [target.item()],
+            )
+        found, _ = index.many(self.centers)
+        self.assertListEqual(found.tolist(), list(range(10)))
+
+    def test_fit(self) -> None:
+        # prototypes are fitted with the index, not on the first query
+        index = PrototypeIndex(self.references, self.targets, num_prototypes=3)
+        self.assertIsNotNone(index._prototypes)
+        with mock.patch.object(
+            index, "_fit_prototypes", wraps=index._fit_prototypes
+        ) as fit:
+            index.many(self.centers)
+            fit.assert_not_called()
+            # and refitted once changed
+            index.remove(3)
+            index.many(self.centers)
+            fit.assert_called_once()
+
+    def test_add_remove(self) -> None:
+        index = PrototypeIndex(torch.empty((0,)), torch.empty((0,)))
+        for encoding, target in zip(self.references, self.targets.tolist()):
+            index.add(encoding, target)
+        self.assertEqual(index.prototypes[0].shape, (10, 512))
+        self.assertListEqual(index.many(self.centers)[0].tolist(), list(range(10)))
+        index.remove(3)
+        self.assertEqual(index.prototypes[0].shape, (9, 512))
+        self.assertNotIn(3, index.many(self.centers)[0].tolist())
+
+
+class TestShardedIndex(unittest.TestCase):
+    def test_search(self) -> None:
+        references = _references()
+        targets = torch.arange(len(references))
+        queries = torch.nn.functional.normalize(references + 0.01, dim=1)
+        exact = BruteForceIndex(references, targets)
+        index = ShardedIndex(
+            references, targets, num_shards=3, index=partial(CosineIndex)
+        )
+        self.addCleanup(index.close)
+        self.assertListEqual(index._sizes, [100, 100, 100])
+        # merged from all shards
+        found, distances = index.topk(queries, 5)
+        exact_targets, exact_distances = exact.topk(queries, 5)
+        self.assertTrue(torch.equal(found, exact_targets))
+        self.assertTrue(torch.allclose(distances, exact_distances, atol=1e-5))
+        self.assertTrue(torch.equal(index.many(queries)[0], targets))
+        self.assertEqual(index(references[150])[0], 150)
+        # errors are raised in this process
+        with self.assertRaises(ValueError):
+            index._request([0], "unknown")
+        # the references are neither copied nor modified in this process
+        index.add(references[0], 300)
+        index.remove(0)
+        self.assertIs(index.encodings, references)
+        self.assertEqual(len(index.targets), 300)
+        self.assertListEqual(index._sizes, [100, 100, 100])
+
+    def test_add_remove(self) -> None:
+        references = _references(10)
+        index = ShardedIndex(torch.empty((0,)), torch.empty((0,)), num_shards=2)
+        self.addCleanup(index.close)
+        self.assertEqual(index.topk(references, 3)[0].shape, (10, 0))
+        for target, encoding in enumerate(references):
+            index.add(encoding, target)
+        self.assertListEqual(index._sizes, [5, 5])
+        # added references only live in the workers
+        self.assertEqual(index.encodings.shape, (0,))
+        self.assertEqual(index.targets.shape, (10,))
+        self.assertListEqual(index.many(references)[0].tolist(), list(range(10)))
+        index.remove(3)
+        index.remove(42)
+        self.assertListEqual(index._sizes, [5, 4])
+        self.assertEqual(index.targets.shape, (9,))
+        self.assertNotIn(3, index.many(references)[0].tolist())
+
+
+class TestIVFIndex(unittest.TestCase):
+    def test_exhaustive(self) -> None:
+        references = _references()
+        targets = torch.arange(len(references))
+        # too few references to train
+        index = IVFIndex(references[:10], targets[:10], num_lists=16, num_probes=1)
+        self.assertIsNone(index.centroids)
+        self.assertListEqual(index.many(references[:10])[0].tolist(), list(range(10)))
+        # all clusters are probed
+        index = IVFIndex(references, targets, num_lists=16, num_probes=16)
+        self.assertIsNotNone(index.centroids)
+        exact = BruteForceIndex(references, targets)
+        queries = references + 0.01
+        self.assertTrue(torch.equal(index.many(queries)[0], exact.many(queries)[0]))
+
+    def test_many(self) -> None:
+        references = _references()
+        index = IVFIndex(
+            references, torch.arange(len(references)), num_lists=16, num_probes=2
+        )
+        self.assertEqual(index.centroids.shape, (16, 512))
+        self.assertEqual(index.assignments.shape, (300,))
+        # references are found in their own cluster
+        targets, distances = index.many(references)
+        self.assertListEqual(targets.tolist(), list(range(300)))
+        self.assertTrue(torch.allclose(distances, torch.zeros(300), atol=1e-3))
+        self.assertEqual(index(references[7])[0], 7)
+
+    def test_topk(self) -> None:
+        references = _references()
+        targets = torch.arange(len(references))
+        queries = references + 0.01
+        exact_targets, exact_distances = BruteForceIndex(references, targets).topk(
+            queries, 3
+        )
+        index = IVFIndex(references, targets, num_lists=16, num_probes=16)
+        found, distances = index.topk(queries, 3)
+        self.assertTrue(torch.equal(found, exact_targets))
+        self.assertTrue(torch.allclose(distances, exact_distances, atol=1e-5))
+        # queries probe fewer references than neighbours requested
+        index.num_probes = 1
+        found, distances = index.topk(queries, 300)
+        self.assertListEqual(found[:, 0].tolist(), list(range(300)))
+        self.assertTrue((found == -1).any())
+        self.assertTrue(torch.isinf(distances[found == -1]).all())
+        self.assertFalse(torch.isinf(distances[found >= 0]).any())
+
+    def test_add_remove(self) -> None:
+        references = _references()
+        index = IVFIndex(
+            torch.empty((0,)), torch.empty((0,)), num_lists=16, num_probes=2
+        )
+        for target, encoding in enumerate(references):
+            index.add(encoding, target)
+        self.assertIsNotNone(index.centroids)
+        self.assertEqual(index.assignments.shape, (300,))
+        self.assertListEqual(index.many(references)[0].tolist(), list(range(300)))
+
+        for target in range(0, 300, 2):
+            index.remove(target)
+        self.assertEqual(index.encodings.shape, (150, 512))
+        self.assertEqual(index.assignments.shape, (150,))
+        self.assertListEqual(
+            index.many(references[1::2])[0].tolist(), list(range(1, 300, 2))
+        )
+
+    def test_exact(self) -> None:
+        references = _references()
+        index = PQIndex(
+            torch.empty((0,)),
+            torch.empty((0,)),
+            num_subspaces=16,
+            num_centroids=32,
+            num_candidates=0,
+        )
+        # exact encodings are kept until trained
+        for target, encoding in enumerate(references[:31]):
+            index.add(encoding, target)
+        self.assertTrue(index.has_exact)
+        self.assertListEqual(index.many(references[:31])[0].tolist(), list(range(31)))
+        for target, encoding in enumerate(references[31:], 31):
+            index.add(encoding, target)
+        self.assertIsNotNone(index.codebooks)
+        self.assertFalse(index.has_exact)
+        self.assertEqual(index.encodings.numel(), 0)
+        self.assertEqual(index.codes.shape, (300, 16))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,23 @@
 import shutil
+import tempfile
 import unittest
-from contextlib import redirect_stdout
+from contextlib import redirect_stderr, redirect_stdout
 from io import StringIO
 from pathlib import Path
 from tempfile import mkstemp
+from unittest import mock
 
 import torch
 from PIL import Image as PILImage
 
 from faces import Image
 from faces.builder import DefaultBuilder
+from faces.identifier import (
+    ConstrainedNearestNeighbourClassifier,
+    KNearestNeighbourClassifier,
+)
 from faces.main import Main
+from faces.registry import PickleRegistry, SqliteRegistry
 
 
 class TestMain(unittest.TestCase):
@@ -49,6 +56,55 @@ class TestMain(unittest.TestCase):
         annotated_image = Main().identify(self.builder, image)
         self.assertIsInstance(annotated_image, PILImage.Image)
 
+    def test_identify_many(self) -> None:
+        images = [
+            Image.open(Path(__file__).parent / "data" / "images" / name)
+            for name in ("douglas_adams.jpg", "monty_python.jpg")
+        ]
+        annotated_images = Main().identify_many(self.builder, images)
+        self.assertEqual(len(annotated_images), 2)
+        for annotated_image in annotated_images:
+            self.assertIsInstance(annotated_image, PILImage.Image)
+        self.assertListEqual(Main().detect_many(self.builder, []), [])
+
+    def test_register_many(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            shutil.copy(
+                Path(__file__).parent / "data" / "images" / "douglas_adams.jpg",
+                Path(directory) / "portrait.jpg",
+            )
+            Main().register_many(
+                self.builder,
+                [Path(directory), Path(directory) / "missing.jpg"],
+                identity="Douglas Adams",
+                batch_size=1,
+            )
+        self.assertEqual(self.builder.registry.counts()["Douglas Adams"], 1)
+
+    def test_register_many_interrupted(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ("douglas_adams.jpg", "monty_python.jpg"):
+                shutil.copy(
+                    Path(__file__).parent / "data" / "images" / name,
+                    Path(directory) / name,
+                )
+            for error in (EOFError, KeyboardInterrupt):
+                with mock.patch("faces.main.plt"), mock.patch(
+                    "builtins.input", side_effect=error
+                ), redirect_stdout(StringIO()), self.assertRaises(SystemExit):
+                    Main().register_many(
+                        self.builder,
+                        [
+                            Path(directory) / "douglas_adams.jpg",
+                            Path(directory) / "monty_python.jpg",
+                        ],
+                        batch_size=1,
+                    )
+                # faces added before the interruption are kept
+                self.assertEqual(
+                    self.builder.reload().registry.counts()["douglas adams"], 1
+                )
+
     def test_register(self) -> None:
         self.assertEqual(len(self.builder.registry), 4)
         Main().register(
@@ -71,6 +127,122 @@ class TestMain(unittest.TestCase):
             },
         )
 
+    def test_migrate_missing(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            source = Path(directory) / "typo.db"
+            with redirect_stderr(StringIO()), self.assertRaises(SystemExit):
+                Main().main(
+                    [
+                        "--registry-path",
+                        str(self.registry_path),
+                        "db",
+                        "migrate",
+                        str(source),
+                    ]
+                )
+            self.assertFalse(source.exists())
+
+    def test_migrate(self) -> None:
+        target_path = Path(mkstemp(prefix="faces-test-", suffix=".db")[1])
+        try:
+            builder = DefaultBuilder(
+                device=torch.device("cpu"), registry_path=target_path
+            )
+            self.assertIsInstance(builder.registry, SqliteRegistry)
+            Main().migrate(builder, self.builder.registry)
+            self.assertDictEqual(
+                builder.registry.counts(), self.builder.registry.counts()
+            )
+        finally:
+            for suffix in ("", "-wal", "-shm"):
+                Path(str(target_path) + suffix).unlink(missing_ok=True)
+
+    def test_cached_registry(self) -> None:
+        registry = self.builder.registry
+        self.assertIs(self.builder.registry, registry)
+        # reopened when another process changes the file
+        PickleRegistry.open(self.registry_path, torch.device("cpu")).add(
+            torch.zeros((3, 160, 160)), "nobody"
+        )
+        self.assertIsNot(self.builder.registry, registry)
+        self.assertEqual(len(self.builder.registry), 5)
+        # reload forces a reopen
+        registry = self.builder.registry
+        self.assertIsNot(self.builder.reload().registry, registry)
+
+    def test_export(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            gallery = Path(directory) / "gallery"
+            Main().export(self.builder, gallery)
+            identifier = ConstrainedNearestNeighbourClassifier.load(
+                gallery, encoder=self.builder.encoder
+            )
+            self.assertEqual(identifier.classifier.encodings.shape, (4, 512))
+            self.assertSetEqual(
+                set(identifier.index2identity.values()),
+                set(self.builder.registry.counts()),
+            )
+
+    def test_snapshot(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot_path = Path(directory) / "snapshot"
+            builder = DefaultBuilder(
+                device=torch.device("cpu"),
+                registry_path=self.registry_path,
+                snapshot_path=snapshot_path,
+            )
+            # fitted and saved
+            self.assertEqual(len(builder.identifier.index2identity), 4)
+            self.assertTrue(snapshot_path.exists())
+            # loaded instead of fitted
+            builder.reload()
+            with mock.patch.object(
+                ConstrainedNearestNeighbourClassifier, "fit", side_effect=AssertionError
+            ):
+                self.assertEqual(len(builder.identifier.index2identity), 4)
+            # refitted once the registry changes
+            builder.add(torch.zeros((3, 160, 160)), "nobody")
+            builder.reload()
+            self.assertEqual(len(builder.identifier.index2identity), 5)
+            # still fitted if the snapshot cannot be saved
+            builder.add(torch.ones((3, 160, 160)), "somebody")
+            builder.reload()
+            with mock.patch.object(
+                ConstrainedNearestNeighbourClassifier,
+                "save",
+                side_effect=OSError("Directory not empty"),
+            ):
+                self.assertEqual(len(builder.identifier.index2identity), 6)
+
+    def test_vote(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            for snapshot_path in (None, Path(directory) / "snapshot"):
+                builder = DefaultBuilder(
+                    device=torch.device("cpu"),
+                    registry_path=self.registry_path,
+                    snapshot_path=snapshot_path,
+                    num_neighbours=3,
+                    weighted_vote=True,
+                )
+                identifier = builder.identifier
+                self.assertIsInstance(identifier, KNearestNeighbourClassifier)
+                self.assertEqual(identifier.num_neighbours, 3)
+                self.assertTrue(identifier.weighted)
+
+    def test_add(self) -> None:
+        targets = self.builder.identifier.classifier.targets
+        patch = torch.zeros((3, 160, 160))
+        self.builder.add(patch, "nobody")
+        self.assertEqual(
+            len(self.builder.identifier.classifier.targets), len(targets) + 1
+        )
+        # duplicates reach neither the registry nor the identifier
+        self.builder.add(patch.clone(), "nobody")
+        self.assertEqual(len(self.builder.registry), 5)
+        self.assertEqual(
+            len(self.builder.identifier.classifier.targets), len(targets) + 1
+        )
+
     def test_remove(self) -> None:
         self.assertEqual(len(self.builder.registry), 4)
         Main().remove(self.builder, "terry-jones.npy")
@@ -1,13 +1,27 @@
+import pickle
 import unittest
 from pathlib import Path
 from tempfile import mkstemp
-from typing import Iterable, Tuple
+from typing import Iterable, Set, Tuple
 
 import numpy as np
 import torch
 
 from faces import FacePatch, Identity
-from faces.registry import InMemoryRegistry, PickleRegistry
+from faces.registry import (
+    InMemoryRegistry,
+    JournalRegistry,
+    PickleRegistry,
+    SqliteRegistry,
+    open_registry,
+)
+from faces.utils import digest
+from test.helpers import CountingEncoder
+
+
+def _content(faces: Iterable[Tuple[FacePatch, Identity]]) -> Set[Tuple[str, Identity]]:
+    """Return the digests of the *faces*' patches, and their identities."""
+    return {(digest(face_patch), identity) for face_patch, identity in faces}
 
 
 class TestInMemoryRegistry(unittest.TestCase):
@@ -38,6 +52,9 @@ class TestInMemoryRegistry(unittest.TestCase):
         registry, queries, patches = self._initialize_registry()
         self.assertEqual(len(registry.data), 6)
         self.assertSetEqual(set(registry.data), set(zip(patches, queries)))
+        # double add skips
+        self.assertFalse(registry.add(patches[0], queries[0]))
+        self.assertTrue(registry.add(patches[0], "new name"))
 
     def test_remove(self) -> None:
         registry, queries, patches = self._initialize_registry()
@@ -52,6 +69,29 @@ class TestInMemoryRegistry(unittest.TestCase):
         registry, queries, patches = self._initialize_registry()
         self.assertSetEqual(set(registry), set(zip(patches, queries)))
 
+    def test_add_many(self) -> None:
+        registry, queries, patches = self._initialize_registry()
+        registry.remove(queries[0])
+        # rolled back if the transaction fails
+        with self.assertRaises(KeyError):
+            with registry.transaction():
+                registry.add(patches[0], queries[0])
+                raise KeyError()
+        self.assertEqual(len(registry), 5)
+        registry.add_many([(patches[0], queries[0], None)])
+        self.assertEqual(len(registry), 6)
+
+    def test_encodings(self) -> None:
+        registry, queries, patches = self._initialize_registry()
+        encoder = CountingEncoder()
+        encodings = dict(
+            (identity, encoding)
+            for encoding, identity in registry.encodings(encoder, batch_size=4)
+        )
+        self.assertListEqual(encoder.batch_sizes, [4, 2])
+        self.assertSetEqual(set(encodings), set(queries))
+        self.assertListEqual(sorted(registry.identities()), sorted(queries))
+
     def test_len(self) -> None:
         registry = InMemoryRegistry()
         # new registry
@@ -107,32 +147,171 @@ class TestPickleRegistry(unittest.TestCase):
 
     def test_remove(self) -> None:
         registry, queries, patches = self._initialize_registry()
-        self.assertSetEqual(set(registry.data), set(zip(patches, queries)))
+        self.assertSetEqual(_content(registry), _content(zip(patches, queries)))
         self.assertEqual(len(registry.data), 6)
         registry.remove("eric-idle.npy")
         registry.remove("terry-gilliam.npy")
         registry.remove("not in the database")
         self.assertEqual(len(registry.data), 4)
+        self.assertEqual(len(registry.by_digest), 4)
+        # removed faces can be added again
+        registry.add(patches[0], "new name")
+        self.assertEqual(len(registry.data), 5)
 
     def test_add(self) -> None:
         registry, queries, patches = self._initialize_registry()
         # registry has been modified
         self.assertEqual(len(registry.data), 6)
-        self.assertSetEqual(set(registry.data), set(zip(patches, queries)))
+        self.assertSetEqual(_content(registry), _content(zip(patches, queries)))
         # double add raises
         self.assertRaises(ValueError, registry.add, patches[0], "new name")
+        self.assertRaises(ValueError, registry.add, patches[0].clone(), "new name")
         # double add skips
-        registry.add(patches[0], queries[0])
+        self.assertFalse(registry.add(patches[0], queries[0]))
+        self.assertFalse(registry.add(patches[0].clone(), queries[0]))
         self.assertEqual(len(registry.data), 6)
+        self.assertEqual(len(registry.by_digest), 6)
         # registry has been saved
         reloaded = PickleRegistry.open(self.registry_path, device=torch.device("cpu"))
         self.assertEqual(len(registry.data), 6)
-        self.assertSetEqual(set(registry.data), set(zip(patches, queries)))
+        self.assertSetEqual(_content(registry), _content(zip(patches, queries)))
+        # digests have been saved
+        self.assertSetEqual(set(reloaded.by_digest), set(registry.by_digest))
+        self.assertRaises(ValueError, reloaded.add, patches[0], "new name")
+
+    def test_transaction(self) -> None:
+        registry = PickleRegistry.open(self.registry_path, device=torch.device("cpu"))
+        patches = [torch.rand((3, 160, 160)) for _ in range(3)]
+        # commits once at the end
+        with registry.transaction():
+            for index, patch in enumerate(patches):
+                registry.add(patch, f"person {index}")
+            with registry.transaction():  # nested
+                registry.remove("person 0")
+            self.assertEqual(len(registry), 2)
+            self.assertFalse(self.registry_path.exists())
+        reloaded = PickleRegistry.open(self.registry_path, device=torch.device("cpu"))
+        self.assertEqual(len(reloaded), 2)
+        # rolls back on errors
+        with self.assertRaises(ValueError):
+            with registry.transaction():
+                registry.remove("person 1")
+                registry.add(patches[2], "someone else")
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(len(registry.by_digest), 2)
+        self.assertEqual(
+            len(PickleRegistry.open(self.registry_path, device=torch.device("cpu"))), 2
+        )
+
+    def test_add_many(self) -> None:
+        registry, queries, patches = self._initialize_registry()
+        new = torch.rand((3, 160, 160))
+        # a rejected face rejects all faces
+        self.assertRaises(
+            ValueError,
+            registry.add_many,
+            [(new, "new", None), (patches[0], "new name", None)],
+        )
+        self.assertEqual(len(registry), 6)
+        # known faces are skipped
+        registry.add_many(
+            [
+                (new, "new", ("counting", torch.zeros(512))),
+                (patches[0], queries[0], None),
+            ]
+        )
+        self.assertEqual(len(registry), 7)
+        reloaded = PickleRegistry.open(self.registry_path, device=torch.device("cpu"))
+        self.assertEqual(len(reloaded), 7)
+        self.assertEqual(len(reloaded.encoded), 1)
+
+    def test_encodings(self) -> None:
+        registry, queries, patches = self._initialize_registry()
+        encoder = CountingEncoder()
+        # all faces are encoded once
+        encodings = dict(
+            (identity, encoding) for encoding, identity in registry.encodings(encoder)
+        )
+        self.assertEqual(encoder.num_encoded, 6)
+        self.assertSetEqual(set(encodings), set(queries))
+        for identity, patch in zip(queries, patches):
+            self.assertTrue(torch.equal(encodings[identity], encoder(patch)))
+        encoder.num_encoded = 0
+        # stored encodings are reused, also after reloading
+        list(registry.encodings(encoder))
+        reloaded = PickleRegistry.open(self.registry_path, device=torch.device("cpu"))
+        self.assertEqual(len(list(reloaded.encodings(encoder))), 6)
+        self.assertEqual(encoder.num_encoded, 0)
+        # stale encodings are replaced
+        encoder.version = "other"
+        list(reloaded.encodings(encoder))
+        self.assertEqual(encoder.num_encoded, 6)
+        # passed encodings are stored
+        patch = torch.rand(patches[0].shape)
+        reloaded.add(patch, "new", encoding=(encoder.version, torch.zeros(512)))
+        encodings = dict(
+            (identity, encoding) for encoding, identity in reloaded.encodings(encoder)
+        )
+        self.assertEqual(encoder.num_encoded, 6)
+        self.assertTrue(torch.equal(encodings["new"], torch.zeros(512)))
+        # removed faces drop their encoding
+        reloaded.remove("new")
+        self.assertEqual(len(reloaded.encoded), 6)
+
+    def test_is_stale(self) -> None:
+        registry, queries, _ = self._initialize_registry()
+        # own writes keep the registry fresh
+        self.assertFalse(registry.is_stale())
+        other = PickleRegistry.open(self.registry_path, device=torch.device("cpu"))
+        other.remove(queries[0])
+        self.assertTrue(registry.is_stale())
+        self.assertFalse(other.is_stale())
+
+    def test_quantized(self) -> None:
+        registry, queries, patches = self._initialize_registry()
+        # patches are held as uint8, and restored exactly
+        self.assertTrue(all(patch.dtype == torch.uint8 for patch, _ in registry.data))
+        stored = {identity: patch for patch, identity in registry}
+        for identity, patch in zip(queries, patches):
+            self.assertTrue(torch.equal(stored[identity], patch))
+        # the file is about four times smaller than the float patches
+        self.assertLess(
+            3 * self.registry_path.stat().st_size,
+            sum(patch.element_size() * patch.nelement() for patch in patches),
+        )
+        # registries with float patches are quantized when opened
+        legacy = Path(__file__).parent / "data" / "registry" / "faces.pkl"
+        registry = PickleRegistry.open(legacy, device=torch.device("cpu"))
+        self.assertTrue(all(patch.dtype == torch.uint8 for patch, _ in registry.data))
+
+    def test_lazy(self) -> None:
+        registry, queries, _ = self._initialize_registry()
+        # patches stay on the cpu until they are iterated over
+        self.assertTrue(all(patch.device.type == "cpu" for patch, _ in registry.data))
+        self.assertListEqual(sorted(registry.identities()), sorted(queries))
+        self.assertDictEqual(registry.counts(), {query: 1 for query in queries})
+        # faces are encoded in batches, and committed once
+        encoder = CountingEncoder()
+        stamp = registry.stamp
+        reports = []
+        list(
+            registry.encodings(
+                encoder,
+                batch_size=4,
+                progress=lambda num_done, num_total, _: reports.append(
+                    (num_done, num_total)
+                ),
+            )
+        )
+        self.assertListEqual(encoder.batch_sizes, [4, 2])
+        self.assertListEqual(reports, [(4, 6), (6, 6)])
+        self.assertEqual(len(registry.encoded), 6)
+        self.assertNotEqual(registry.stamp, stamp)
 
     def test_query(self) -> None:
         # new registry
         registry, queries, patches = self._initialize_registry()
-        self.assertSetEqual(set(registry), set(zip(patches, queries)))
+        self.assertSetEqual(_content(registry), _content(zip(patches, queries)))
         # loaded registry
         registry = PickleRegistry.open(
             Path(__file__).parent / "data" / "registry" / "faces.pkl",
@@ -153,5 +332,312 @@ class TestPickleRegistry(unittest.TestCase):
         self.assertEqual(len(registry), 4)
 
 
+class TestJournalRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry_base_path = Path(mkstemp(prefix="faces-test-")[1])
+        self.registry_path = Path(str(self.registry_base_path) + "-missing")
+        self.journal_path = Path(str(self.registry_path) + ".journal")
+
+    def tearDown(self) -> None:
+        self.registry_base_path.unlink(missing_ok=True)
+        self.registry_path.unlink(missing_ok=True)
+        self.journal_path.unlink(missing_ok=True)
+
+    def _initialize_registry(
+        self, compact_after: int = 1000
+    ) -> Tuple[JournalRegistry, Iterable[Identity], Iterable[FacePatch]]:
+        registry = JournalRegistry.open(self.registry_path, device=torch.device("cpu"))
+        registry.compact_after = compact_after
+
+        queries = (
+            "eric-idle.npy",
+            "graham-chapman.npy",
+            "john-cleese.npy",
+            "michael-palin.npy",
+            "terry-gilliam.npy",
+            "terry-jones.npy",
+        )
+        patches = [
+            FacePatch(np.load(Path(__file__).parent / "data" / "patches" / query))
+            for query in queries
+        ]
+
+        for identity, patch in zip(queries, patches):
+            registry.add(patch, identity)
+
+        return registry, queries, patches
+
+    def _reopen(self) -> JournalRegistry:
+        return JournalRegistry.open(self.registry_path, device=torch.device("cpu"))
+
+    def test_journal(self) -> None:
+        registry, queries, _ = self._initialize_registry()
+        # mutations are journaled, the snapshot is not written
+        self.assertFalse(self.registry_path.exists())
+        self.assertEqual(registry.num_records, 6)
+        registry.remove(queries[0])
+        self.assertEqual(registry.num_records, 7)
+        # the journal is replayed
+        reloaded = self._reopen()
+        self.assertEqual(len(reloaded), 5)
+        self.assertSetEqual({identity for _, identity in reloaded}, set(queries[1:]))
+        self.assertSetEqual(set(reloaded.by_digest), set(registry.by_digest))
+
+    def test_compact(self) -> None:
+        registry, queries, _ = self._initialize_registry(compact_after=4)
+        # compacted after the fifth record
+        self.assertTrue(self.registry_path.exists())
+        self.assertEqual(registry.num_records, 1)
+        self.assertEqual(len(self._reopen()), 6)
+        # explicit compaction
+        registry.remove(queries[0])
+        registry.compact()
+        self.assertFalse(self.journal_path.exists())
+        self.assertEqual(registry.num_records, 0)
+        self.assertEqual(len(self._reopen()), 5)
+
+    def test_transaction(self) -> None:
+        registry, queries, _ = self._initialize_registry()
+        size = self.journal_path.stat().st_size
+        with registry.transaction():
+            registry.remove(queries[0])
+            registry.remove(queries[1])
+            # records are appended at the end
+            self.assertEqual(self.journal_path.stat().st_size, size)
+        self.assertEqual(registry.num_records, 8)
+        self.assertEqual(len(self._reopen()), 4)
+
+    def test_encodings(self) -> None:
+        registry, _, _ = self._initialize_registry()
+        encoder = CountingEncoder()
+        list(registry.encodings(encoder))
+        self.assertEqual(encoder.num_encoded, 6)
+        self.assertEqual(registry.num_records, 12)
+        list(self._reopen().encodings(encoder))
+        self.assertEqual(encoder.num_encoded, 6)
+
+    def test_is_stale(self) -> None:
+        registry, queries, _ = self._initialize_registry(compact_after=6)
+        self.assertFalse(registry.is_stale())
+        other = self._reopen()
+        # appending to the journal, or compacting it, changes the files
+        other.remove(queries[0])
+        self.assertTrue(registry.is_stale())
+        registry = self._reopen()
+        other.remove(queries[1])
+        self.assertTrue(registry.is_stale())
+        self.assertFalse(other.is_stale())
+
+    def test_truncated_journal(self) -> None:
+        registry, queries, _ = self._initialize_registry()
+        # simulate a crash while appending the last record
+        size = self.journal_path.stat().st_size
+        with open(self.journal_path, "ab") as journal:
+            journal.write(b"\x80\x04\x95garbage")
+        registry = self._reopen()
+        # opening doesn't write
+        reloaded = self._reopen()
+        self.assertEqual(len(reloaded), 6)
+        self.assertFalse(registry.is_stale())
+        # the incomplete record is dropped by the next mutation
+        reloaded.remove(queries[0])
+        with open(self.journal_path, "rb") as journal:
+            journal.seek(size)
+            self.assertEqual(pickle.load(journal), ("remove", queries[0]))
+        self.assertEqual(len(self._reopen()), 5)
+
+    def test_open_registry(self) -> None:
+        self._initialize_registry()
+        # inferred from the journal
+        registry = open_registry(self.registry_path, torch.device("cpu"))
+        self.assertIsInstance(registry, JournalRegistry)
+        self.assertEqual(len(registry), 6)
+
+    def test_open(self) -> None:
+        self._initialize_registry()
+        registry = self._reopen()
+        stat = self.journal_path.stat()
+        # opening doesn't touch the journal
+        self.assertEqual(len(self._reopen()), 6)
+        self.assertEqual(self.journal_path.stat().st_mtime_ns, stat.st_mtime_ns)
+        self.assertFalse(registry.is_stale())
+
+
+class TestSqliteRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry_base_path = Path(mkstemp(prefix="faces-test-", suffix=".db")[1])
+        self.registry_base_path.unlink()
+
+    def tearDown(self) -> None:
+        for suffix in ("", "-wal", "-shm"):
+            Path(str(self.registry_base_path) + suffix).unlink(missing_ok=True)
+
+    def _initialize_registry(
+        self,
+    ) -> Tuple[SqliteRegistry, Iterable[Identity], Iterable[FacePatch]]:
+        registry = SqliteRegistry.open(
+            self.registry_base_path, device=torch.device("cpu")
+        )
+
+        queries = (
+            "eric-idle.npy",
+            "graham-chapman.npy",
+            "john-cleese.npy",
+            "michael-palin.npy",
+            "terry-gilliam.npy",
+            "terry-jones.npy",
+        )
+        patches = [
+            FacePatch(np.load(Path(__file__).parent / "data" / "patches" / query))
+            for query in queries
+        ]
+
+        for identity, patch in zip(queries, patches):
+            registry.add(patch, identity)
+
+        return registry, queries, patches
+
+    def _reopen(self) -> SqliteRegistry:
+        return SqliteRegistry.open(self.registry_base_path, device=torch.device("cpu"))
+
+    def test_add(self) -> None:
+        registry, queries, patches = self._initialize_registry()
+        self.assertEqual(len(registry), 6)
+        # double add raises
+        self.assertRaises(ValueError, registry.add, patches[0].clone(), "new name")
+        # double add skips
+        self.assertFalse(registry.add(patches[0].clone(), queries[0]))
+        self.assertEqual(len(registry), 6)
+        # registry has been saved
+        reloaded = self._reopen()
+        self.assertEqual(len(reloaded), 6)
+        stored = {identity: patch for patch, identity in reloaded}
+        for identity, patch in zip(queries, patches):
+            self.assertTrue(torch.equal(stored[identity], patch))
+
+    def test_remove(self) -> None:
+        registry, queries, _ = self._initialize_registry()
+        registry.add(torch.rand((3, 160, 160)), queries[0])
+        registry.remove(queries[0])
+        registry.remove("not in the database")
+        self.assertEqual(len(registry), 5)
+        self.assertSetEqual(
+            {identity for _, identity in self._reopen()}, set(queries[1:])
+        )
+
+    def test_transaction(self) -> None:
+        registry, queries, patches = self._initialize_registry()
+        # rolls back on errors
+        with self.assertRaises(ValueError):
+            with registry.transaction():
+                registry.remove(queries[0])
+                with registry.transaction():  # nested
+                    registry.add(torch.rand((3, 160, 160)), "new")
+                self.assertEqual(len(registry), 6)
+                registry.add(patches[1], "someone else")
+        self.assertEqual(len(registry), 6)
+        self.assertEqual(len(self._reopen()), 6)
+        # commits at the end
+        registry.add_many(
+            [(torch.rand((3, 160, 160)), "new", None), (patches[0], queries[0], None)]
+        )
+        self.assertEqual(len(self._reopen()), 7)
+
+    def test_counts(self) -> None:
+        registry, queries, _ = self._initialize_registry()
+        registry.add(torch.rand((3, 160, 160)), queries[0])
+        counts = registry.counts()
+        self.assertEqual(counts[queries[0]], 2)
+        self.assertEqual(sum(counts.values()), 7)
+
+    def test_encodings(self) -> None:
+        registry, queries, patches = self._initialize_registry()
+        encoder = CountingEncoder()
+        encodings = dict(
+            (identity, encoding) for encoding, identity in registry.encodings(encoder)
+        )
+        self.assertEqual(encoder.num_encoded, 6)
+        self.assertTrue(torch.equal(encodings[queries[0]], encoder(patches[0])))
+        # stored encodings are reused
+        encoder.num_encoded = 0
+        self.assertEqual(len(list(self._reopen().encodings(encoder))), 6)
+        self.assertEqual(encoder.num_encoded, 0)
+        # passed encodings are stored
+        registry.add(
+            torch.rand((3, 160, 160)),
+            "new",
+            encoding=(encoder.version, torch.zeros(512)),
+        )
+        encodings = dict(
+            (identity, encoding) for encoding, identity in registry.encodings(encoder)
+        )
+        self.assertEqual(encoder.num_encoded, 0)
+        self.assertTrue(torch.equal(encodings["new"], torch.zeros(512)))
+        # stale encodings are replaced
+        encoder.version = "other"
+        list(registry.encodings(encoder))
+        self.assertEqual(encoder.num_encoded, 7)
+        # entries come with their encoding
+        self.assertTrue(
+            all(encoding[0] == "other" for _, _, encoding in registry.entries())
+        )
+
+    def test_lazy(self) -> None:
+        registry, queries, _ = self._initialize_registry()
+        self.assertListEqual(sorted(registry.identities()), sorted(queries))
+        # faces are encoded in batches
+        encoder = CountingEncoder()
+        encodings = dict(
+            (identity, encoding)
+            for encoding, identity in registry.encodings(encoder, batch_size=4)
+        )
+        self.assertListEqual(encoder.batch_sizes, [4, 2])
+        self.assertSetEqual(set(encodings), set(queries))
+
+    def test_fingerprint(self) -> None:
+        registry, queries, patches = self._initialize_registry()
+        fingerprint = registry.fingerprint()
+        # equal content has an equal fingerprint, across backends
+        pickled = PickleRegistry.open(
+            Path(str(self.registry_base_path) + ".pkl"), device=torch.device("cpu")
+        )
+        pickled.add_many((patch, identity, None) for patch, identity in registry)
+        self.assertEqual(pickled.fingerprint(), fingerprint)
+        # changes alter the fingerprint
+        registry.remove(queries[0])
+        self.assertNotEqual(registry.fingerprint(), fingerprint)
+        registry.add(patches[0], "new name")
+        self.assertNotEqual(registry.fingerprint(), fingerprint)
+        registry.remove("new name")
+        registry.add(patches[0], queries[0])
+        self.assertEqual(registry.fingerprint(), fingerprint)
+        Path(str(self.registry_base_path) + ".pkl").unlink()
+
+    def test_is_stale(self) -> None:
+        registry, queries, _ = self._initialize_registry()
+        self.assertFalse(registry.is_stale())
+        other = self._reopen()
+        other.remove(queries[0])
+        self.assertTrue(registry.is_stale())
+        # checking resets the staleness
+        self.assertFalse(registry.is_stale())
+        self.assertFalse(other.is_stale())
+
+    def test_open_registry(self) -> None:
+        device = torch.device("cpu")
+        self.assertIsInstance(
+            open_registry(self.registry_base_path, device), SqliteRegistry
+        )
+        self.assertIsInstance(
+            open_registry(
+                Path(__file__).parent / "data" / "registry" / "faces.pkl", device
+            ),
+            PickleRegistry,
+        )
+        self.assertRaises(
+            ValueError, open_registry, self.registry_base_path, device, "unknown"
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,197 @@
+import unittest
+from typing import List, Sequence, Tuple
+
+import cv2
+import numpy as np
+import torch
+
+from faces import BoundingBox, Detections, Detector, Identity, Image
+from faces.tracker import Tracker, associate, iou, thumbnails
+
+
+def _frame(shift=(0, 0)) -> np.ndarray:
+    """Return a textured grayscale frame, moved by *shift* pixels."""
+    noise = np.random.default_rng(0).integers(0, 256, (240, 320)).astype(np.uint8)
+    frame = cv2.GaussianBlur(noise, (5, 5), 0)
+    return np.roll(frame, shift=(shift[1], shift[0]), axis=(0, 1))
+
+
+def _detections(*boxes, faces: Sequence[int] = (0, 1, 2)) -> Detections:
+    """Return detections of *faces* in *boxes*, whose patches are random per face."""
+    return Detections(
+        boxes=np.array(boxes, np.float32).reshape(-1, 4),
+        probabilities=np.ones(len(boxes), np.float32),
+    ).with_patches(
+        torch.stack(
+            [
+                torch.randn(
+                    (3, 160, 160), generator=torch.Generator().manual_seed(face)
+                )
+                for face in faces[: len(boxes)]
+            ]
+        )
+        if boxes
+        else torch.empty((0, 3, 160, 160))
+    )
+
+
+class _Identify:
+    """Return the given identities, in the order of the patches,
+    and count the number of identified patches.
+    """
+
+    def __init__(self, *identities: Tuple[Identity, float]):
+        self.identities = list(identities)
+        self.num_patches = 0
+
+    def __call__(self, patches: torch.Tensor) -> List[Tuple[Identity, float]]:
+        self.num_patches += len(patches)
+        identities, self.identities = (
+            self.identities[: len(patches)],
+            self.identities[len(patches) :],
+        )
+        return identities
+
+
+class _NoFaces(Detector):
+    """Detect no faces."""
+
+    def detect(self, image: Image) -> List[Tuple[BoundingBox, float]]:
+        return []
+
+    def extract(self, image: Image) -> List[Tuple[BoundingBox, torch.Tensor]]:
+        return []
+
+
+class TestTracker(unittest.TestCase):
+    def test_iou(self) -> None:
+        overlaps = iou(
+            np.array([[0, 0, 10, 10], [20, 20, 30, 30]], np.float32),
+            np.array([[0, 0, 10, 10], [5, 0, 15, 10], [50, 50, 60, 60]], np.float32),
+        )
+        self.assertEqual(overlaps.shape, (2, 3))
+        self.assertTrue(np.allclose(overlaps, [[1, 1 / 3, 0], [0, 0, 0]]))
+
+    def test_associate(self) -> None:
+        boxes = np.array([[0, 0, 10, 10], [20, 20, 30, 30]], np.float32)
+        others = np.array(
+            [[21, 21, 31, 31], [1, 0, 11, 10], [2, 0, 12, 10]], np.float32
+        )
+        self.assertListEqual(
+            sorted(associate(boxes, others, threshold=0.3)), [(0, 1), (1, 0)]
+        )
+        self.assertListEqual(associate(boxes, others, threshold=0.9), [])
+        self.assertListEqual(associate(boxes[:0], others, threshold=0.3), [])
+
+    def test_update(self) -> None:
+        tracker = Tracker(detection_interval=3)
+        self.assertTrue(tracker.needs_detection)
+        tracks = tracker.update(
+            _frame(),
+            _detections([100, 80, 160, 150], [200, 60, 250, 120]),
+            _Identify(("Alice", 0.5), ("Bob", 0.6)),
+        )
+        self.assertListEqual([track.identity for track in tracks], ["Alice", "Bob"])
+        self.assertEqual(tracks[0].bounding_box, BoundingBox(100, 80, 160, 150))
+        self.assertTrue(
+            all(len(track.points) >= tracker.min_points for track in tracks)
+        )
+        # overlapping faces continue the track
+        first = tracks[0]
+        identify = _Identify(("Bob", 0.4))
+        tracks = tracker.update(_frame(), _detections([102, 80, 162, 150]), identify)
+        self.assertEqual(len(tracks), 1)
+        self.assertIs(tracks[0], first)
+        # and keep its identity
+        self.assertEqual(identify.num_patches, 0)
+        self.assertEqual((tracks[0].identity, tracks[0].distance), ("Alice", 0.5))
+
+    def test_propagate(self) -> None:
+        tracker = Tracker(detection_interval=3)
+        tracker.update(
+            _frame(),
+            _detections([100, 80, 160, 150], [200, 60, 250, 120]),
+            _Identify(("Alice", 0.5), ("Bob", 0.6)),
+        )
+        self.assertFalse(tracker.needs_detection)
+        tracks = tracker.propagate(_frame(shift=(4, -3)))
+        self.assertListEqual([track.identity for track in tracks], ["Alice", "Bob"])
+        self.assertTrue(np.allclose(tracks[0].box, [104, 77, 164, 147], atol=0.5))
+        self.assertTrue(np.allclose(tracks[1].box, [204, 57, 254, 117], atol=0.5))
+        self.assertListEqual([track.age for track in tracks], [1, 1])
+        # detects every third frame
+        self.assertFalse(tracker.needs_detection)
+        tracks = tracker.propagate(_frame(shift=(8, -6)))
+        self.assertTrue(np.allclose(tracks[0].box, [108, 74, 168, 144], atol=0.5))
+        self.assertTrue(tracker.needs_detection)
+
+    def test_reidentify(self) -> None:
+        tracker = Tracker(detection_interval=1, reidentify_interval=3)
+        boxes = ([100, 80, 160, 150], [200, 60, 250, 120])
+        identify = _Identify(("Alice", 0.5), ("Anonymous", 0.95))
+        tracker.update(_frame(), _detections(*boxes), identify)
+        self.assertEqual(identify.num_patches, 2)
+        # faces near the distance threshold are re-identified every detection
+        identify = _Identify(("Bob", 0.6))
+        tracks = tracker.update(_frame(), _detections(*boxes), identify)
+        self.assertEqual(identify.num_patches, 1)
+        self.assertListEqual([track.identity for track in tracks], ["Alice", "Bob"])
+        # as are faces whose appearance changes
+        identify = _Identify(("Carol", 0.3))
+        tracks = tracker.update(_frame(), _detections(*boxes, faces=(2, 1)), identify)
+        self.assertEqual(identify.num_patches, 1)
+        self.assertListEqual([track.identity for track in tracks], ["Carol", "Bob"])
+        # and all faces after *reidentify_interval* frames
+        identify = _Identify()
+        tracker.update(_frame(), _detections(*boxes, faces=(2, 1)), identify)
+        self.assertEqual(identify.num_patches, 0)
+        identify = _Identify(("Bob", 0.6))
+        tracker.update(_frame(), _detections(*boxes, faces=(2, 1)), identify)
+        self.assertEqual(identify.num_patches, 1)
+        identify = _Identify(("Carol", 0.3))
+        tracker.update(_frame(), _detections(*boxes, faces=(2, 1)), identify)
+        self.assertEqual(identify.num_patches, 1)
+
+    def test_unknown(self) -> None:
+        tracker = Tracker(detection_interval=1, distance_threshold=0.9, margin=0.1)
+        boxes = ([100, 80, 160, 150], [200, 60, 250, 120])
+        identify = _Identify(("Anonymous", 1.4), ("Anonymous", 0.85))
+        tracker.update(_frame(), _detections(*boxes), identify)
+        # faces far beyond the threshold stay unknown until they're re-identified
+        identify = _Identify(("Anonymous", 0.95))
+        tracks = tracker.update(_frame(), _detections(*boxes), identify)
+        self.assertEqual(identify.num_patches, 1)
+        self.assertListEqual([track.distance for track in tracks], [1.4, 0.95])
+
+    def test_no_faces(self) -> None:
+        tracker = Tracker()
+        detections = _NoFaces().extract_batch(Image.from_array(_frame()))
+        self.assertEqual(detections.patches.shape, (0, 3, 160, 160))
+        identify = _Identify()
+        self.assertListEqual(tracker.update(_frame(), detections, identify), [])
+        self.assertEqual(identify.num_patches, 0)
+
+    def test_thumbnails(self) -> None:
+        patches = _detections([0, 0, 1, 1], [0, 0, 1, 1], faces=(0, 1)).patches
+        thumbs = thumbnails(patches)
+        self.assertEqual(thumbs.shape, (2, 256))
+        self.assertTrue(torch.allclose(thumbs.norm(dim=1), torch.ones(2)))
+        self.assertAlmostEqual(float(thumbnails(patches + 0.1)[0] @ thumbs[0]), 1, 5)
+        self.assertLess(float(thumbs[0] @ thumbs[1]), 0.8)
+
+    def test_lost(self) -> None:
+        tracker = Tracker(detection_interval=10)
+        tracker.update(
+            _frame(), _detections([100, 80, 160, 150]), _Identify(("Alice", 0.5))
+        )
+        # the face disappears
+        self.assertListEqual(tracker.propagate(np.zeros_like(_frame())), [])
+        self.assertTrue(tracker.needs_detection)
+        # no faces
+        tracker.update(_frame(), _detections(), _Identify())
+        self.assertListEqual(tracker.propagate(_frame()), [])
+        self.assertFalse(tracker.needs_detection)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,9 +2,10 @@ import unittest
 from pathlib import Path
 
 import numpy as np
+import torch
 from PIL import Image as PILImage
 
-from faces import BoundingBox, Image
+from faces import BoundingBox, Detections, Image
 
 
 class TestImage(unittest.TestCase):
@@ -25,5 +26,57 @@ class TestBoundingBox(unittest.TestCase):
     pass
 
 
+class TestDetections(unittest.TestCase):
+    def setUp(self) -> None:
+        self.detections = Detections(
+            boxes=np.array(
+                [[10, 20, 30, 40], [40, 10, 60, 20], [80, 50, 160, 60]], np.float32
+            ),
+            probabilities=np.array([0.75, 0.5, 0.875], np.float32),
+            patches=torch.arange(3).float().reshape(3, 1),
+        )
+
+    def test_iter(self) -> None:
+        self.assertEqual(len(self.detections), 3)
+        self.assertListEqual(
+            [box for box, _ in self.detections],
+            [
+                BoundingBox(10, 20, 30, 40),
+                BoundingBox(40, 10, 60, 20),
+                BoundingBox(80, 50, 160, 60),
+            ],
+        )
+        self.assertEqual(self.detections[1], (BoundingBox(40, 10, 60, 20), 0.5))
+        self.assertListEqual(list(Detections.empty()), [])
+
+    def test_getitem(self) -> None:
+        # slices are views
+        detections = self.detections[1:]
+        self.assertTrue(np.shares_memory(detections.boxes, self.detections.boxes))
+        self.assertListEqual(list(detections), list(self.detections)[1:])
+        self.assertTrue(torch.equal(detections.patches, torch.tensor([[1.0], [2.0]])))
+        self.assertIsNone(detections.landmarks)
+        # masks
+        detections = self.detections[np.array([True, False, True])]
+        self.assertListEqual(detections.boxes[:, 0].tolist(), [10, 80])
+        self.assertTrue(torch.equal(detections.patches, torch.tensor([[0.0], [2.0]])))
+
+    def test_filter(self) -> None:
+        detections = self.detections.filter(0.7)
+        self.assertListEqual(detections.probabilities.tolist(), [0.75, 0.875])
+        self.assertListEqual(detections.boxes[:, 0].tolist(), [10, 80])
+        self.assertTrue(torch.equal(detections.patches, torch.tensor([[0.0], [2.0]])))
+        # all kept
+        self.assertIs(self.detections.filter(0.5), self.detections)
+        self.assertEqual(len(self.detections.filter(1.0)), 0)
+
+    def test_with_patches(self) -> None:
+        detections = Detections.empty().with_patches(torch.empty((0, 3, 8, 8)))
+        self.assertEqual(detections.patches.shape, (0, 3, 8, 8))
+        self.assertRaises(
+            AssertionError, self.detections.with_patches, torch.empty((2, 3, 8, 8))
+        )
+
+
 if __name__ == "__main__":
     unittest.main()
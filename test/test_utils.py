@@ -2,8 +2,16 @@ import unittest
 from pathlib import Path
 
 import PIL.Image
+import torch
 
-from faces.utils import preprocess
+from faces.utils import (
+    append,
+    chunked,
+    dequantize_patch,
+    digest,
+    preprocess,
+    quantize_patch,
+)
 
 
 class TestUtils(unittest.TestCase):
@@ -19,6 +27,42 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(preprocess(image, 1000, rotate=360).size, (1000, 643))
         self.assertEqual(preprocess(image, 1000, rotate=450).size, (643, 1000))
 
+    def test_digest(self):
+        tensor = torch.rand((3, 16, 16))
+        self.assertEqual(digest(tensor), digest(tensor.clone()))
+        self.assertNotEqual(digest(tensor), digest(tensor + 1))
+        self.assertNotEqual(digest(tensor), digest(tensor.reshape(3, 256)))
+        self.assertNotEqual(digest(tensor), digest(tensor.double()))
+
+    def test_chunked(self):
+        self.assertListEqual(list(chunked(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertListEqual(list(chunked(iter(range(4)), 2)), [[0, 1], [2, 3]])
+        self.assertListEqual(list(chunked([], 2)), [])
+
+    def test_append(self):
+        buffer = torch.empty((0,))
+        for size in range(5):
+            buffer = append(buffer, size, torch.full((2,), float(size)))
+        self.assertEqual(buffer.shape, (8, 2))
+        self.assertListEqual(buffer[:5, 0].tolist(), [0, 1, 2, 3, 4])
+
+    def test_quantize_patch(self):
+        pixels = torch.randint(0, 256, (3, 16, 16))
+        patch = (pixels.float() - 127.5) / 128
+        quantized = quantize_patch(patch)
+        self.assertEqual(quantized.dtype, torch.uint8)
+        self.assertTrue(torch.equal(quantized, pixels.to(torch.uint8)))
+        # standardized pixels are restored exactly
+        self.assertTrue(torch.equal(dequantize_patch(quantized), patch))
+        # other values are rounded
+        noisy = patch + 0.001
+        self.assertLessEqual(
+            (dequantize_patch(quantize_patch(noisy)) - noisy).abs().max(), 1 / 256
+        )
+        # other dtypes pass through
+        self.assertIs(quantize_patch(quantized), quantized)
+        self.assertIs(dequantize_patch(patch), patch)
+
 
 if __name__ == "__main__":
     unittest.main()